@@ -1,21 +1,34 @@
+import sys
+from importlib import import_module
+
 from .dataset import Dataset, Volume, Vertex, VolumeRGB, VertexRGB, Volume2D, Vertex2D
-from . import align, volume, quickflat, webgl, segment, options
+from . import volume, options
 from .database import db
 from .utils import *
-from .quickflat import make_figure as quickshow
 
 load = Dataset.from_file
 
-try:
-	from . import webgl
-	from .webgl import show as webshow
-except ImportError:
-	pass
+quickshow = DocLoader("make_figure", ".quickflat", "cortex")
+webshow = DocLoader("show", ".webgl", "cortex")
+
+# Heavyweight submodules (matplotlib, tornado, FSL, ...) are imported on first access
+_lazy_modules = ("align", "anat", "blender", "mni", "quickflat", "segment", "webgl")
+
+def __getattr__(name):
+	if name in _lazy_modules:
+		return import_module("." + name, __name__)
+	raise AttributeError("module %r has no attribute %r" % (__name__, name))
+
+def __dir__():
+	return sorted(set(globals().keys()) | set(_lazy_modules))
 
-try:
-	from . import anat
-except ImportError:
-	pass
+if sys.version_info < (3, 7):
+	# Module __getattr__ is not supported, so import everything up front
+	for _name in _lazy_modules:
+		try:
+			import_module("." + _name, __name__)
+		except ImportError:
+			pass
 
 # Create deprecated interface for database
 import warnings
@@ -26,4 +39,4 @@ class dep(object):
 	def __dir__(self):
 		warnings.warn("cortex.surfs is deprecated, use cortex.db instead", Warning)
 		return db.__dir__()
-surfs = dep()
\ No newline at end of file
+surfs = dep()
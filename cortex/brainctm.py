@@ -15,14 +15,15 @@ uv
 '''
 import os
 import json
-import tempfile
+
 import numpy as np
 from scipy.spatial import cKDTree
 
 from .database import db
-from .utils import get_cortical_mask, get_mapper, get_dropout
+from .utils import get_cortical_mask, get_mapper, get_dropout, _atomic_open
 from . import polyutils
-from openctm import CTMfile
+from . import instrument
+from .openctm import CTMfile
 
 class BrainCTM(object):
     def __init__(self, subject, decimate=False):
@@ -58,15 +59,14 @@ class BrainCTM(object):
             if fleft is not None:
                 #set medial wall
                 for hemi, ptpoly in ([self.left, fleft], [self.right, fright]):
-                    fidpolys = set(tuple(f) for f in polyutils.sort_polys(hemi.polys))
-                    flatpolys = set(tuple(f) for f in polyutils.sort_polys(ptpoly[1]))
-                    hemi.aux[np.array(list(fidpolys - flatpolys)).astype(int), 0] = 1
+                    mwall = polyutils.face_difference(hemi.polys, ptpoly[1])
+                    hemi.aux[mwall.astype(int), 0] = 1
 
         #Find the flatmap limits
         if fleft is not None:
             flatmerge = np.vstack([fleft[0][:,:2], fright[0][:,:2]])
             fmin, fmax = flatmerge.min(0), flatmerge.max(0)
-            self.flatlims = map(float, -fmin), map(float, fmax-fmin)
+            self.flatlims = list(map(float, -fmin)), list(map(float, fmax-fmin))
 
             self.left.setFlat(fleft[0])
             self.right.setFlat(fright[0])
@@ -89,6 +89,7 @@ class BrainCTM(object):
             self.left.aux[:,1] = npz.left
             self.right.aux[:,1] = npz.right
 
+    @instrument.traced("brainctm.save")
     def save(self, path, method='mg2', disp_layers=['rois'], extra_disp=None, **kwargs):
         """Save CTM file for static html display. 
 
@@ -110,21 +111,11 @@ class BrainCTM(object):
         (rpts, _, _), rbin = self.right.save(method=method, **kwargs)
 
         offsets = [0]
-        with open(path+'.ctm', 'w') as fp:
+        with _atomic_open(ctmname) as fp:
             fp.write(lbin)
             offsets.append(fp.tell())
             fp.write(rbin)
 
-        # Save the JSON descriptor | Need to add to this for extra_disp?
-        jsdict = dict(rois=os.path.split(svgname)[1],
-                      data=os.path.split(ctmname)[1],
-                      names=self.types, 
-                      materials=[],
-                      offsets=offsets)
-        if self.flatlims is not None:
-            jsdict['flatlims'] = self.flatlims
-        json.dump(jsdict, open(jsname, 'w'))
-
         # Compute and save the index map
         if method != 'raw':
             ptmap, inverse = [], []
@@ -152,7 +143,7 @@ class BrainCTM(object):
                 layers = (layers,)
             
             # assign coordinates in left hemisphere negative values
-            with open(svgname, "w") as fp:
+            with _atomic_open(svgname) as fp:
                 for layer in layers:
                     for element in layer.findall(".//{http://www.w3.org/2000/svg}text"):
                         idx = int(element.attrib["data-ptidx"])
@@ -163,12 +154,23 @@ class BrainCTM(object):
                             idx = inverse[1][idx] + len(inverse[0])
                         element.attrib["data-ptidx"] = str(idx)
                 fp.write(roipack.toxml())
+
+        # Save the JSON descriptor last, since its presence marks the pack as cached
+        # | Need to add to this for extra_disp?
+        jsdict = dict(rois=os.path.split(svgname)[1],
+                      data=os.path.split(ctmname)[1],
+                      names=self.types, 
+                      materials=[],
+                      offsets=offsets)
+        if self.flatlims is not None:
+            jsdict['flatlims'] = self.flatlims
+        with _atomic_open(jsname, "w") as fp:
+            json.dump(jsdict, fp)
         return ptmap
 
 class Hemi(object):
     def __init__(self, pts, polys, norms=None):
-        self.tf = tempfile.NamedTemporaryFile()
-        self.ctm = CTMfile(self.tf.name, "w")
+        self.ctm = CTMfile(None, "w")
 
         self.ctm.setMesh(pts.astype(np.float32), polys.astype(np.uint32), norms=norms)
 
@@ -198,11 +200,13 @@ class Hemi(object):
         self.flat = pts[:,:2]
 
     def save(self, **kwargs):
+        '''Encodes the mesh in memory, returning it as read back by OpenCTM,
+        which reorders the vertices, along with the encoded bytes'''
         self.ctm.addAttrib(self.aux, 'auxdat')
-        self.ctm.save(**kwargs)
+        data = self.ctm.save(**kwargs)
 
-        ctm = CTMfile(self.tf.name)
-        return ctm.getMesh(), self.tf.read()
+        ctm = CTMfile(data=data)
+        return ctm.getMesh(), data
 
 class DecimatedHemi(Hemi):
     def __init__(self, pts, polys, fpolys, pia=None):
@@ -210,9 +214,7 @@ class DecimatedHemi(Hemi):
         kdt = cKDTree(pts)
         mask = np.zeros((len(pts),), dtype=bool)
 
-        fidset = set([tuple(p) for p in polyutils.sort_polys(polys)])
-        flatset = set([tuple(p) for p in polyutils.sort_polys(fpolys)])
-        mwall = np.array(list(fidset - flatset))
+        mwall = polyutils.face_difference(polys, fpolys)
 
         dpts, dpolys = polyutils.decimate(pts, fpolys)
         dist, didx = kdt.query(dpts)
@@ -238,14 +240,16 @@ class DecimatedHemi(Hemi):
     def addSurf(self, pts, **kwargs):
         super(DecimatedHemi, self).addSurf(pts[self.mask], **kwargs)
 
+@instrument.traced("brainctm.make_pack")
 def make_pack(outfile, subj, types=("inflated",), method='raw', level=0,
               decimate=False, disp_layers=['rois'],extra_disp=None):
     """Generates a cached CTM file"""
 
-    ctm = BrainCTM(subj, decimate=decimate)
-    ctm.addCurvature()
-    for name in types:
-        ctm.addSurf(name)
+    with instrument.span("brainctm.load", subject=subj, types=list(types), decimate=decimate):
+        ctm = BrainCTM(subj, decimate=decimate)
+        ctm.addCurvature()
+        for name in types:
+            ctm.addSurf(name)
 
     if not os.path.exists(os.path.split(outfile)[0]):
         os.makedirs(os.path.split(outfile)[0])
@@ -263,17 +267,13 @@ def read_pack(ctmfile):
 
     meshes = []
 
-    with open(ctmfile, 'r') as ctmfp:
-        ctmfp.seek(0, 2)
-        offset.append(ctmfp.tell())
-
-        for start, end in zip(offset[:-1], offset[1:]):
-            ctmfp.seek(start)
-            tf = tempfile.NamedTemporaryFile()
-            tf.write(ctmfp.read(end-start))
-            tf.seek(0)
-            ctm = CTMfile(tf.name, "r")
-            pts, polys, norms = ctm.getMesh()
-            meshes.append((pts, polys))
+    with open(ctmfile, 'rb') as ctmfp:
+        data = ctmfp.read()
+    offset.append(len(data))
+
+    for start, end in zip(offset[:-1], offset[1:]):
+        ctm = CTMfile(data=data[start:end])
+        pts, polys, norms = ctm.getMesh()
+        meshes.append((pts, polys))
 
     return meshes
@@ -8,33 +8,90 @@ This module creates a singleton object surfs_ which allows easy access to surfac
 """
 import os
 import re
-import copy
 import glob
 import json
 import shutil
 import warnings
 import tempfile
-import functools
 import numpy as np
 from hashlib import sha1
+from collections import namedtuple, OrderedDict
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
 
 from . import options
+from . import instrument
 
 default_filestore = options.config.get('basic', 'filestore')
 
 
-def _memo(fn):
-    @functools.wraps(fn)
-    def memofn(self, *args, **kwargs):
-        if not hasattr(self, "_memocache"):
-            setattr(self, "_memocache", dict())
-        #h = sha1(str((id(fn), args, kwargs))).hexdigest()
-        h = str((id(fn), args, kwargs))
-        if h not in self._memocache:
-            self._memocache[h] = fn(self, *args, **kwargs)
-        return copy.deepcopy(self._memocache[h])
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
 
-    return memofn
+def _readonly(obj):
+    """Marks every array in a (nested) tuple or list as read-only"""
+    if isinstance(obj, np.ndarray):
+        obj.flags.writeable = False
+    elif isinstance(obj, (tuple, list)):
+        for item in obj:
+            _readonly(item)
+    return obj
+
+class SurfCache(object):
+    """Least-recently-used cache of surfaces loaded by `Database.get_surf`.
+
+    Arrays in the cache are shared with every caller and are marked read-only,
+    so they are never copied on access. Copy them before modifying.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        Maximum number of surfaces to keep. Defaults to the `surface_cache`
+        option in the [basic] section of options.cfg.
+    """
+    def __init__(self, maxsize=None):
+        if maxsize is None:
+            try:
+                maxsize = options.config.getint("basic", "surface_cache")
+            except (configparser.Error, ValueError):
+                maxsize = 64
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __repr__(self):
+        return "<Surface cache: %d hits, %d misses, %d/%d surfaces>"%(
+            self.hits, self.misses, len(self), self.maxsize)
+
+    def get(self, key, func):
+        """Returns the cached value for `key`, or calls `func` to load it"""
+        try:
+            value = self._cache.pop(key)
+            self.hits += 1
+        except KeyError:
+            value = _readonly(func())
+            self.misses += 1
+
+        self._cache[key] = value
+        while len(self._cache) > self.maxsize:
+            self._cache.popitem(last=False)
+        return value
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self))
+
+    def clear(self, subject=None):
+        """Drops all cached surfaces, or only those of `subject`"""
+        if subject is None:
+            self._cache.clear()
+        else:
+            for key in [k for k in self._cache if k[0] == subject]:
+                del self._cache[key]
 
 class SubjectDB(object):
     def __init__(self, subj, filestore=default_filestore):
@@ -156,6 +213,8 @@ class Database(object):
         self.filestore = filestore
         self._subjects = None
         self.auxfile = None
+        self.surfcache = SurfCache()
+        self._paths = dict()
     
     def __repr__(self):
         subjs = ", ".join(sorted(self.subjects.keys()))
@@ -299,10 +358,12 @@ class Database(object):
             if not os.path.exists(os.path.join(self.filestore, subject, "surface-info")):
                 os.makedirs(os.path.join(self.filestore, subject, "surface-info"))
 
-        if not os.path.exists(surfifile) or recache:
-            print ("Generating %s surface info..."%type)
-            from . import surfinfo
-            getattr(surfinfo, type)(surfifile, subject, **kwargs)
+        with instrument.span("db.get_surfinfo", subject=subject, type=type) as span:
+            span.set(hit=os.path.exists(surfifile) and not recache)
+            if not os.path.exists(surfifile) or recache:
+                print ("Generating %s surface info..."%type)
+                from . import surfinfo
+                getattr(surfinfo, type)(surfifile, subject, **kwargs)
 
         npz = np.load(surfifile)
         if "left" in npz and "right" in npz:
@@ -312,6 +373,7 @@ class Database(object):
             return Vertex(verts, subject)
         return npz
 
+    @instrument.traced("db.get_overlay")
     def get_overlay(self, subject, otype='rois', **kwargs):
         from . import svgroi
         pts, polys = self.get_surf(subject, "flat", merge=True, nudge=True)
@@ -433,7 +495,6 @@ class Database(object):
         xfmdict = json.load(open(fname))
         return Transform(xfmdict[xfmtype], reference)
 
-    @_memo
     def get_surf(self, subject, type, hemisphere="both", merge=False, nudge=False):
         '''Return the surface pair for the given subject, surface type, and hemisphere.
 
@@ -458,33 +519,52 @@ class Database(object):
             If request is for both hemispheres, otherwise:
         pts, polys, norms : ((p,3) array, (f,3) array, (p,3) array or None)
             For single hemisphere
+
+        Surfaces are cached in `surfcache`; the returned arrays are shared and
+        read-only, so copy them before modifying.
         '''
         try:
             return self.auxfile.get_surf(subject, type, hemisphere, merge=merge, nudge=nudge)
         except (AttributeError, IOError):
             pass
 
-        files = self.get_paths(subject)['surfs']
+        hemisphere = hemisphere.lower()
+        if hemisphere in ("lh", "left"):
+            hemisphere = "lh"
+        elif hemisphere in ("rh", "right"):
+            hemisphere = "rh"
+        elif hemisphere != "both":
+            raise TypeError("Not a valid hemisphere name")
+
+        #merging and nudging only apply to both hemispheres
+        if hemisphere != "both":
+            merge = nudge = False
+        nudge = nudge and type != "fiducial"
+
+        key = subject, type, hemisphere, bool(merge), bool(nudge)
+        with instrument.span("db.get_surf", subject=subject, type=type, hemisphere=hemisphere) as span:
+            misses = self.surfcache.misses
+            surf = self.surfcache.get(key, lambda: self._load_surf(subject, type, hemisphere, merge, nudge))
+            span.set(hit=self.surfcache.misses == misses)
+        return surf
+
+    def _load_surf(self, subject, type, hemi, merge, nudge):
+        if hemi == "both":
+            left, right = [self.get_surf(subject, type, hemisphere=h) for h in ["lh", "rh"]]
+            if nudge:
+                lpts, rpts = left[0].copy(), right[0].copy()
+                lpts[:,0] -= lpts.max(0)[0]
+                rpts[:,0] -= rpts.min(0)[0]
+                left, right = (lpts,) + tuple(left[1:]), (rpts,) + tuple(right[1:])
 
-        if hemisphere.lower() == "both":
-            left, right = [ self.get_surf(subject, type, hemisphere=h) for h in ["lh", "rh"]]
-            if type != "fiducial" and nudge:
-                left[0][:,0] -= left[0].max(0)[0]
-                right[0][:,0] -= right[0].min(0)[0]
-            
             if merge:
                 pts   = np.vstack([left[0], right[0]])
                 polys = np.vstack([left[1], right[1]+len(left[0])])
                 return pts, polys
 
             return left, right
-        elif hemisphere.lower() in ("lh", "left"):
-            hemi = "lh"
-        elif hemisphere.lower() in ("rh", "right"):
-            hemi = "rh"
-        else:
-            raise TypeError("Not a valid hemisphere name")
-        
+
+        files = self.get_paths(subject)['surfs']
         if type == 'fiducial' and 'fiducial' not in files:
             wpts, polys = self.get_surf(subject, 'wm', hemi)
             ppts, _     = self.get_surf(subject, 'pia', hemi)
@@ -572,14 +652,44 @@ class Database(object):
             os.makedirs(cachedir)
         return cachedir
 
-    def get_paths(self, subject):
+    def get_paths(self, subject, refresh=False):
         """Get a dictionary with a list of all candidate filenames for associated data, such as roi overlays, flatmap caches, and ctm caches.
-        """
-        surfpath = os.path.join(self.filestore, subject, "surfaces")
 
+        The directory listings are indexed once per subject, and only rebuilt when
+        the modification time of the surfaces, transforms or views directory
+        changes, or when `refresh` is True.
+        """
         if self.subjects[subject]._warning is not None:
             warnings.warn(self.subjects[subject]._warning)
 
+        key = self.filestore, subject
+        stamp = self._path_stamp(subject)
+        if refresh or key not in self._paths or self._paths[key][0] != stamp:
+            filenames = self._index_paths(subject)
+            #the views directory may have just been created
+            self._paths[key] = self._path_stamp(subject), filenames
+
+        return dict(self._paths[key][1])
+
+    def refresh_paths(self, subject=None):
+        """Drops the indexed filestore paths of `subject`, or of every subject,
+        so they are listed again on the next call to `get_paths`."""
+        for key in list(self._paths.keys()):
+            if subject is None or key[1] == subject:
+                del self._paths[key]
+
+    def _path_stamp(self, subject):
+        stamp = []
+        for dirname in ("surfaces", "transforms", "views"):
+            try:
+                stamp.append(os.stat(os.path.join(self.filestore, subject, dirname)).st_mtime)
+            except OSError:
+                stamp.append(None)
+        return tuple(stamp)
+
+    def _index_paths(self, subject):
+        surfpath = os.path.join(self.filestore, subject, "surfaces")
+
         surfs = dict()
         for surf in os.listdir(surfpath):
             ssurf = os.path.splitext(surf)[0].split('_')
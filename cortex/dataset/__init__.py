@@ -16,7 +16,6 @@ objects into the h5py file, reconstituting each when requested.
 import tempfile
 import warnings
 import numpy as np
-import h5py
 
 from ..database import db
 from ..xfm import Transform
@@ -72,6 +71,7 @@ class Dataset(object):
 
     @classmethod
     def from_file(cls, filename):
+        import h5py
         ds = cls()
         ds.h5 = h5py.File(filename)
 
@@ -108,6 +108,7 @@ class Dataset(object):
         return uniques
 
     def save(self, filename=None, pack=False):
+        import h5py
         if filename is not None:
             self.h5 = h5py.File(filename)
         elif self.h5 is None:
@@ -210,6 +211,7 @@ def normalize(data):
     raise TypeError('Unknown input type')
 
 def _pack_subjs(h5, subjects):
+    import h5py
     for subject in subjects:
         rois = db.get_overlay(subject, type='rois')
         rnode = h5.require_dataset("/subjects/%s/rois"%subject, (1,),
@@ -1,6 +1,6 @@
+import sys
 import hashlib
 import numpy as np
-import h5py
 
 from ..database import db
 
@@ -20,7 +20,9 @@ class BrainData(object):
 
     @property
     def data(self):
-        if isinstance(self._data, h5py.Dataset):
+        #data can only be an hdf dataset if h5py was already imported to read it
+        h5py = sys.modules.get("h5py")
+        if h5py is not None and isinstance(self._data, h5py.Dataset):
             return self._data.value
         return self._data
 
@@ -60,10 +62,11 @@ class BrainData(object):
     def to_json(self, simple=False):
         sdict = super(BrainData, self).to_json(simple=simple)
         if simple:
+            vmin, vmax = _minmax(self.data)
             sdict.update(dict(name=self.name,
                 subject=self.subject,
-                min=float(np.nan_to_num(self.data).min()), 
-                max=float(np.nan_to_num(self.data).max()),
+                min=vmin,
+                max=vmax,
                 ))
         return sdict
 
@@ -163,12 +166,14 @@ class VolumeData(BrainData):
                 raise ValueError("Volumetric data (shape %s) is not the same shape as reference for transform (shape %s)" % (str(shape), str(xfm.shape)))
             self.shape = shape
 
-    def map(self, projection="nearest"):
-        """Convert this VolumeData into a VertexData using the given sampler
+    def map(self, projection="nearest", chunksize=None, out=None):
+        """Convert this VolumeData into a VertexData using the given sampler.
+        Movies can be streamed through the mapper `chunksize` volumes at a
+        time into a preallocated `out` array (see Mapper.__call__).
         """
         from .. import utils
         mapper = utils.get_mapper(self.subject, self.xfmname, projection)
-        data = mapper(self)
+        data = mapper(self, chunksize=chunksize, out=out)
         return data
 
     def __repr__(self):
@@ -204,6 +209,7 @@ class VolumeData(BrainData):
         """Save the dataset into an hdf file with the provided name
         """
         import os
+        import h5py
         if isinstance(filename, str):
             fname, ext = os.path.splitext(filename)
             if ext in (".hdf", ".h5",".hf5"):
@@ -314,6 +320,30 @@ class VertexData(BrainData):
     def copy(self, data):
         return super(VertexData, self).copy(data, self.subject)
 
+    def smooth(self, fwhm, surface="fiducial", chunksize=100, **kwargs):
+        """Smooths the data along the `surface` of each hemisphere with a Gaussian
+        kernel of `fwhm` mm, and returns it as a copy. Movies are smoothed
+        `chunksize` timepoints at a time. Extra keyword arguments are passed on to
+        polyutils.Surface.smoothing_kernel.
+        """
+        from .. import polyutils
+        kernels = []
+        for pts, polys in db.get_surf(self.subject, surface):
+            surf = polyutils.Surface(pts, polys)
+            kernels.append(surf.smoothing_kernel(fwhm, **kwargs))
+
+        verts = self.vertices
+        hemis = [slice(0, self.llen), slice(self.llen, None)]
+        smoothed = np.empty(verts.shape, dtype=np.result_type(verts.dtype, np.float32))
+        for start in range(0, len(verts), chunksize):
+            chunk = np.asarray(verts[start:start+chunksize])
+            for kernel, hemi in zip(kernels, hemis):
+                smoothed[start:start+chunksize, hemi] = kernel.dot(chunk[:, hemi].T).T
+
+        if not self.movie:
+            smoothed = smoothed[0]
+        return self.copy(smoothed)
+
     def volume(self, xfmname, projection='nearest', **kwargs):
         import warnings
         warnings.warn('Inverse mapping cannot be accurate')
@@ -397,9 +427,20 @@ class _masker(object):
         except:
             self.dv.copy(self.dv.volume[:, mask].squeeze())
 
+def _minmax(data):
+    """Minimum and maximum of np.nan_to_num(data), without copying the data"""
+    data = np.asarray(data)
+    if data.dtype.kind != 'f':
+        return float(data.min()), float(data.max())
+    with np.errstate(invalid='ignore'):
+        vmin, vmax = np.fmin.reduce(data, axis=None), np.fmax.reduce(data, axis=None)
+    if np.isnan(data).any():
+        vmin, vmax = np.fmin(vmin, 0), np.fmax(vmax, 0)
+    return float(np.nan_to_num(vmin)), float(np.nan_to_num(vmax))
+
 def _hash(array):
     '''A simple numpy hash function'''
-    return hashlib.sha1(array.tostring()).hexdigest()
+    return hashlib.sha1(array.tobytes()).hexdigest()
 
 def _hdf_write(h5, data, name="data", group="/data"):
     try:
@@ -1,6 +1,5 @@
 import json
 import warnings
-import h5py
 import numpy as np
 from .. import options
 from ..database import db
@@ -182,6 +181,7 @@ class Dataview(object):
             raise NotImplementedError
 
     def _write_hdf(self, h5, name="data", data=None, xfmname=None):
+        import h5py
         views = h5.require_group("/views")
         view = views.require_dataset(name, (8,), h5py.special_dtype(vlen=str))
         view[0] = json.dumps(data)
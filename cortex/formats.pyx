@@ -41,10 +41,17 @@ def read_npz(filename):
     return pts, polys
 
 def read_gii(filename):
+    import nibabel
     from nibabel import gifti
-    gii = gifti.read(filename)
-    pts = gii.getArraysFromIntent('pointset')[0].data
-    polys = gii.getArraysFromIntent('triangle')[0].data
+    if not os.path.exists(filename):
+        raise IOError('No such file: %s'%filename)
+    if hasattr(gifti, "read"):
+        gii = gifti.read(filename)
+    else:
+        gii = nibabel.load(filename)
+    getarrays = getattr(gii, "get_arrays_from_intent", None) or gii.getArraysFromIntent
+    pts = getarrays('pointset')[0].data
+    polys = getarrays('triangle')[0].data
     return pts, polys
 
 @cython.boundscheck(False)
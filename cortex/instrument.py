@@ -0,0 +1,179 @@
+"""Lightweight instrumentation of the hot paths.
+
+Spans time named stages, such as loading a mapper or rasterizing the overlays
+of a flatmap, and record whether they were served from a cache and the sizes
+of the arrays involved. Spans nest, so a slow `quickflat.make_figure` can be
+broken down into its flatmap cache, projection and overlay stages::
+
+    from cortex import instrument
+    instrument.enable()
+    cortex.quickshow(volume)
+    instrument.save_trace("quickshow.json")
+
+The trace opens in chrome://tracing or Perfetto; `save_json` writes the raw
+spans instead. Instrumentation is off by default, and can be switched on with
+`enable` or with `instrument = True` in the [basic] section of options.cfg.
+While it is off, `span` returns a shared span that records nothing.
+"""
+import os
+import json
+import time
+import threading
+import functools
+from collections import deque, OrderedDict
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
+import numpy as np
+
+from . import options
+
+try:
+    enabled = options.config.getboolean("basic", "instrument")
+except (configparser.Error, ValueError):
+    enabled = False
+
+#Only the most recent spans are kept, so that long-running processes stay bounded
+_spans = deque(maxlen=100000)
+_lock = threading.Lock()
+_local = threading.local()
+
+def enable(flag=True):
+    """Turns recording of spans on, or off with `flag=False`"""
+    global enabled
+    enabled = bool(flag)
+
+def disable():
+    enable(False)
+
+def clear():
+    """Drops all recorded spans"""
+    with _lock:
+        _spans.clear()
+
+def _stack():
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = []
+        return _local.stack
+
+def _describe(value):
+    """JSON-friendly description of a span argument. Arrays, including sparse
+    matrices, are recorded by their shape, dtype and size in bytes."""
+    if isinstance(value, (bool, int, float, str)) or value is None:
+        return value
+    if isinstance(value, np.generic):
+        return value.item()
+    if hasattr(value, "shape") and hasattr(value, "dtype"):
+        if hasattr(value, "nnz"):
+            nbytes = sum(getattr(value, a).nbytes for a in ("data", "indices", "indptr") if hasattr(value, a))
+        else:
+            nbytes = getattr(value, "nbytes", None)
+        return dict(shape=list(value.shape), dtype=str(value.dtype), nbytes=nbytes)
+    if isinstance(value, (tuple, list)):
+        return [_describe(v) for v in value]
+    return str(value)
+
+class Span(object):
+    """A timed stage. Use as a context manager, and annotate it with `set`."""
+    def __init__(self, name, args):
+        self.name = name
+        self.args = args
+        self.start = None
+        self.duration = None
+        self.depth = 0
+        self.thread = None
+
+    def set(self, **kwargs):
+        """Adds arguments to the span, such as hit=True for a cache hit"""
+        for key, value in kwargs.items():
+            self.args[key] = _describe(value)
+
+    def __enter__(self):
+        stack = _stack()
+        self.depth = len(stack)
+        self.thread = threading.current_thread().ident
+        stack.append(self)
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.duration = time.time() - self.start
+        _stack().pop()
+        if exc_type is not None:
+            self.args['error'] = exc_type.__name__
+        with _lock:
+            _spans.append(self)
+        return False
+
+    def __repr__(self):
+        if self.duration is None:
+            return "<Span %s>"%self.name
+        return "<Span %s: %0.3f s>"%(self.name, self.duration)
+
+    def to_dict(self):
+        return dict(name=self.name, start=self.start, duration=self.duration,
+            depth=self.depth, thread=self.thread, args=self.args)
+
+class _NullSpan(object):
+    def set(self, **kwargs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_null = _NullSpan()
+
+def span(name, **kwargs):
+    """Returns a span timing the stage `name`, with keyword arguments recorded
+    alongside it"""
+    if not enabled:
+        return _null
+    return Span(name, dict((k, _describe(v)) for k, v in kwargs.items()))
+
+def traced(name):
+    """Decorator that times every call of a function in a span"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def get_spans():
+    """Returns the recorded spans as dictionaries, in the order they finished"""
+    with _lock:
+        return [s.to_dict() for s in _spans]
+
+def summary():
+    """Returns the number of calls, total and mean durations and the number of
+    cache hits, per span name"""
+    stats = OrderedDict()
+    for s in get_spans():
+        stat = stats.setdefault(s['name'], dict(count=0, total=0., hits=0))
+        stat['count'] += 1
+        stat['total'] += s['duration']
+        stat['hits'] += int(s['args'].get('hit') is True)
+    for stat in stats.values():
+        stat['mean'] = stat['total'] / stat['count']
+    return stats
+
+def save_json(filename):
+    """Writes the recorded spans into a JSON file"""
+    with open(filename, "w") as fp:
+        json.dump(dict(pid=os.getpid(), spans=get_spans()), fp, indent=1)
+
+def save_trace(filename):
+    """Writes the recorded spans as complete events into a Chrome trace file"""
+    pid = os.getpid()
+    events = [dict(name=s['name'], cat="cortex", ph="X", pid=pid, tid=s['thread'],
+        ts=s['start'] * 1e6, dur=s['duration'] * 1e6, args=s['args']) for s in get_spans()]
+    with open(filename, "w") as fp:
+        json.dump(dict(traceEvents=events, displayTimeUnit="ms"), fp)
@@ -1,4 +1,8 @@
 import os
+import json
+import shutil
+import hashlib
+import tempfile
 import warnings
 
 import nibabel
@@ -7,6 +11,7 @@ from scipy import sparse
 warnings.simplefilter('ignore', sparse.SparseEfficiencyWarning)
 
 from .. import dataset
+from .. import instrument
 
 def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
     from ..database import db
@@ -21,53 +26,164 @@ def get_mapper(subject, xfmname, type='nearest', recache=False, **kwargs):
         const_patch_trilin=patch.ConstPatchTrilin,
         const_patch_lanczos=patch.ConstPatchLanczos,
         line_nearest=line.LineNN,
-        line_trilinear=line.LineTrilin)
+        line_trilinear=line.LineTrilin,
+        line_gaussian=line.LineGauss,
+        line_lanczos=line.LineLanczos)
     Map = mapcls[type]
     ptype = Map.__name__.lower()
     kwds ='_'.join(['%s%s'%(k,str(v)) for k, v in list(kwargs.items())])
     if len(kwds) > 0:
         ptype += '_'+kwds
 
-    fname = "{xfmname}_{projection}.npz".format(xfmname=xfmname, projection=ptype)
-
-    xfmfile = db.get_paths(subject)['xfmdir'].format(xfmname=xfmname)
+    fname = "{xfmname}_{projection}".format(xfmname=xfmname, projection=ptype)
     cachefile = os.path.join(db.get_cache(subject), fname)
 
+    with instrument.span("mapper.get_mapper", subject=subject, xfmname=xfmname, type=type) as span:
+        try:
+            header = None if recache else _cacheheader(cachefile)
+            if header is not None and not _isfresh(cachefile, header, Map, subject, xfmname, **kwargs):
+                header = None
+            if header is not None:
+                mapper = Map.from_cache(cachefile)
+                span.set(hit=True)
+                return mapper
+            raise Exception
+        except Exception as e:
+            span.set(hit=False)
+            return Map._cache(cachefile, subject, xfmname, **kwargs)
+
+#Bump whenever the layout of the cache or the construction of the masks changes
+CACHE_VERSION = 2
+
+def _cacheheader(filename):
+    """Returns the header of a mapper cache, or None if it is missing or stale"""
     try:
-        if not recache and (xfmname == "identity" or os.stat(cachefile).st_mtime > os.stat(xfmfile).st_mtime):
-           return mapcls[type].from_cache(cachefile)
-        raise Exception
-    except Exception as e:
-        return mapcls[type]._cache(cachefile, subject, xfmname, **kwargs)
-
-def _savecache(filename, left, right, shape):
-    np.savez(filename,
-            left_data=left.data,
-            left_indices=left.indices,
-            left_indptr=left.indptr,
-            left_shape=left.shape,
-            right_data=right.data,
-            right_indices=right.indices,
-            right_indptr=right.indptr,
-            right_shape=right.shape,
-            shape=shape)
+        with open(os.path.join(filename, "header.json")) as fp:
+            header = json.load(fp)
+    except (IOError, OSError, ValueError):
+        return None
+    if header.get('version') != CACHE_VERSION:
+        return None
+    return header
+
+def _sourcestamp(subject, xfmname):
+    """Returns the (path, mtime, size) of every surface and of the transform
+    a mapper can be built from, listed through the filestore path index. Returns
+    None for sources that cannot be stamped, such as an auxiliary dataset file,
+    which are then always hashed."""
+    from ..database import db
+    if getattr(db, 'auxfile', None) is not None:
+        return None
+    paths = db.get_paths(subject)
+    files = sorted(fname for hemis in paths['surfs'].values() for fname in hemis.values())
+    xfmfile = paths['xfmdir'].format(xfmname=xfmname)
+    files += [xfmfile, os.path.join(os.path.dirname(xfmfile), "reference.nii.gz")]
+    stamp = []
+    for fname in files:
+        try:
+            stat = os.stat(fname)
+        except OSError:
+            return None
+        stamp.append([fname, stat.st_mtime, stat.st_size])
+    return stamp
+
+def _isfresh(filename, header, Map, subject, xfmname, **kwargs):
+    """Checks whether a cache header matches the current sources. When none
+    of the source files changed since the cache was written, the stored key
+    is trusted without rehashing the surfaces; otherwise the sources are
+    hashed, and the new stamps are recorded if their content is unchanged."""
+    stamp = _sourcestamp(subject, xfmname)
+    if stamp is not None and header.get('stamp') == stamp:
+        return True
+    if Map._hash(subject, xfmname, **kwargs) != header.get('key'):
+        return False
+    if stamp is not None:
+        header['stamp'] = stamp
+        _saveheader(filename, header)
+    return True
+
+def _saveheader(filename, header):
+    from ..utils import _atomic_open
+    with _atomic_open(os.path.join(filename, "header.json"), "w") as fp:
+        json.dump(header, fp)
+
+def _savecache(filename, left, right, shape, key=None, stamp=None):
+    """Stores the masks as one raw .npy file per array, so that the cache can
+    be memory-mapped by `Mapper.from_cache`. The cache is written to a
+    temporary directory and renamed into place. `stamp` records the source
+    files as of before the masks were built (see `_sourcestamp`).
+
+    Another process may finish the same cache while this one writes it. An
+    existing cache is renamed aside rather than removed in place, and if a
+    cache with the same key appears before ours is renamed into place, it is
+    kept and ours is dropped, since its masks are the same."""
+    tmpdir = tempfile.mkdtemp(prefix=os.path.basename(filename)+'.', dir=os.path.dirname(filename))
+    try:
+        for name, mask in [('left', left), ('right', right)]:
+            for attr in ('data', 'indices', 'indptr'):
+                np.save(os.path.join(tmpdir, "%s_%s.npy"%(name, attr)), getattr(mask, attr))
+
+        header = dict(version=CACHE_VERSION, key=key, stamp=stamp,
+            shape=[int(s) for s in shape],
+            left_shape=[int(s) for s in left.shape],
+            right_shape=[int(s) for s in right.shape])
+        with open(os.path.join(tmpdir, "header.json"), "w") as fp:
+            json.dump(header, fp)
+
+        aside = tmpdir+'.old'
+        try:
+            os.rename(filename, aside)
+        except OSError:
+            #no previous cache, or another process moved it first
+            aside = None
+        try:
+            os.rename(tmpdir, filename)
+        except OSError:
+            header = _cacheheader(filename)
+            if header is None or header.get('key') != key:
+                raise
+            #someone else built it
+            shutil.rmtree(tmpdir, ignore_errors=True)
+        finally:
+            if aside is not None:
+                shutil.rmtree(aside, ignore_errors=True)
+    except:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+        raise
+
+def _hashsurfs(xfm, surfs, **kwargs):
+    """Hashes the transform, surfaces and sampler options that a mask is built from"""
+    sha = hashlib.sha1()
+    sha.update(repr((CACHE_VERSION, sorted(kwargs.items()), tuple(xfm.shape))).encode())
+    sha.update(np.ascontiguousarray(xfm.xfm, dtype=np.float64).tobytes())
+    for pts, polys in surfs:
+        sha.update(np.ascontiguousarray(pts, dtype=np.float64).tobytes())
+        sha.update(np.ascontiguousarray(polys, dtype=np.int64).tobytes())
+    return sha.hexdigest()
 
 class Mapper(object):
     '''Maps data from epi volume onto surface using various projections'''
     def __init__(self, left, right, shape):
         self.idxmap = None
         self.masks = [left, right]
+        self._derived = dict()
         self.nverts = left.shape[0] + right.shape[0]
         self.shape = shape
 
     @classmethod
-    def from_cache(cls, cachefile):
-        npz = np.load(cachefile)
-        left = (npz['left_data'], npz['left_indices'], npz['left_indptr'])
-        right = (npz['right_data'], npz['right_indices'], npz['right_indptr'])
-        lsparse = sparse.csr_matrix(left, shape=npz['left_shape'])
-        rsparse = sparse.csr_matrix(right, shape=npz['right_shape'])
-        return cls(lsparse, rsparse, npz['shape'])
+    def from_cache(cls, cachefile, mmap_mode='r'):
+        """Loads a cached mapper. The sparse matrices are memory-mapped by
+        default, so that processes loading the same mapper share its pages."""
+        with open(os.path.join(cachefile, "header.json")) as fp:
+            header = json.load(fp)
+
+        masks = []
+        for name in ['left', 'right']:
+            arrays = [np.load(os.path.join(cachefile, "%s_%s.npy"%(name, attr)), mmap_mode=mmap_mode)
+                for attr in ('data', 'indices', 'indptr')]
+            shape = tuple(header[name+'_shape'])
+            masks.append(sparse.csr_matrix(tuple(arrays), shape=shape, copy=False))
+        return cls(masks[0], masks[1], tuple(header['shape']))
 
     @property
     def mask(self):
@@ -83,7 +199,26 @@ class Mapper(object):
         ptype = self.__class__.__name__
         return '<%s mapper with %d vertices>'%(ptype, self.nverts)
 
-    def __call__(self, data):
+    def __call__(self, data, chunksize=None, out=None):
+        """Projects volume data onto the surface
+
+        Parameters
+        ----------
+        data : Volume or tuple
+            Volume (or movie) to project
+        chunksize : int, optional
+            Number of time points projected at once. Movies are streamed
+            through the mapper in chunks of this many volumes, so only one
+            chunk of voxel data is ever copied. Defaults to the whole movie.
+        out : array_like, optional
+            Preallocated (T, nverts) destination, such as a numpy memmap or an
+            HDF5 dataset. Float32 data is projected in float32, everything
+            else in float64.
+
+        Returns
+        -------
+        Vertex
+        """
         if isinstance(data, tuple):
             data = dataset.Volume(*data)
 
@@ -101,19 +236,48 @@ class Mapper(object):
                     right = right[..., self.idxmap[1]]
             return left, right
 
-        volume = np.ascontiguousarray(data.volume)
-        volume.shape = len(volume), -1
-        volume = volume.T
+        volume = data.data
+        if not data.movie:
+            volume = volume[np.newaxis]
+        ntime = len(volume)
+        volume = volume.reshape(ntime, -1)
+
+        dtype = np.float32 if volume.dtype == np.float32 else np.float64
+        masks = self._masks(dtype, data.mask if data.linear else None)
+        if out is None:
+            out = np.empty((ntime, self.nverts), dtype=dtype)
+        if chunksize is None:
+            chunksize = ntime
 
-        mapped = []
-        for mask in self.masks:
-            mapped.append(np.array(mask * volume).T)
+        llen = self.masks[0].shape[0]
+        with instrument.span("mapper.project", mapper=self.__class__.__name__, data=volume, out=out):
+            for start in range(0, ntime, chunksize):
+                chunk = np.asarray(volume[start:start+chunksize], dtype=dtype).T
+                left, right = [np.asarray(mask.dot(chunk)).T for mask in masks]
+                out[start:start+chunksize, :llen] = left
+                out[start:start+chunksize, llen:] = right
 
-        if self.idxmap is not None:
-            mapped[0] = mapped[0][:, self.idxmap[0]]
-            mapped[1] = mapped[1][:, self.idxmap[1]]
+        if not data.movie:
+            out = out[0]
+        return dataset.Vertex(out, data.subject)
 
-        return dataset.Vertex(np.hstack(mapped).squeeze(), data.subject)
+    def _masks(self, dtype, mask=None):
+        """Returns the masks in `dtype`, restricted to the columns inside `mask`
+        for masked data. The derived matrices are kept on the mapper, so that
+        repeated projections do not copy the (possibly memory-mapped) masks."""
+        key = np.dtype(dtype).str, None
+        if mask is not None:
+            key = key[0], hashlib.sha1(np.packbits(np.asarray(mask, dtype=bool).ravel()).tobytes()).hexdigest()
+        if key not in self._derived:
+            masks = self.masks
+            if mask is not None:
+                #masked data only needs the mapper columns inside the mask
+                cols = np.nonzero(mask.ravel())[0]
+                masks = [m[:, cols] for m in masks]
+            if len(self._derived) >= 8:
+                self._derived.clear()
+            self._derived[key] = [m.astype(dtype, copy=False) for m in masks]
+        return self._derived[key]
 
     def backwards(self, verts, fast=True):
         '''Projects vertex data back into volume space
@@ -155,19 +319,32 @@ class Mapper(object):
         return output
 
     @classmethod
-    def _cache(cls, filename, subject, xfmname, **kwargs):
-        print('Caching mapper...')
+    def _surfaces(cls, subject):
         from ..database import db
-        masks = []
-        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
         fid = db.get_surf(subject, 'fiducial', merge=False, nudge=False)
         try:
             flat = db.get_surf(subject, 'flat', merge=False, nudge=False)
         except IOError:
             flat = fid
+        return [(pts, polys) for (pts, _), (_, polys) in zip(fid, flat)]
 
-        for (pts, _), (_, polys) in zip(fid, flat):
+    @classmethod
+    def _hash(cls, subject, xfmname, **kwargs):
+        from ..database import db
+        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
+        return _hashsurfs(xfm, cls._surfaces(subject), mapper=cls.__name__, **kwargs)
+
+    @classmethod
+    def _cache(cls, filename, subject, xfmname, **kwargs):
+        print('Caching mapper...')
+        from ..database import db
+        masks = []
+        stamp = _sourcestamp(subject, xfmname)
+        xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
+        surfs = cls._surfaces(subject)
+        for pts, polys in surfs:
             masks.append(cls._getmask(xfm(pts), polys, xfm.shape, **kwargs))
 
-        _savecache(filename, masks[0], masks[1], xfm.shape)
+        key = _hashsurfs(xfm, surfs, mapper=cls.__name__, **kwargs)
+        _savecache(filename, masks[0], masks[1], xfm.shape, key=key, stamp=stamp)
         return cls(masks[0], masks[1], xfm.shape)
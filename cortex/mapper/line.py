@@ -1,34 +1,44 @@
 import numpy as np
 from scipy import sparse
 
-from . import Mapper, _savecache
+from . import Mapper, _savecache, _hashsurfs, _sourcestamp
 from . import samplers
 
 class LineMapper(Mapper):
+    @classmethod
+    def _surfaces(cls, subject):
+        from .. import db
+        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
+        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
+        return list(pia) + list(wm)
+
     @classmethod
     def _cache(cls, filename, subject, xfmname, **kwargs):
         from .. import db
         masks = []
+        stamp = _sourcestamp(subject, xfmname)
         xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
-        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
-        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
-        
+        surfs = cls._surfaces(subject)
+        pia, wm = surfs[:2], surfs[2:]
+
         #iterate over hemispheres
         for (wpts, polys), (ppts, _) in zip(pia, wm):
             masks.append(cls._getmask(xfm(ppts), xfm(wpts), polys, xfm.shape, **kwargs))
-            
-        _savecache(filename, masks[0], masks[1], xfm.shape)
+
+        key = _hashsurfs(xfm, surfs, mapper=cls.__name__, **kwargs)
+        _savecache(filename, masks[0], masks[1], xfm.shape, key=key, stamp=stamp)
         return cls(masks[0], masks[1], xfm.shape)
 
     @classmethod
-    def _getmask(cls, pia, wm, polys, shape, npts=64, mp=True, **kwargs):
+    def _getmask(cls, pia, wm, polys, shape, npts=64, mp=True, layerchunk=None, **kwargs):
         valid = np.unique(polys)
         #vidx = np.nonzero(valid)[0]
-        mapper = sparse.csr_matrix((len(pia), np.prod(shape)))
-        for t in np.linspace(0, 1, npts+2)[1:-1]:
-            i, j, data = cls.sampler(pia*t + wm*(1-t), shape)
-            mapper = mapper + sparse.csr_matrix((data / npts, (i, j)), shape=mapper.shape)
-        return mapper
+        def layers():
+            for t in np.linspace(0, 1, npts+2)[1:-1]:
+                i, j, data = cls.sampler(pia*t + wm*(1-t), shape, **kwargs)
+                yield i, j, data / npts
+        csrshape = len(pia), np.prod(shape)
+        return samplers.accumulate(layers(), csrshape, chunk=layerchunk)
 
 class LineNN(LineMapper):
     sampler = staticmethod(samplers.nearest)
@@ -1,10 +1,37 @@
 import numpy as np
+from scipy import sparse
 
 def collapse(j, data):
     """Collapses samples into a single row"""
     uniques = np.unique(j)
     return uniques, np.array([data[j == u].sum() for u in uniques])
 
+def accumulate(triplets, shape, chunk=None):
+    """Sums a sequence of (i, j, data) triplets into a single CSR matrix
+
+    All triplets are gathered into flat COO buffers and converted to CSR once,
+    summing duplicate entries. If `chunk` is given, only that many triplets are
+    buffered at a time before being collapsed into the running matrix, which
+    bounds memory when there are many sampling layers.
+    """
+    mapper = sparse.csr_matrix(shape)
+    buf = []
+    def flush():
+        i, j, data = [np.concatenate(b) for b in zip(*buf)]
+        del buf[:]
+        return sparse.coo_matrix((data, (i, j)), shape=shape).tocsr()
+
+    for ijdata in triplets:
+        buf.append(ijdata)
+        if chunk is not None and len(buf) >= chunk:
+            mapper = mapper + flush()
+
+    if len(buf) > 0:
+        if mapper.nnz == 0:
+            return flush()
+        mapper = mapper + flush()
+    return mapper
+
 def nearest(coords, shape, **kwargs):
     valid = ~(np.isnan(coords).all(1))
     valid = np.logical_and(valid, np.logical_and(coords[:,0] > -.5, coords[:,0] < shape[2]+.5))
@@ -49,50 +76,67 @@ def trilinear(coords, shape, **kwargs):
     data = np.vstack([v000, v100, v010, v001, v101, v011, v110, v111]).ravel()
     return i, np.ravel_multi_index(j, shape, mode='clip'), data
 
-def distance_func(func, coords, shape, renorm=True, mp=True):
-    """Generates masks for seperable distance functions"""
+def distance_func(func, coords, shape, renorm=True, mp=True, window=3, chunksize=4096, **kwargs):
+    """Generates masks for seperable distance functions
+
+    The kernel `func` is evaluated on the voxels within `window` of each
+    coordinate along every axis. Coordinates are processed in blocks of
+    `chunksize`, so at most chunksize * (2*window)**3 weights are held in
+    memory at once per process. If `mp` is True, blocks are distributed over
+    a process pool. Returns the (i, j, data) triplets of the mask.
+    """
     nZ, nY, nX = shape
-    dx = coords[:,0] - np.atleast_2d(np.arange(nX)).T
-    dy = coords[:,1] - np.atleast_2d(np.arange(nY)).T
-    dz = coords[:,2] - np.atleast_2d(np.arange(nZ)).T
-
-    Lx, Ly, Lz = func(dx), func(dy), func(dz)
-    ix, jx = np.nonzero(Lx)
-    iy, jy = np.nonzero(Ly)
-    iz, jz = np.nonzero(Lz)
-    ba = np.broadcast_arrays
-    def func(v):
-        mx, my, mz = ix[jx == v], iy[jy == v], iz[jz == v]
-        idx, idy, idz = [i.ravel() for i in ba(*np.ix_(mx, my, mz))]
-        vx, vy, vz = [i.ravel() for i in ba(*np.ix_(Lx[mx, v], Ly[my, v], Lz[mz, v]))]
-
-        i = v * np.ones((len(idx,)))
-        j = np.ravel_multi_index((idz, idy, idx), shape, mode='clip')
-        data = vx*vy*vz
+    width = int(np.ceil(window))
+    offsets = np.arange(1 - width, width + 1)
+
+    valid = np.nonzero(~np.isnan(coords).any(1))[0]
+    def kernel(start):
+        idx = valid[start:start+chunksize]
+        chunk = coords[idx]
+        #voxel positions of the window, (n, nwin) per axis
+        pos = np.floor(chunk)[:,:,np.newaxis].astype(int) + offsets
+        weights = func(chunk[:,:,np.newaxis] - pos)
+        for axis, size in enumerate((nX, nY, nZ)):
+            weights[:,axis][(pos[:,axis] < 0) | (pos[:,axis] >= size)] = 0
+            np.clip(pos[:,axis], 0, size - 1, out=pos[:,axis])
+
+        #separable kernel: outer product over the three axes, ordered (z, y, x)
+        wx, wy, wz = weights[:,0], weights[:,1], weights[:,2]
+        data = (wz[:,:,None,None] * wy[:,None,:,None] * wx[:,None,None,:]).reshape(len(idx), -1)
+        px, py, pz = pos[:,0], pos[:,1], pos[:,2]
+        j = ((pz[:,:,None,None] * nY + py[:,None,:,None]) * nX + px[:,None,None,:]).reshape(len(idx), -1)
+
         if renorm:
-            data /= data.sum()
-        return i, j, data
+            norm = data.sum(1)
+            norm[norm == 0] = 1
+            data /= norm[:,np.newaxis]
+
+        nz = data != 0
+        return np.repeat(idx, nz.sum(1)), j[nz], data[nz]
 
-    if mp:
+    starts = range(0, len(valid), chunksize)
+    if mp and len(starts) > 1:
         from .. import mp
-        ijdata = mp.map(func, range(len(coords)))
+        ijdata = mp.map(kernel, starts, chunksize=1)
     else:
-        ijdata = map(func, range(len(coords)))
+        ijdata = [kernel(start) for start in starts]
 
-    return np.hstack(ijdata)
+    if len(ijdata) == 0:
+        return np.array([], dtype=int), np.array([], dtype=int), np.array([])
+    return tuple(np.hstack(arrs) for arrs in zip(*ijdata))
 
 def gaussian(coords, shape, sigma=1, window=3, **kwargs):
-    raise NotImplementedError
     def gaussian(x):
-        pass
-    return distance_func(gaussian, coords, shape, **kwargs)
+        out = np.exp(-.5 * (x / sigma)**2)
+        out[np.abs(x) >= window] = 0
+        return out
+
+    return distance_func(gaussian, coords, shape, window=window, **kwargs)
 
 def lanczos(coords, shape, window=3, **kwargs):
     def lanczos(x):
-        out = np.zeros_like(x)
-        sel = np.abs(x)<window
-        selx = x[sel]
-        out[sel] = np.sin(np.pi * selx) * np.sin(np.pi * selx / window) * (window / (np.pi**2 * selx**2))
+        out = np.sinc(x) * np.sinc(x / window)
+        out[np.abs(x) >= window] = 0
         return out
 
-    return distance_func(lanczos, coords, shape, **kwargs)
+    return distance_func(lanczos, coords, shape, window=window, **kwargs)
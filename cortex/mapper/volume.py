@@ -1,23 +1,32 @@
 import numpy as np
 from scipy import sparse
 
-from . import Mapper
+from . import Mapper, _savecache, _hashsurfs, _sourcestamp
 from . import samplers
 
 class VolumeMapper(Mapper):
+    @classmethod
+    def _surfaces(cls, subject):
+        from .. import db
+        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
+        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
+        return list(pia) + list(wm)
+
     @classmethod
     def _cache(cls, filename, subject, xfmname, **kwargs):
         from .. import db
         masks = []
+        stamp = _sourcestamp(subject, xfmname)
         xfm = db.get_xfm(subject, xfmname, xfmtype='coord')
-        pia = db.get_surf(subject, "pia", merge=False, nudge=False)
-        wm = db.get_surf(subject, "wm", merge=False, nudge=False)
-        
+        surfs = cls._surfaces(subject)
+        pia, wm = surfs[:2], surfs[2:]
+
         #iterate over hemispheres
         for (wpts, polys), (ppts, _) in zip(pia, wm):
             masks.append(cls._getmask(xfm(ppts), xfm(wpts), polys, xfm.shape, **kwargs))
-            
-        _savecache(filename, masks[0], masks[1], xfm.shape)
+
+        key = _hashsurfs(xfm, surfs, mapper=cls.__name__, **kwargs)
+        _savecache(filename, masks[0], masks[1], xfm.shape, key=key, stamp=stamp)
         return cls(masks[0], masks[1], xfm.shape)
 
     @classmethod
@@ -9,14 +9,29 @@ from . import db
 
 import shlex
 
-fslprefix = options.config.get("basic", "fsl_prefix")
-fsldir = os.getenv("FSLDIR")
-if fsldir is None:
-    import warnings
-    warnings.warn("Can't find FSLDIR environment variable, assuming default FSL location..")
-    fsldir = "/usr/share/fsl/5.0"
-
-default_template = os.path.join(fsldir, "data", "standard", "MNI152_T1_1mm_brain.nii.gz")
+def _fslprefix():
+    return options.config.get("basic", "fsl_prefix")
+
+def _fsldir():
+    fsldir = os.getenv("FSLDIR")
+    if fsldir is None:
+        import warnings
+        warnings.warn("Can't find FSLDIR environment variable, assuming default FSL location..")
+        fsldir = "/usr/share/fsl/5.0"
+    return fsldir
+
+def _default_template():
+    return os.path.join(_fsldir(), "data", "standard", "MNI152_T1_1mm_brain.nii.gz")
+
+def __getattr__(name):
+    #FSL settings are looked up when first used, not when the module is imported
+    if name == "fslprefix":
+        return _fslprefix()
+    if name == "fsldir":
+        return _fsldir()
+    if name == "default_template":
+        return _default_template()
+    raise AttributeError("module %r has no attribute %r" % (__name__, name))
 
 def _save_fsl_xfm(filename, xfm):
     np.savetxt(filename, xfm, "%0.10f")
@@ -25,7 +40,7 @@ def _load_fsl_xfm(filename):
     return np.loadtxt(filename)
 
 def compute_mni_transform(subject, xfm,
-                          template=default_template):
+                          template=None):
     """Compute transform from the space specified by `xfm` to MNI standard space.
 
     Parameters
@@ -42,6 +57,9 @@ def compute_mni_transform(subject, xfm,
     func_to_mni : numpy.ndarray
         Transformation matrix from the space specified by `xfm` to MNI space.
     """
+    if template is None:
+        template = _default_template()
+
     # Set up some paths
     anat_to_mni_xfm = tempfile.mktemp()
 
@@ -49,7 +67,7 @@ def compute_mni_transform(subject, xfm,
     anat_filename = db.get_anat(subject, "brainmask").get_filename()
     
     # First use flirt to align masked subject anatomical to MNI template
-    cmd = shlex.split(" ".join(["{fslprefix}flirt".format(fslprefix=fslprefix),
+    cmd = shlex.split(" ".join(["{fslprefix}flirt".format(fslprefix=_fslprefix()),
                      "-searchrx -180 180",
                      "-searchry -180 180",
                      "-searchrz -180 180",
@@ -68,7 +86,7 @@ def compute_mni_transform(subject, xfm,
     return func_to_mni
 
 def transform_to_mni(volumedata, func_to_mni, 
-                     template=default_template,
+                     template=None,
                      use_flirt=True):
     """Transform data in `volumedata` to MNI space, resample at 1mm resolution.
 
@@ -88,6 +106,9 @@ def transform_to_mni(volumedata, func_to_mni,
     mni_volumedata : nibabel.nifti1.Nifti1Image
         `volumedata` after transformation to MNI space.
     """
+    if template is None:
+        template = _default_template()
+
     if use_flirt:
         # Set up paths
         func_nii = tempfile.mktemp(".nii.gz")
@@ -99,7 +120,7 @@ def transform_to_mni(volumedata, func_to_mni,
         _save_fsl_xfm(func_to_mni_xfm, func_to_mni)
         
         # Use flirt to resample functional data
-        subprocess.call(["{fslprefix}flirt".format(fslprefix=fslprefix),
+        subprocess.call(["{fslprefix}flirt".format(fslprefix=_fslprefix()),
                          "-in", func_nii,
                          "-ref", template,
                          "-applyxfm", "-init", func_to_mni_xfm,
@@ -141,7 +162,7 @@ def transform_surface_to_mni(subject, surfname):
         MNI-transformed surface in same format returned by db.get_surf.
     """
     # Get MNI affine transform
-    mni_affine = nibabel.load(default_template).get_affine()
+    mni_affine = nibabel.load(_default_template()).get_affine()
 
     # Get subject anatomical-to-MNI transform
     mni_xfm = np.dot(mni_affine, db.get_mnixfm(subject, "identity"))
@@ -157,12 +178,12 @@ def transform_surface_to_mni(subject, surfname):
 
     # Transform anatomical space points to MNI space
     mni_lpts, mni_rpts = [np.dot(mni_xfm, np.hstack([p, np.ones((p.shape[0],1))]).T).T[:,:3]
-                          for p in anat_lpts, anat_rpts]
+                          for p in (anat_lpts, anat_rpts)]
 
     return [(mni_lpts, lpolys), (mni_rpts, rpolys)]
 
 def transform_mni_to_subject(subject, xfm, volarray, func_to_mni,
-                             template=default_template):
+                             template=None):
     """Transform data in `volarray` from MNI space to functional space specified by `xfm`.
 
     Parameters
@@ -186,6 +207,9 @@ def transform_mni_to_subject(subject, xfm, volarray, func_to_mni,
         `volarray` after transformation from MNI space to space specified by `xfm`.
 
     """
+    if template is None:
+        template = _default_template()
+
     # Set up paths
     mnispace_func_nii = tempfile.mktemp(".nii.gz")
     mni_to_func_xfm = tempfile.mktemp(".mat")
@@ -199,7 +223,7 @@ def transform_mni_to_subject(subject, xfm, volarray, func_to_mni,
     # Use flirt to resample data to functional space
     ref_filename = db.get_xfm(subject, xfm).reference.get_filename()
     
-    subprocess.call(["{fslprefix}flirt".format(fslprefix=fslprefix),
+    subprocess.call(["{fslprefix}flirt".format(fslprefix=_fslprefix()),
                      "-in", mnispace_func_nii,
                      "-ref", ref_filename,
                      "-applyxfm", "-init", mni_to_func_xfm,
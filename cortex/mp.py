@@ -1,59 +1,197 @@
+"""Simple process pool for mapping closures over large iterables.
+
+Workers are forked, so `func` may be a closure over large arrays without ever
+being pickled. Items are sent to the workers in chunks, and results are
+returned in the order of the input. Where forking is not possible (or we are
+already inside a worker), everything runs serially in the calling process.
+"""
+import os
 import sys
-import marshal
+import traceback
+import threading
 import multiprocessing as mp
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
 try:
     import progressbar as pb
 except ImportError:
     pass
 
-def map(func, iterable, procs = mp.cpu_count()):
-    input, output = mp.Queue(), mp.Queue()
-    length = mp.Value('i',0)
-    
-    def _fill(iterable, procs, input, output):
-        for data in enumerate(iterable):
-            input.put(data)
-            length.value += 1
-        for _ in range(procs*2):
-            input.put((-1,-1))
-        
-    def _func(proc, input, output):
-        idx, data = input.get()
-        while idx != -1:
-            output.put((idx, func(data)))
-            idx, data = input.get()
-    
-    filler = mp.Process(target = _fill, args=(iterable, procs, input, output))
-    filler.daemon = True
-    filler.start()
-    for i in range(procs):
-        proc = mp.Process(target=_func, args=(i, input, output))
-        proc.daemon = True
-        proc.start()
-    
+def _context():
+    """Returns a multiprocessing context that forks, or None if we cannot fork"""
+    if not hasattr(os, "fork"):
+        return None
     try:
-        iterlen = len(iterable)
-    except:
-        filler.join()
-        iterlen = length.value
+        return mp.get_context("fork")
+    except AttributeError:
+        #python 2 always forks
+        return mp
+    except ValueError:
+        return None
 
-    data = [[]]*iterlen
+def cpu_count():
+    """Number of worker processes, from the `procs` option in the [mp] section of
+    options.cfg. A value of 0 (the default) uses every core."""
+    from .options import config
     try:
-        progress = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar()], maxval=iterlen)
-        progress.start()
-        for i in xrange(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-            progress.update(i+1)
-        progress.finish()
-    except NameError:
-        for _ in xrange(iterlen):
-            idx, result = output.get()
-            data[idx] = result
-        
-    return data
+        procs = config.getint("mp", "procs")
+    except (configparser.Error, ValueError):
+        procs = 0
+    if procs <= 0:
+        procs = mp.cpu_count()
+    return procs
+
+def _chunks(iterable, chunksize):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == chunksize:
+            yield chunk
+            chunk = []
+    if len(chunk) > 0:
+        yield chunk
+
+def _worker(func, tasks, results):
+    for idx, chunk in iter(tasks.get, None):
+        try:
+            results.put((idx, [func(item) for item in chunk], None))
+        except Exception:
+            results.put((idx, None, traceback.format_exc()))
+
+class Pool(object):
+    """A pool of forked workers that apply `func` to items.
+
+    The pool can be reused for any number of `map` calls and should be closed
+    when done, preferably by using it as a context manager::
+
+        with mp.Pool(func) as pool:
+            left = pool.map(leftitems)
+            right = pool.map(rightitems)
+
+    Parameters
+    ----------
+    func : callable
+        Function applied to every item. Since the workers are forked, this can
+        be a closure.
+    procs : int, optional
+        Number of workers. Defaults to `cpu_count()`. With one worker, or where
+        processes cannot be forked, items are mapped serially.
+    """
+    def __init__(self, func, procs=None):
+        self.func = func
+        self.procs = cpu_count() if procs is None else procs
+        self._workers = []
+
+        ctx = _context()
+        #daemonic workers are not allowed to fork their own pools
+        if self.procs > 1 and ctx is not None and not mp.current_process().daemon:
+            self._tasks, self._results = ctx.Queue(), ctx.Queue()
+            for _ in range(self.procs):
+                proc = ctx.Process(target=_worker, args=(func, self._tasks, self._results))
+                proc.daemon = True
+                proc.start()
+                self._workers.append(proc)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __repr__(self):
+        nproc = len(self._workers) if len(self._workers) > 0 else "serial"
+        return "<Pool of %s workers>"%nproc
+
+    def map(self, iterable, chunksize=None):
+        """Applies `func` to every item of `iterable`, returning a list of results
+        in the same order. Items are sent to the workers `chunksize` at a time;
+        by default about four chunks per worker are used."""
+        if len(self._workers) == 0:
+            return [self.func(item) for item in iterable]
+
+        try:
+            length = len(iterable)
+        except TypeError:
+            length = None
+
+        if chunksize is None:
+            chunksize = 64 if length is None else max(1, length // (4 * self.procs))
+
+        #feed the queue from a thread, so generators are consumed lazily
+        nchunks, failed = [], []
+        def feed():
+            idx = -1
+            try:
+                for idx, chunk in enumerate(_chunks(iterable, chunksize)):
+                    self._tasks.put((idx, chunk))
+            except Exception as e:
+                failed.append(e)
+            nchunks.append(idx + 1)
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+
+        progress = None
+        if length is not None and 'pb' in globals():
+            progress = pb.ProgressBar(widgets=[pb.Percentage(), pb.Bar()], maxval=length)
+            progress.start()
+
+        results, ndone = dict(), 0
+        while len(nchunks) == 0 or len(results) < nchunks[0]:
+            if len(failed) > 0:
+                #the input raised, re-raise it here instead of waiting forever
+                self.close()
+                raise failed[0]
+            try:
+                idx, result, error = self._results.get(timeout=1)
+            except queue.Empty:
+                if not all(proc.is_alive() for proc in self._workers):
+                    self.close()
+                    raise RuntimeError("A worker process died unexpectedly")
+                continue
+
+            if error is not None:
+                self.close()
+                raise RuntimeError("Exception in worker process:\n%s"%error)
+
+            results[idx] = result
+            ndone += len(result)
+            if progress is not None:
+                progress.update(ndone)
+
+        feeder.join()
+        if len(failed) > 0:
+            self.close()
+            raise failed[0]
+        if progress is not None:
+            progress.finish()
+
+        return [item for idx in range(len(results)) for item in results[idx]]
+
+    def close(self):
+        """Stops and joins all the workers"""
+        if len(self._workers) == 0:
+            return
+        for _ in self._workers:
+            self._tasks.put(None)
+        for proc in self._workers:
+            proc.join(timeout=1)
+            if proc.is_alive():
+                proc.terminate()
+                proc.join()
+        self._workers = []
+
+def map(func, iterable, procs=None, chunksize=None):
+    """Maps `func` over `iterable` in a temporary pool of `procs` workers,
+    returning the results in order. See `Pool`."""
+    with Pool(func, procs=procs) as pool:
+        return pool.map(iterable, chunksize=chunksize)
 
 if __name__ == "__main__":
-    #pool = Pool()
-    #data = pool.map(
-    map(lambda x: max(x), zip(*(iter(xrange(65536)),)*3))
+    print(map(lambda x: max(x), zip(*(iter(range(65536)),)*3))[-1])
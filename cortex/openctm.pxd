@@ -55,6 +55,9 @@ cdef extern from "openctm.h":
 		CTM_ATTRIB_MAP_8      = 0x0807
 
 	ctypedef void* CTMcontext
+	ctypedef unsigned int CTMuint
+	ctypedef CTMuint (*CTMreadfn)(void*, CTMuint, void*)
+	ctypedef CTMuint (*CTMwritefn)(const void*, CTMuint, void*)
 
 	CTMcontext ctmNewContext(CTMenum)
 	void ctmFreeContext(CTMcontext)
@@ -83,4 +86,6 @@ cdef extern from "openctm.h":
 	CTMenum ctmAddUVMap(CTMcontext, float*, char*, char*)
 	CTMenum ctmAddAttribMap(CTMcontext, float*, char*)
 	void ctmLoad(CTMcontext, char*)
-	void ctmSave(CTMcontext, char*)
\ No newline at end of file
+	void ctmSave(CTMcontext, char*)
+	void ctmLoadCustom(CTMcontext, CTMreadfn, void*)
+	void ctmSaveCustom(CTMcontext, CTMwritefn, void*)
\ No newline at end of file
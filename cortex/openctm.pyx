@@ -3,8 +3,33 @@ import numpy as np
 cimport cython
 cimport openctm
 cimport numpy as np
+from libc.string cimport memcpy
+
+cdef struct membuf:
+	const char* data
+	size_t size
+	size_t pos
+
+cdef openctm.CTMuint _read(void* buf, openctm.CTMuint count, void* userdata) noexcept nogil:
+	cdef membuf* mem = <membuf*>userdata
+	cdef size_t n = mem.size - mem.pos
+	if count < n:
+		n = count
+	memcpy(buf, mem.data + mem.pos, n)
+	mem.pos += n
+	return <openctm.CTMuint>n
+
+cdef openctm.CTMuint _write(const void* buf, openctm.CTMuint count, void* userdata) noexcept:
+	try:
+		(<bytearray>userdata).extend((<const char*>buf)[:count])
+	except Exception:
+		return 0
+	return count
 
 cdef class CTMfile:
+	"""OpenCTM mesh, read from or written to `filename`. Without a filename,
+	the mesh is read from the bytes in `data`, and `save` returns the encoded
+	file as bytes instead of writing it."""
 	cdef CTMcontext ctx
 
 	cdef public bytes filename
@@ -17,8 +42,11 @@ cdef class CTMfile:
 	cdef dict attribs
 	cdef dict uvs
 
-	def __cinit__(self, bytes filename, str mode='r'):
+	def __cinit__(self, filename=None, str mode='r', bytes data=None):
 		cdef openctm.CTMenum err
+		cdef membuf mem
+		if filename is not None and not isinstance(filename, bytes):
+			filename = filename.encode('utf-8')
 		self.filename = filename
 		self.mode = mode
 		self.attribs = {}
@@ -26,7 +54,15 @@ cdef class CTMfile:
 
 		if mode == 'r':
 			self.ctx = openctm.ctmNewContext(openctm.CTM_IMPORT)
-			openctm.ctmLoad(self.ctx, self.filename)
+			if data is not None:
+				mem.data = data
+				mem.size = len(data)
+				mem.pos = 0
+				openctm.ctmLoadCustom(self.ctx, _read, &mem)
+			elif self.filename is not None:
+				openctm.ctmLoad(self.ctx, self.filename)
+			else:
+				raise IOError('Either a filename or data is required')
 			err = ctmGetError(self.ctx)
 			if err != openctm.CTM_NONE:
 				raise IOError(openctm.ctmErrorString(err))
@@ -158,21 +194,31 @@ cdef class CTMfile:
 
 		for name, attrib in self.attribs.items():
 			pts = attrib
-			err = openctm.ctmAddAttribMap(self.ctx, <float*> pts.data, <char*>name)
+			bname = name.encode('utf-8')
+			err = openctm.ctmAddAttribMap(self.ctx, <float*> pts.data, <char*>bname)
 			if err == openctm.CTM_NONE:
 				err = openctm.ctmGetError(self.ctx)
 				raise Exception(openctm.ctmErrorString(err))
 
 		for name, (fname, uv) in self.uvs.items():
 			if fname is not None:
-				cname = fname
+				bfname = fname.encode('utf-8')
+				cname = bfname
 			pts = uv
-			err = openctm.ctmAddUVMap(self.ctx, <float*>pts.data, <char*>name, cname)
+			bname = name.encode('utf-8')
+			err = openctm.ctmAddUVMap(self.ctx, <float*>pts.data, <char*>bname, cname)
 			if err == openctm.CTM_NONE:
 				err = openctm.ctmGetError(self.ctx)
 				raise Exception(openctm.ctmErrorString(err))
 
-		openctm.ctmSave(self.ctx, self.filename)
+		if self.filename is None:
+			buf = bytearray()
+			openctm.ctmSaveCustom(self.ctx, _write, <void*>buf)
+		else:
+			openctm.ctmSave(self.ctx, self.filename)
 		err = openctm.ctmGetError(self.ctx)
 		if err != openctm.CTM_NONE:
 			raise Exception(openctm.ctmErrorString(err))
+
+		if self.filename is None:
+			return bytes(buf)
@@ -3,9 +3,12 @@ import numpy as np
 from scipy.spatial import distance, Delaunay
 from scipy import sparse
 import scipy.sparse.linalg
+import scipy.sparse.csgraph
 import functools
 import numexpr as ne
 
+from . import instrument
+
 def _memo(fn):
     """Helper decorator memoizes the given zero-argument function.
     Really helpful for memoizing properties so they don't have to be recomputed
@@ -19,6 +22,57 @@ def _memo(fn):
 
     return memofn
 
+def _cholmod():
+    """Returns the CHOLMOD module from scikit-sparse, or None if it is not installed
+    """
+    try:
+        from sksparse import cholmod
+    except ImportError:
+        try:
+            from scikits.sparse import cholmod
+        except ImportError:
+            return None
+    return cholmod
+
+def factorize(A, backend="auto"):
+    """Factorizes the sparse matrix `A` once, so that Ax = b can be solved cheaply
+    for many right-hand sides.
+
+    Parameters
+    ----------
+    A : sparse matrix, shape (N, N)
+        Matrix to factorize.
+    backend : str, optional
+        'cholmod' uses the sparse Cholesky decomposition from scikit-sparse, which
+        requires `A` to be symmetric positive definite. 'superlu' uses the sparse LU
+        decomposition from scipy, which works for any nonsingular matrix. 'auto'
+        (default) uses cholmod if it is installed, and falls back to superlu if it
+        is not or if `A` turns out not to be positive definite.
+
+    Returns
+    -------
+    solve : function
+        Solves Ax = b for b of shape (N,) or (N, K).
+    backend : str
+        The backend that was used.
+    """
+    A = sparse.csc_matrix(A)
+    if backend in ("auto", "cholmod"):
+        cholmod = _cholmod()
+        if cholmod is None:
+            if backend == "cholmod":
+                raise ImportError("The cholmod backend requires scikit-sparse")
+        else:
+            try:
+                return cholmod.cholesky(A), "cholmod"
+            except cholmod.CholmodNotPositiveDefiniteError:
+                if backend == "cholmod":
+                    raise
+    elif backend != "superlu":
+        raise ValueError("Unknown factorization backend %r"%backend)
+
+    return sparse.linalg.splu(A).solve, "superlu"
+
 class Surface(object):
     """Represents a single cortical hemisphere surface. Can be the white matter surface,
     pial surface, fiducial (mid-cortical) surface, inflated surface, flattened surface,
@@ -26,7 +80,10 @@ class Surface(object):
 
     Implements some useful functions for dealing with functions across surfaces.
     """
-    def __init__(self, pts, polys):
+    #Number of factorized operators kept by each surface
+    max_factors = 8
+
+    def __init__(self, pts, polys, backend="auto"):
         """Initialize Surface.
 
         Parameters
@@ -35,13 +92,52 @@ class Surface(object):
             Location of each vertex in space (mm). Order is x, y, z.
         polys : 2D ndarray, shape (total_polys, 3)
             Indices of the vertices in each triangle in the surface.
+        backend : str, optional
+            Sparse factorization used by smooth and the geodesic distances, see
+            `factorize`. Default 'auto' uses a Cholesky decomposition if scikit-sparse
+            is installed, and an LU decomposition otherwise.
         """
         self.pts = pts.astype(np.double)
         self.polys = polys
+        self.backend = backend
 
         self._cache = dict()
-        self._rlfac_solvers = dict()
-        self._nLC_solvers = dict()
+        self._factors = OrderedDict()
+
+    def _factorize(self, key, build, definite=True, goodrows=None):
+        """Factorization of the operator identified by `key`, such as ('smooth', factor),
+        which is built by calling `build` if it is not cached yet. Only the rows and
+        columns in `goodrows` are factorized. By default these are the ones that do
+        not sum to zero (vertices that are not part of any face), which would make
+        the operator singular.
+
+        Only positive `definite` operators are handed to the Cholesky backend; the
+        others always use the LU decomposition.
+
+        Returns
+        -------
+        goodrows : 1D ndarray
+            Indices of the vertices included in the factorization.
+        solve : function
+            Solves the operator for those vertices.
+        """
+        with instrument.span("polyutils.factorize", operator=key[0]) as span:
+            if key in self._factors:
+                span.set(hit=True)
+                self._factors[key] = self._factors.pop(key)
+                return self._factors[key]
+
+            lfac = build()
+            if goodrows is None:
+                goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
+            backend = self.backend if definite else "superlu"
+            solve, backend = factorize(lfac[goodrows][:,goodrows], backend=backend)
+            span.set(hit=False, backend=backend, size=len(goodrows))
+
+            self._factors[key] = goodrows, solve
+            while len(self._factors) > self.max_factors:
+                self._factors.popitem(last=False)
+            return goodrows, solve
 
     @property
     @_memo
@@ -201,7 +297,9 @@ class Surface(object):
         """Smooth vertex-wise function given by `scalars` across the surface using
         mean curvature flow method (see http://brickisland.net/cs177fa12/?p=302).
 
-        Amount of smoothing is controlled by `factor`.
+        Amount of smoothing is controlled by `factor`. The smoothing operator is
+        factorized once per `factor` and cached, so repeated calls with the same
+        `factor` only cost a solve.
 
         Parameters
         ----------
@@ -223,9 +321,9 @@ class Surface(object):
         
         B,D,W,V = self.laplace_operator
         npt = len(D)
-        lfac = sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
-        goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-        lfac_solver = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
+        def build():
+            return sparse.dia_matrix((D,[0]), (npt,npt)) - factor * (W-V)
+        goodrows, lfac_solver = self._factorize(("smooth", factor), build)
         to_smooth = scalars.copy()
         for _ in range(iterations):
             from_smooth = lfac_solver((D * to_smooth)[goodrows])
@@ -314,10 +412,9 @@ class Surface(object):
         notboundary : ndarray, int
             Indices of non-boundary vertices
         """
-        try:
-            from sksparse.sparse.cholmod import cholesky
-        except ImportError:
-            from scikits.sparse.cholmod import cholesky
+        cholmod = _cholmod()
+        if cholmod is None:
+            raise ImportError("Biharmonic interpolation requires scikit-sparse")
         B, D, W, V = self.laplace_operator
         npt = len(D)
 
@@ -330,7 +427,7 @@ class Surface(object):
         L = Dinv.dot((V-W)) # construct Laplace-Beltrami operator
         
         lhs = (V-W).dot(L) # construct left side, almost squared L-B operator
-        lhsfac = cholesky(lhs[notboundary][:,notboundary]) # factorize
+        lhsfac = cholmod.cholesky(lhs[notboundary][:,notboundary]) # factorize
         
         return lhs, D, Dinv, lhsfac, notboundary
 
@@ -418,28 +515,32 @@ class Surface(object):
         fe31 = np.cross(fnorms, ppts[:,0] - ppts[:,2])
         return fe12, fe23, fe31
 
-    def approx_geodesic_distance(self, verts, m=0.1):
+    def _heat_solver(self, m, fem=False):
+        """Factorized backward Euler step of heat diffusion for time `m` times the
+        squared average edge length"""
         npt = len(self.pts)
         t = m * self.avg_edge_length ** 2 # time of heat evolution
-
-        if m not in self._rlfac_solvers:
+        def build():
             B, D, W, V = self.laplace_operator
             nLC = W - V # negative laplace matrix
-            spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
-            
-            lfac = spD - t * nLC # backward Euler matrix
+            if not fem:
+                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
+            else:
+                spD = B
+            return spD - t * nLC # backward Euler matrix
+        return self._factorize(("heat", m, fem), build)
 
-            # Exclude rows with zero weight (these break the sparse LU, that finicky fuck)
-            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-            self._goodrows = goodrows
-            self._rlfac_solvers[m] = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
+    def approx_geodesic_distance(self, verts, m=0.1):
+        npt = len(self.pts)
+        t = m * self.avg_edge_length ** 2 # time of heat evolution
+        goodrows, solver = self._heat_solver(m)
 
         # Solve system to get u, the heat values
         u0 = np.zeros((npt,)) # initial heat values
         u0[verts] = 1.0
-        goodu = self._rlfac_solvers[m](u0[self._goodrows])
+        goodu = solver(u0[goodrows])
         u = np.zeros((npt,))
-        u[self._goodrows] = goodu
+        u[goodrows] = goodu
 
         return -4 * t * np.log(u)
 
@@ -454,7 +555,7 @@ class Surface(object):
         computation. Smaller values of `m` will roughen and will usually increase error
         in the distance computation. The default value of 1.0 is probably pretty good.
 
-        This function caches some data (sparse LU factorizations of the laplace-beltrami
+        This function caches some data (sparse factorizations of the laplace-beltrami
         operator and the weighted adjacency matrix), so it will be much faster on
         subsequent runs.
 
@@ -478,57 +579,99 @@ class Surface(object):
             Geodesic distance (in mm) from each vertex in the surface to the closest
             vertex in `verts`.
         """
+        u0 = np.zeros((len(self.pts), 1)) # initial heat values
+        u0[verts] = 1.0
+        phi = self._heat_geodesic(u0, m, fem)[:,0]
+
+        # Ensure that distance is zero for selected verts
+        phi[verts] = 0.0
+
+        return phi
+
+    def batch_geodesic_distance(self, sources, m=1.0, fem=False, chunksize=32):
+        """Geodesic distance (in mm) from each vertex in the surface to each of K sets
+        of vertices in `sources`. Equivalent to stacking `geodesic_distance(verts)` for
+        each set, but the heat and Poisson systems are solved for many sets at once.
+
+        Parameters
+        ----------
+        sources : list of array-like of ints
+            K sets of vertices to compute distances from. A single vertex index is
+            also accepted as a set.
+        m : float, optional
+            Reverse Euler step length, see geodesic_distance.
+        fem : bool, optional
+            Whether to use Finite Element Method lumped mass matrix, see
+            geodesic_distance.
+        chunksize : int, optional
+            Number of sets solved at once. Memory use grows with chunksize times the
+            number of faces. If None, all sets are solved at once.
+
+        Returns
+        -------
+        dists : 2D ndarray, shape (K, total_verts), float32
+            Geodesic distance from each vertex to the closest vertex of each set.
+        """
+        sources = list(sources)
         npt = len(self.pts)
-        if m not in self._rlfac_solvers or m not in self._nLC_solvers:
+        if chunksize is None:
+            chunksize = max(len(sources), 1)
+
+        dists = np.zeros((len(sources), npt), dtype=np.float32)
+        for start in range(0, len(sources), chunksize):
+            chunk = sources[start:start+chunksize]
+            u0 = np.zeros((npt, len(chunk))) # initial heat values
+            for k, verts in enumerate(chunk):
+                u0[verts, k] = 1.0
+            phi = self._heat_geodesic(u0, m, fem)
+            for k, verts in enumerate(chunk):
+                phi[verts, k] = 0.0
+            dists[start:start+len(chunk)] = phi.T
+
+        return dists
+
+    def _heat_geodesic(self, u0, m, fem):
+        """Heat method distances for each column of `u0`, the initial heat values
+        at each vertex. Returns an array of shape (total_verts, columns)"""
+        npt, nsrc = u0.shape
+        goodrows, heat_solver = self._heat_solver(m, fem=fem)
+        def build():
             B, D, W, V = self.laplace_operator
-            nLC = W - V # negative laplace matrix
-            if not fem:
-                spD = sparse.dia_matrix((D,[0]), (npt,npt)).tocsr() # lumped mass matrix
-            else:
-                spD = B
-            
-            t = m * self.avg_edge_length ** 2 # time of heat evolution
-            lfac = spD - t * nLC # backward Euler matrix
-
-            # Exclude rows with zero weight (these break the sparse LU, that finicky fuck)
-            goodrows = np.nonzero(~np.array(lfac.sum(0) == 0).ravel())[0]
-            self._goodrows = goodrows
-            self._rlfac_solvers[m] = sparse.linalg.dsolve.factorized(lfac[goodrows][:,goodrows])
-            self._nLC_solvers[m] = sparse.linalg.dsolve.factorized(nLC[goodrows][:,goodrows])
+            return W - V # negative laplace matrix
+        # The laplacian is singular, so it cannot be Cholesky factorized
+        _, poisson_solver = self._factorize(("laplace",), build, definite=False,
+            goodrows=goodrows)
 
         # Solve system to get u, the heat values
-        u0 = np.zeros((npt,)) # initial heat values
-        u0[verts] = 1.0
-        goodu = self._rlfac_solvers[m](u0[self._goodrows])
-        u = np.zeros((npt,))
-        u[self._goodrows] = goodu
-
-        # Compute grad u at each face
-        gradu = self.surface_gradient(u, at_verts=False)
-        
-        # Compute X (normalized grad u)
-        #X = np.nan_to_num((-gradu.T / np.sqrt((gradu**2).sum(1))).T)
-        graduT = gradu.T
-        gusum = ne.evaluate("sum(gradu ** 2, 1)")
-        X = np.nan_to_num(ne.evaluate("-graduT / sqrt(gusum)").T)
+        u = np.zeros((npt, nsrc))
+        u[goodrows] = heat_solver(u0[goodrows])
+
+        # Compute grad u at each face, shape (faces, 3, sources)
+        pu = u[self.polys]
+        fe12, fe23, fe31 = self._facenorm_cross_edge
+        gradu = fe12[:,:,np.newaxis] * pu[:,np.newaxis,2]
+        gradu += fe23[:,:,np.newaxis] * pu[:,np.newaxis,0]
+        gradu += fe31[:,:,np.newaxis] * pu[:,np.newaxis,1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            gradu /= 2 * self.face_areas[:,np.newaxis,np.newaxis]
+            gradu = np.nan_to_num(gradu)
+
+            # Compute X (normalized grad u)
+            X = gradu
+            X /= -np.sqrt((gradu**2).sum(1))[:,np.newaxis]
+            X = np.nan_to_num(X)
 
         # Compute integrated divergence of X at each vertex
-        #x1 = x2 = x3 = np.zeros((X.shape[0],))
         c32, c13, c21 = self._cot_edge
-        x1 = 0.5 * (c32 * X).sum(1)
-        x2 = 0.5 * (c13 * X).sum(1)
-        x3 = 0.5 * (c21 * X).sum(1)
-        
         conn1, conn2, conn3 = self._polyconn
-        divx = conn1.dot(x1) + conn2.dot(x2) + conn3.dot(x3)
+        divx = np.zeros((npt, nsrc))
+        for conn, c in [(conn1, c32), (conn2, c13), (conn3, c21)]:
+            divx += conn.dot(0.5 * np.einsum("fd,fdk->fk", c, X))
 
         # Compute phi (distance)
-        goodphi = self._nLC_solvers[m](divx[self._goodrows])
-        phi = np.zeros((npt,))
-        phi[self._goodrows] = goodphi - goodphi.min()
-
-        # Ensure that distance is zero for selected verts
-        phi[verts] = 0.0
+        goodphi = poisson_solver(divx[goodrows])
+        phi = np.zeros((npt, nsrc))
+        phi[goodrows] = goodphi - goodphi.min(0)
 
         return phi
 
@@ -556,6 +699,116 @@ class Surface(object):
         c3 = sparse.coo_matrix((o, (self.polys[:,2], range(npoly))), (npt, npoly)).tocsr()
         return c1, c2, c3
 
+    @property
+    @_memo
+    def edge_lengths(self):
+        """Sparse matrix of the length (in mm) of the edge between each pair of
+        adjacent vertices, in CSR format. This is the graph used by dijkstra_distance.
+        """
+        adj = self.adj.tocoo()
+        lengths = np.sqrt(((self.pts[adj.row] - self.pts[adj.col])**2).sum(1))
+        return sparse.csr_matrix((lengths, (adj.row, adj.col)), adj.shape)
+
+    def dijkstra_distance(self, verts, radius=None):
+        """Shortest distance (in mm) along the edges of the mesh from each vertex in
+        the surface to any vertex in the collection `verts`. Paths along the edges
+        are a bit longer than the true geodesic, but unlike geodesic_distance the
+        search can stop at a given `radius`, which makes small neighborhoods cheap.
+
+        Parameters
+        ----------
+        verts : 1D array-like of ints
+            Set of vertices to compute distance from.
+        radius : float, optional
+            Vertices further than this are not visited, and get a distance of inf.
+            Default None visits the whole surface.
+
+        Returns
+        -------
+        dist : 1D ndarray, shape (total_verts,)
+            Distance (in mm) from each vertex to the closest vertex in `verts`.
+        """
+        limit = np.inf if radius is None else radius
+        return sparse.csgraph.dijkstra(self.edge_lengths, directed=True,
+            indices=np.atleast_1d(verts), limit=limit, min_only=True)
+
+    def geodesic_neighborhoods(self, seeds, radius, chunksize=64):
+        """Vertices within `radius` mm of each of the `seeds`, along the edges of the
+        mesh (see dijkstra_distance), as in a searchlight or smoothing kernel.
+
+        Parameters
+        ----------
+        seeds : 1D array-like of ints
+            Center vertex of each neighborhood.
+        radius : float
+            Radius of the neighborhoods, in mm.
+        chunksize : int, optional
+            Number of seeds searched at once. Each chunk needs a dense array of
+            chunksize by total_verts distances.
+
+        Returns
+        -------
+        dists : sparse matrix, shape (len(seeds), total_verts), CSR
+            Distance from each seed to each vertex in its neighborhood. The seed
+            itself is stored as an explicit zero, so the sparsity pattern gives the
+            neighborhoods.
+        """
+        seeds = np.atleast_1d(seeds)
+        npt = len(self.pts)
+        graph = self.edge_lengths
+        rows, cols, data = [np.zeros((0,), dtype=int)], [np.zeros((0,), dtype=int)], [np.zeros((0,))]
+        for start in range(0, len(seeds), chunksize):
+            # The graph is symmetric, so directed search avoids symmetrizing it again
+            dist = sparse.csgraph.dijkstra(graph, directed=True,
+                indices=seeds[start:start+chunksize], limit=radius)
+            idx = np.flatnonzero(dist <= radius)
+            i, j = np.divmod(idx, npt)
+            rows.append(i + start)
+            cols.append(j)
+            data.append(dist.ravel()[idx])
+
+        return sparse.csr_matrix((np.hstack(data), (np.hstack(rows), np.hstack(cols))),
+            shape=(len(seeds), npt))
+
+    def smoothing_kernel(self, fwhm, radius=None, chunksize=64):
+        """Sparse operator that smooths vertex-wise functions with a Gaussian kernel
+        of the given full width at half maximum, applied to distances along the mesh
+        (see geodesic_neighborhoods). Unlike `smooth`, the operator is built once and
+        can then be applied to many functions at once, such as the timepoints of a
+        movie: `kernel.dot(data.T).T` for data of shape (time, total_verts).
+
+        Parameters
+        ----------
+        fwhm : float
+            Full width at half maximum of the kernel, in mm.
+        radius : float, optional
+            Distance at which the kernel is truncated, in mm. Default is 3 sigma,
+            about 1.27 times `fwhm`. The number of nonzeros in the operator grows
+            with the square of the radius.
+        chunksize : int, optional
+            Number of vertices whose neighborhoods are searched at once.
+
+        Returns
+        -------
+        kernel : sparse matrix, shape (total_verts, total_verts), CSR, float32
+            Smoothing operator. Each row sums to one.
+        """
+        npt = len(self.pts)
+        if fwhm == 0:
+            return sparse.identity(npt, dtype=np.float32, format="csr")
+
+        sigma = fwhm / (2 * np.sqrt(2 * np.log(2)))
+        if radius is None:
+            radius = 3 * sigma
+
+        kernel = self.geodesic_neighborhoods(np.arange(npt), radius, chunksize=chunksize)
+        weights = np.exp(-kernel.data**2 / (2 * sigma**2))
+        # Each vertex is in its own neighborhood, so rows never sum to zero
+        rowsum = np.add.reduceat(weights, kernel.indptr[:-1])
+        weights /= np.repeat(rowsum, np.diff(kernel.indptr))
+        kernel.data = weights.astype(np.float32)
+        return kernel
+
     @property
     @_memo
     def graph(self):
@@ -836,6 +1089,36 @@ def sort_polys(polys):
     xind = np.arange(len(polys))
     return np.array([polys[xind, amin], polys[xind, (amin+1)%3], polys[xind, (amin+2)%3]]).T
 
+def face_keys(polys, nverts=None):
+    '''Encodes each triangle as a single int64, so that sets of faces can be
+    compared with numpy instead of as python sets of tuples. Faces with the
+    same vertices in the same cyclic order (see `sort_polys`) get equal keys.
+
+    Parameters
+    ----------
+    polys : array_like
+        n x 3 array of triangles
+    nverts : int, optional
+        Upper bound on the vertex indices, max(polys)+1 by default. Use the
+        same bound for every set of faces that is compared.
+    '''
+    polys = sort_polys(np.asarray(polys)).astype(np.int64)
+    if nverts is None:
+        nverts = int(polys.max()) + 1 if len(polys) > 0 else 1
+    if nverts ** 3 >= 2 ** 63:
+        raise ValueError('Too many vertices to encode faces as int64')
+    return (polys[:, 0] * nverts + polys[:, 1]) * nverts + polys[:, 2]
+
+def face_difference(polys, other):
+    '''Faces of `polys` that are not faces of `other`, such as the medial wall
+    of a fiducial surface that is cut from its flatmap. Each face is returned
+    once, rotated by `sort_polys`, in the order it first appears in `polys`.'''
+    polys, other = np.asarray(polys), np.asarray(other)
+    nverts = max([int(p.max()) + 1 for p in (polys, other) if len(p) > 0] + [1])
+    keys, idx = np.unique(face_keys(polys, nverts), return_index=True)
+    idx = idx[~np.isin(keys, face_keys(other, nverts))]
+    return sort_polys(polys.reshape(-1, 3)[np.sort(idx)])
+
 def face_area(pts):
     '''Area of triangles
 
@@ -925,27 +1208,63 @@ def trace_poly(edges):
 
         yield poly
 
+def inside_edges(pts, edges, blocksize=2**22):
+    """Even-odd test of points against a set of line segments, counting the
+    segments crossed by a ray cast from each point towards -x.
+
+    Only points inside the bounding box of the segments are tested. These are
+    bucketed into horizontal bands, and each band is only tested against the
+    segments that overlap it, at most `blocksize` point/segment pairs at once.
+    """
+    inside = np.zeros(len(pts), dtype=bool)
+    #horizontal segments are never crossed with a half-open test
+    edges = edges[edges[:,0,1] != edges[:,1,1]]
+    if len(edges) == 0:
+        return inside
+
+    x0, y0, x1, y1 = edges[:,0,0], edges[:,0,1], edges[:,1,0], edges[:,1,1]
+    ylo, yhi = np.minimum(y0, y1), np.maximum(y0, y1)
+    slope = (x1 - x0) / (y1 - y0)
+
+    px, py = pts[:,0], pts[:,1]
+    cand = np.nonzero((py >= ylo.min()) & (py <= yhi.max()) & (px > np.minimum(x0, x1).min()))[0]
+    if len(cand) == 0:
+        return inside
+
+    nbands = int(np.clip(np.sqrt(len(edges)), 1, 1024))
+    bounds = np.linspace(ylo.min(), yhi.max(), nbands+1)
+    band = np.clip(np.searchsorted(bounds, py[cand], side='right') - 1, 0, nbands - 1)
+    order = np.argsort(band, kind='mergesort')
+    cand, band = cand[order], band[order]
+    splits = np.searchsorted(band, np.arange(nbands+1))
+
+    for b in range(nbands):
+        idx = cand[splits[b]:splits[b+1]]
+        if len(idx) == 0:
+            continue
+        eidx = np.nonzero((ylo <= bounds[b+1]) & (yhi >= bounds[b]))[0]
+        if len(eidx) == 0:
+            continue
+
+        ex0, ey0, ey1, eslope = x0[eidx], y0[eidx], y1[eidx], slope[eidx]
+        step = max(1, blocksize // len(eidx))
+        for start in range(0, len(idx), step):
+            bidx = idx[start:start+step]
+            bx, by = px[bidx,np.newaxis], py[bidx,np.newaxis]
+            spans = (ey0 > by) != (ey1 > by)
+            crosses = spans & (ex0 + (by - ey0) * eslope < bx)
+            inside[bidx] = crosses.sum(1) % 2 == 1
+
+    return inside
+
 def rasterize(poly, shape=(256, 256)):
-    #ImageDraw sucks at its job, so we'll use imagemagick to do rasterization
-    import subprocess as sp
-    import cStringIO
-    import shlex
-    from PIL import Image
-    
-    polygon = " ".join(["%0.3f,%0.3f"%tuple(p[::-1]) for p in np.array(poly)-(.5, .5)])
-    cmd = 'convert -size %dx%d xc:black -fill white -stroke none -draw "polygon %s" PNG32:-'%(shape[0], shape[1], polygon)
-    proc = sp.Popen(shlex.split(cmd), stdout=sp.PIPE)
-    png = cStringIO.StringIO(proc.communicate()[0])
-    im = Image.open(png)
-
-    # For PNG8:
-    # mode, palette = im.palette.getdata()
-    # lut = np.fromstring(palette, dtype=np.uint8).reshape(-1, 3)
-    # if (lut == 255).any():
-    #     white = np.nonzero((lut == 255).all(1))[0][0]
-    #     return np.array(im) == white
-    # return np.zeros(shape, dtype=bool)
-    return (np.array(im)[:,:,0] > 128).T
+    """Rasterizes a closed polygon, returning a boolean image of `shape` that is
+    True for the pixels whose centers are inside the polygon."""
+    poly = np.asarray(poly, dtype=float)
+    edges = np.concatenate([poly[:,np.newaxis], np.roll(poly, -1, axis=0)[:,np.newaxis]], axis=1)
+    x, y = np.mgrid[:shape[0], :shape[1]]
+    centers = np.column_stack([y.ravel() + .5, x.ravel() + .5])
+    return inside_edges(centers, edges).reshape(shape)
 
 def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True):
     from tvtk.api import tvtk
@@ -975,7 +1294,7 @@ def voxelize(pts, polys, shape=(256, 256, 256), center=(128, 128, 128), mp=True)
         from . import mp
         layers = mp.map(func, range(shape[2]))
     else:
-        layers = map(func, range(shape[2]))
+        layers = list(map(func, range(shape[2])))
 
     return np.array(layers).T
 
@@ -3,12 +3,15 @@ import os
 import glob
 import binascii
 import numpy as np
+from functools import reduce
 
 from . import utils
 from . import dataset
+from . import instrument
 from .database import db
 from .options import config
 
+@instrument.traced("quickflat.make_figure")
 def make_figure(braindata, recache=False, pixelwise=True, thick=32, sampler='nearest',
                 height=1024, dpi=100, depth=0.5, with_rois=True, with_sulci=False,
                 with_labels=True, with_colorbar=True, with_borders=False, 
@@ -104,21 +107,7 @@ def make_figure(braindata, recache=False, pixelwise=True, thick=32, sampler='nea
                        height=height, thick=thick, depth=depth)
 
     if cutout:
-        roi = db.get_overlay(dataview.subject,
-                             otype='cutouts',
-                             roifill=(0.,0.,0.,0.),
-                             linecolor=(0.,0.,0.,0.),
-                             linewidth=0.)
-
-        # Set ONLY desired cutout to be white
-        roi.rois[cutout].set(roifill=(1.,1.,1.,1.),
-                             linewidth=2.,
-                             linecolor=(1.,1.,1.,1.))
-        roitex = roi.get_texture(height, labels=False)
-        roitex.seek(0)
-        co = plt.imread(roitex)[:,:,0] # Cutout image
-        if not np.any(co):
-            raise Exception('No pixels in cutout region %s!'%cutout)
+        co = _get_cutout(dataview.subject, cutout, height) # Cutout image
 
         # STUPID BUT NECESSARY 1-PIXEL CHECK:
         if any([np.abs(aa-bb)>0 and np.abs(aa-bb)<2 for aa,bb in zip(im.shape,co.shape)]):
@@ -228,44 +217,14 @@ def make_figure(braindata, recache=False, pixelwise=True, thick=32, sampler='nea
                              colors=[['r','b'][mw] for mw in border[1]])
         bax.add_collection(blc)
     
-    overlays = []
-    if with_rois:
-        roi = db.get_overlay(dataview.subject,
-                             linewidth=linewidth,
-                             linecolor=linecolor,
-                             roifill=roifill,
-                             shadow=shadow,
-                             labelsize=labelsize,
+    overlays = _get_overlays(dataview.subject, with_rois=with_rois, with_sulci=with_sulci,
+                             extra_disp=extra_disp, linewidth=linewidth, linecolor=linecolor,
+                             roifill=roifill, shadow=shadow, labelsize=labelsize,
                              labelcolor=labelcolor)
-        overlays.append(roi)
-    if with_sulci:
-        sulc = db.get_overlay(dataview.subject,
-                              otype='sulci',
-                              linewidth=linewidth,
-                              linecolor=linecolor,
-                              shadow=shadow,
-                              labelsize=labelsize,
-                              labelcolor=labelcolor)
-        overlays.append(sulc)
-    if not extra_disp is None:
-        svgfile,layer = extra_disp
-        if not isinstance(layer,(list,tuple)):
-            layer = [layer]
-        for extralayer in layer:
-            # Allow multiple extra layer overlays
-            disp = db.get_overlay(dataview.subject,
-                              otype='external',
-                              shadow=shadow,
-                              labelsize=labelsize,
-                              labelcolor=labelcolor,
-                              layer=extralayer,
-                              svgfile=svgfile)
-            overlays.append(disp)
     for oo in overlays:
-        roitex = oo.get_texture(height, labels=with_labels, size=labelsize)
-        roitex.seek(0)
+        with instrument.span("quickflat.overlay", layer=oo.layer, height=height):
+            roi_im = oo.get_texture_array(height, labels=with_labels, size=labelsize) / 255.
         oax = fig.add_axes((0,0,1,1))
-        roi_im = plt.imread(roitex)
         if cutout: 
             # STUPID BUT NECESSARY 1-PIXEL CHECK:
             if any([np.abs(aa-bb)>0 and np.abs(aa-bb)<2 for aa,bb in zip(im.shape,roi_im.shape)]):
@@ -391,33 +350,37 @@ def make_svg(fname, braindata, with_labels=True, **kwargs): # recache=False, pix
     roipack = utils.get_roipack(braindata.subject)
     roipack.get_svg(fname, labels=with_labels, with_ims=[pngdata])
 
-def make(braindata, height=1024, recache=False, **kwargs):
-    mask, extents = get_flatmask(braindata.subject, height=height, recache=recache)
-    
+def _get_data(braindata):
+    """Returns the xfmname (None for vertex data) and raw values of a dataview"""
     if not hasattr(braindata, "xfmname"):
-        pixmap = get_flatcache(braindata.subject,
-                               None,
-                               height=height,
-                               recache=recache,
-                               **kwargs)
-        data = braindata.vertices
         if isinstance(braindata, dataset.Vertex2D):
-            data = braindata.raw.vertices
-        else:
-            data = braindata.vertices
-    else:
-        pixmap = get_flatcache(braindata.subject,
-                               braindata.xfmname,
-                               height=height,
-                               recache=recache,
-                               **kwargs)
-        if isinstance(braindata, dataset.Volume2D):
-            data = braindata.raw.volume
-        else:
-            data = braindata.volume
+            return None, braindata.raw.vertices
+        return None, braindata.vertices
+    if isinstance(braindata, dataset.Volume2D):
+        return braindata.xfmname, braindata.raw.volume
+    return braindata.xfmname, braindata.volume
+
+@instrument.traced("quickflat.make")
+def make(braindata, height=1024, recache=False, chunksize=64, **kwargs):
+    """Projects a Volume or Vertex onto the flatmap, returning the image and its
+    extents. Images are (height, width) with NaN outside of the cortex, or
+    (height, width, 4) uint8 for RGB data. Movies are projected `chunksize`
+    frames at a time, giving a (T, height, width) float32 stack."""
+    mask, extents = get_flatmask(braindata.subject, height=height, recache=recache)
+    xfmname, data = _get_data(braindata)
+    pixmap = get_flatcache(braindata.subject,
+                           xfmname,
+                           height=height,
+                           recache=recache,
+                           **kwargs)
 
     if data.shape[0] > 1:
-        raise ValueError("Cannot flatten movie views")
+        if data.dtype == np.uint8:
+            raise ValueError("Cannot flatten RGB movie views")
+        badmask = np.array(pixmap.sum(1) > 0).ravel()
+        pixels = _pixel_index(mask)[badmask]
+        imshape = mask.shape[::-1]
+        return _project(pixmap[np.nonzero(badmask)[0]], pixels, data, imshape, chunksize), extents
 
     if data.dtype == np.uint8:
         img = np.zeros(mask.shape+(4,), dtype=np.uint8)
@@ -432,92 +395,375 @@ def make(braindata, height=1024, recache=False, **kwargs):
 
         return img.T[::-1], extents
 
-def overlay_rois(im, subject, name=None, height=1024, labels=True, **kwargs):
-    import shlex
-    import subprocess as sp
-    from matplotlib.pylab import imsave
+def _pixel_index(mask):
+    """Index into the flattened (height, width) image, top row first, of every
+    pixel in the flatmask, in the order of the pixmap rows"""
+    width, height = mask.shape
+    x, y = np.nonzero(mask)
+    return (height - 1 - y) * width + x
+
+def _project(pixmap, pixels, frames, shape, chunksize=64):
+    """Projects a stack of frames through the pixmap into a (T, height, width)
+    float32 stack, with one sparse-dense product per chunk of frames"""
+    frames = frames.reshape(len(frames), -1)
+    out = np.empty((len(frames), shape[0] * shape[1]), dtype=np.float32)
+    out.fill(np.nan)
+    for start in range(0, len(frames), chunksize):
+        chunk = np.asarray(frames[start:start+chunksize], dtype=np.float32)
+        out[start:start+chunksize, pixels] = (pixmap * chunk.T).T
+    return out.reshape((len(frames),)+tuple(shape))
+
+class FlatmapRenderer(object):
+    """Renders many datasets onto the flatmap of one subject.
+
+    All of the layers that do not depend on the data -- the pixel map, the flat
+    mask, the curvature underlay, the dropout hatching, the roi and sulci
+    overlays and the cutout -- are computed once, when the renderer is created.
+    Each call to `render` then costs one sparse product and a colormap lookup,
+    and no matplotlib figure is ever built.
 
-    if name is None:
-        name = 'png:-'
+    Parameters
+    ----------
+    subject : str
+        Subject name
+    xfmname : str, optional
+        Transform for volume data. Leave as None to render vertex data.
+    height : int
+        Height of the image to render
+    bgcolor : matplotlib colorspec, optional
+        Color of the background. `None` gives a transparent background.
+
+    Other keyword arguments (`pixelwise`, `thick`, `sampler`, `depth`, `recache`,
+    `with_rois`, `with_sulci`, `with_labels`, `with_curvature`, `with_dropout`,
+    `cutout`, `extra_disp` and the roi and curvature display options) have the
+    same meaning as in `make_figure`.
+
+    Examples
+    --------
+    >>> renderer = FlatmapRenderer("S1", "fullhead", height=512)
+    >>> for i, contrast in enumerate(contrasts):
+    ...     renderer.save("contrast%03d.png"%i, cortex.Volume(contrast, "S1", "fullhead"))
+    """
+    def __init__(self, subject, xfmname=None, height=1024, pixelwise=True, thick=32,
+                 sampler='nearest', depth=0.5, recache=False, with_rois=True,
+                 with_sulci=False, with_labels=True, with_curvature=False,
+                 with_dropout=False, cutout=None, extra_disp=None, bgcolor=None,
+                 linewidth=None, linecolor=None, roifill=None, shadow=None,
+                 labelsize=None, labelcolor=None, cvmin=None, cvmax=None, cvthr=None):
+        from matplotlib import colors
+        self.subject = subject
+        self.xfmname = xfmname
+        self.height = height
+
+        mask, self.extents = get_flatmask(subject, height=height, recache=recache)
+        pixmap = get_flatcache(subject, xfmname, pixelwise=pixelwise, thick=thick,
+                               sampler=sampler, depth=depth, recache=recache, height=height)
+        width = mask.shape[0]
+        self.shape = height, width
+
+        #flat image index of every pixel row of the pixmap
+        pixels = _pixel_index(mask)
+        keep = np.array(pixmap.sum(1) != 0).ravel()
+
+        cutmask = None
+        if cutout:
+            cutmask = _get_cutout(subject, cutout, height)
+            cutmask = _fit(cutmask, self.shape)
+            keep &= cutmask.ravel()[pixels] > 0
+
+        self._pixmap = pixmap[np.nonzero(keep)[0]]
+        self._pixels = pixels[keep]
+
+        #layers drawn under the data
+        under = np.zeros(self.shape+(4,), dtype=np.float32)
+        if bgcolor is not None:
+            under[:] = colors.to_rgba(bgcolor)
+        if with_curvature:
+            curv, _ = make(db.get_surfinfo(subject), recache=recache, height=height)
+            if config.get('curvature','threshold').lower() in ('true','t','1','y','yes') if cvthr is None else cvthr:
+                curv = np.where(np.isnan(curv), np.nan, (curv > 0).astype(np.float32))
+            vmin = float(config.get('curvature','min')) if cvmin is None else cvmin
+            vmax = float(config.get('curvature','max')) if cvmax is None else cvmax
+            _over(under, _colorize(_fit(curv, self.shape), "gray", vmin, vmax))
+
+        #layers drawn over the data
+        over = np.zeros(self.shape+(4,), dtype=np.float32)
+        if with_dropout is not False:
+            if isinstance(with_dropout, dataset.Dataview):
+                dropout_data = with_dropout
+            else:
+                power = 20 if with_dropout is True else with_dropout
+                dropout_data = utils.get_dropout(subject, xfmname, power=power)
+            _over(over, _fit(_make_hatch_image(dropout_data, height, sampler, recache=recache), self.shape))
+        overlays = _get_overlays(subject, with_rois=with_rois, with_sulci=with_sulci,
+                                 extra_disp=extra_disp, linewidth=linewidth, linecolor=linecolor,
+                                 roifill=roifill, shadow=shadow, labelsize=labelsize,
+                                 labelcolor=labelcolor)
+        for overlay in overlays:
+            tex = overlay.get_texture_array(height, labels=with_labels, size=labelsize) / 255.
+            _over(over, _fit(tex, self.shape))
+
+        if cutmask is not None:
+            under *= cutmask[..., np.newaxis]
+            over *= cutmask[..., np.newaxis]
+            y, x = np.nonzero(cutmask)
+            self._crop = slice(y.min(), y.max()+1), slice(x.min(), x.max()+1)
+        else:
+            self._crop = slice(None), slice(None)
+
+        #keep premultiplied colors, so compositing is a multiply-add per layer
+        self._under = _premultiply(under) if under[..., 3].any() else None
+        self._over = _premultiply(over) if over[..., 3].any() else None
+
+    def __repr__(self):
+        return "<FlatmapRenderer for %s, %dx%d>"%(self.subject, self.shape[1], self.shape[0])
+
+    def project(self, data, chunksize=64):
+        """Projects data onto the flatmap, returning a (height, width) float32 image
+        with NaN outside of the cortex. RGBA uint8 data gives a (height, width, 4)
+        uint8 image, and movies give a (T, height, width) stack, computed
+        `chunksize` frames at a time."""
+        if isinstance(data, dataset.Dataview):
+            if data.subject != self.subject:
+                raise ValueError("Data is for subject %s, not %s"%(data.subject, self.subject))
+            xfmname, data = _get_data(data)
+            if xfmname != self.xfmname:
+                raise ValueError("Data is in transform %s, not %s"%(xfmname, self.xfmname))
+            if data.shape[0] > 1:
+                return self.project_frames(data, chunksize)
+        data = np.asarray(data)
+
+        npix = self.shape[0] * self.shape[1]
+        if data.dtype == np.uint8:
+            img = np.zeros((npix, 4), dtype=np.uint8)
+            img[self._pixels] = self._pixmap * data.reshape(-1, 4)
+            return img.reshape(self.shape+(4,))
+
+        img = np.empty((npix,), dtype=np.float32)
+        img.fill(np.nan)
+        img[self._pixels] = self._pixmap * data.ravel()
+        return img.reshape(self.shape)
+
+    def project_frames(self, frames, chunksize=64):
+        """Projects a stack of raw frames, such as a slice of the TRs of a movie
+        Volume or Vertex, onto the flatmap. Returns a (T, height, width) float32
+        stack with NaN outside of the cortex, computed `chunksize` frames at a time."""
+        return _project(self._pixmap, self._pixels, frames, self.shape, chunksize)
+
+    def render(self, data, cmap=None, vmin=None, vmax=None):
+        """Renders data onto the flatmap with all layers, returning an RGBA uint8
+        image of shape (height, width, 4). `data` may be a Volume or Vertex, whose
+        colormap and limits are used unless overridden, or a raw array of values."""
+        if isinstance(data, dataset.Dataview):
+            cmapdict = _has_cmap(data)
+            cmap = cmapdict.get('cmap') if cmap is None else cmap
+            vmin = cmapdict.get('vmin') if vmin is None else vmin
+            vmax = cmapdict.get('vmax') if vmax is None else vmax
+        return self.composite(self.project(data), cmap=cmap, vmin=vmin, vmax=vmax)
+
+    def composite(self, img, cmap=None, vmin=None, vmax=None):
+        """Colormaps an image returned by `project` and composites it with the
+        underlay and overlays, returning an RGBA uint8 image"""
+        if img.ndim == 3:
+            img = img / np.float32(255)
+        else:
+            if vmin is None:
+                vmin = np.nanmin(img)
+            if vmax is None:
+                vmax = np.nanmax(img)
+            img = _colorize(img, cmap, vmin, vmax)
+
+        img = _premultiply(img)
+        if self._under is not None:
+            img += self._under * (1 - img[..., 3:])
+        if self._over is not None:
+            img *= 1 - self._over[..., 3:]
+            img += self._over
+        img = img[self._crop]
+
+        alpha = img[..., 3:]
+        img[..., :3] /= np.where(alpha > 0, alpha, 1)
+        return (img * 255).round().astype(np.uint8)
+
+    def save(self, filename, data, **kwargs):
+        """Renders data with `render` and writes it as a png to `filename`, which
+        may also be a file-like object."""
+        from PIL import Image
+        Image.fromarray(self.render(data, **kwargs), "RGBA").save(filename, format="PNG")
+
+def _fit(im, shape):
+    """Resizes an image that is off by a pixel or so from the flatmap shape"""
+    if im.shape[:2] == tuple(shape):
+        return im
+    from scipy.ndimage import zoom
+    factors = (shape[0] / float(im.shape[0]), shape[1] / float(im.shape[1])) + (1,)*(im.ndim - 2)
+    return zoom(im, factors, order=1)[:shape[0], :shape[1]]
+
+def _colorize(img, cmap, vmin, vmax):
+    """Maps a float image through a colormap into RGBA, transparent where NaN"""
+    from matplotlib import pyplot as plt
+    lut = plt.get_cmap(cmap)(np.linspace(0, 1, 256)).astype(np.float32)
+    scale = 255. / (vmax - vmin) if vmax != vmin else 0
+    with np.errstate(invalid='ignore'):
+        idx = np.clip((img - vmin) * scale, 0, 255)
+    valid = ~np.isnan(idx)
+    out = np.zeros(img.shape+(4,), dtype=np.float32)
+    out[valid] = lut[idx[valid].astype(np.intp)]
+    return out
+
+def _premultiply(img):
+    img = np.array(img, dtype=np.float32)
+    img[..., :3] *= img[..., 3:]
+    return img
+
+def _over(dst, src):
+    """Composites an RGBA image over another (both non-premultiplied), in place"""
+    a = src[..., 3:]
+    alpha = a + dst[..., 3:] * (1 - a)
+    rgb = src[..., :3] * a + dst[..., :3] * dst[..., 3:] * (1 - a)
+    dst[..., :3] = np.where(alpha > 0, rgb / np.where(alpha > 0, alpha, 1), 0)
+    dst[..., 3:] = alpha
+
+_roitex = dict()
 
-    key = (subject, labels)
-    if key not in rois:
+def overlay_rois(im, subject, name=None, height=1024, labels=True, **kwargs):
+    """Composites the roi overlay of `subject` over a flatmap image. `im` may be
+    an RGBA image, or a 2D array that is colormapped with the `cmap`, `vmin`
+    and `vmax` keyword arguments. Writes a png to `name`, or returns it in a
+    file-like object if no name is given."""
+    from PIL import Image
+    from matplotlib import cm
+
+    key = (subject, labels, height)
+    if key not in _roitex:
         print("loading %s"%subject)
-        rois[key] = utils.get_roipack(subject).get_texture(height, labels=labels)
-    cmd = "composite {rois} - {name}".format(rois=rois[key].name, name=name)
-    proc = sp.Popen(shlex.split(cmd), stdin=sp.PIPE, stdout=sp.PIPE)
-
-    fp = io.StringIO()
-    imsave(fp, im, **kwargs)
+        _roitex[key] = utils.get_roipack(subject).get_texture_array(height, labels=labels)
+    rois = _roitex[key] / 255.
+
+    if im.ndim == 2:
+        cmap = cm.ScalarMappable(cmap=kwargs.get('cmap'))
+        cmap.set_clim(kwargs.get('vmin'), kwargs.get('vmax'))
+        im = cmap.to_rgba(im)
+    elif im.dtype == np.uint8:
+        im = im / 255.
+    if im.shape[2] == 3:
+        im = np.dstack([im, np.ones(im.shape[:2])])
+
+    if rois.shape[:2] != im.shape[:2]:
+        rois = Image.fromarray(_roitex[key]).resize(im.shape[1::-1], Image.BILINEAR)
+        rois = np.asarray(rois) / 255.
+
+    alpha = rois[:,:,3:] + im[:,:,3:] * (1 - rois[:,:,3:])
+    rgb = rois[:,:,:3] * rois[:,:,3:] + im[:,:,:3] * im[:,:,3:] * (1 - rois[:,:,3:])
+    rgb = np.where(alpha > 0, rgb / np.maximum(alpha, 1e-8), 0)
+    out = Image.fromarray((np.dstack([rgb, alpha]) * 255).round().astype(np.uint8))
+
+    if name is not None:
+        out.save(name, format="PNG")
+        return
+
+    fp = io.BytesIO()
+    out.save(fp, format="PNG")
     fp.seek(0)
-    out, err = proc.communicate(fp.read())
-    if len(out) > 0:
-        fp = io.StringIO()
-        fp.write(out)
-        fp.seek(0)
-        return fp
+    return fp
 
 def show(*args, **kwargs):
     raise DeprecationWarning("Use quickflat.make_figure instead")
     return make_figure(*args, **kwargs)
 
-def make_movie(name, data, subject, xfmname, recache=False, height=1024,
-               sampler='nearest', dpi=100, tr=2, interp='linear', fps=30,
-               vcodec='libtheora', bitrate="8000k", vmin=None, vmax=None, **kwargs):
-    raise NotImplementedError
-    import sys
-    import shlex
-    import shutil
-    import tempfile
-    import subprocess as sp
-    import multiprocessing as mp
-    
-    from scipy.interpolate import interp1d
-
-    #make the flatmaps
-    ims,extents = make(data, subject, xfmname, recache=recache, height=height, sampler=sampler)
-    if vmin is None:
-        vmin = np.nanmin(ims)
-    if vmax is None:
-        vmax = np.nanmax(ims)
-
-    #Create the matplotlib figure
-    fig = make_figure(ims[0], subject, vmin=vmin, vmax=vmax, **kwargs)
-    fig.set_size_inches(np.array([ims.shape[2], ims.shape[1]]) / float(dpi))
-    img = fig.axes[0].images[0]
-
-    #set up interpolation
-    times = np.arange(0, len(ims)*tr, tr)
-    interp = interp1d(times, ims, kind=interp, axis=0, copy=False)
-    frames = np.linspace(0, times[-1], (len(times)-1)*tr*fps+1)
-    
-    try:
-        path = tempfile.mkdtemp()
-        impath = os.path.join(path, "im%09d.png")
+def make_movie(name, braindata, height=1024, tr=2, interp='linear', fps=30,
+               vcodec='libx264', bitrate="8000k", vmin=None, vmax=None, cmap=None,
+               bgcolor='black', encoder='ffmpeg', chunksize=64, nsample=100, **kwargs):
+    """Renders a movie Volume or Vertex into a video file. Frames are projected
+    onto the flatmap in chunks of `chunksize` TRs, interpolated to `fps`, and
+    piped as raw RGBA to `encoder` (ffmpeg or avconv), without temporary files.
 
-        def overlay(idxts):
-            idx, ts = idxts
-            img.set_data(interp(ts))
-            fig.savefig(impath%idx, transparent=True, dpi=dpi)
+    Parameters
+    ----------
+    name : str
+        Output video filename
+    braindata : Dataview
+        Movie data to render
+    tr : float
+        Repetition time of the data, in seconds
+    interp : str
+        'linear' or 'nearest' interpolation between TRs
+    vmin, vmax : float, optional
+        Color limits. Default to the limits of the dataview, or else the 1st and
+        99th percentiles of up to `nsample` evenly spaced TRs.
+    cmap : str, optional
+        Colormap. Defaults to that of the dataview.
+
+    Other keyword arguments (roi, curvature and mapping options) are passed to
+    FlatmapRenderer.
+    """
+    import subprocess as sp
 
-        list(map(overlay, enumerate(frames)))
+    dataview = dataset.normalize(braindata)
+    if not isinstance(dataview, dataset.Dataview):
+        raise TypeError('Please provide a Dataview, not a Dataset')
+    if interp not in ('linear', 'nearest'):
+        raise ValueError("Unknown interpolation %r"%interp)
 
-        cmd = "avconv -i {path} -vcodec {vcodec} -r {fps} -b {br} {name}".format(path=impath, vcodec=vcodec, fps=fps, br=bitrate, name=name)
-        sp.call(shlex.split(cmd))
+    xfmname, data = _get_data(dataview)
+    cmapdict = _has_cmap(dataview)
+    cmap = cmapdict.get('cmap') if cmap is None else cmap
+    vmin = cmapdict.get('vmin') if vmin is None else vmin
+    vmax = cmapdict.get('vmax') if vmax is None else vmax
+    if vmin is None or vmax is None:
+        #only read a subsample of the movie, so that it is streamed just once
+        sample = data[np.unique(np.linspace(0, len(data) - 1, nsample).astype(int))]
+        if vmin is None:
+            vmin = np.nanpercentile(sample, 1)
+        if vmax is None:
+            vmax = np.nanpercentile(sample, 99)
+
+    renderer = FlatmapRenderer(dataview.subject, xfmname, height=height, bgcolor=bgcolor, **kwargs)
+    h, w = renderer.composite(renderer.project(data[0])).shape[:2]
+
+    #times of the output frames, in units of TRs
+    ntr = len(data)
+    frames = np.arange(0, (ntr - 1) * tr * fps + 1) / float(tr * fps)
+
+    cmd = [encoder, "-y", "-f", "rawvideo", "-pix_fmt", "rgba", "-s", "%dx%d"%(w, h),
+           "-r", str(fps), "-i", "-", "-vcodec", vcodec, "-b:v", bitrate, "-pix_fmt", "yuv420p",
+           "-vf", "pad=ceil(iw/2)*2:ceil(ih/2)*2", name]
+    proc = sp.Popen(cmd, stdin=sp.PIPE)
+    try:
+        for start in range(0, ntr - 1 or 1, chunksize):
+            #project one extra TR, to interpolate up to the start of the next chunk
+            chunk = data[start:start+chunksize+1]
+            stack = renderer.project_frames(chunk, len(chunk))
+            last = start + chunksize if start + chunksize < ntr - 1 else ntr
+            for ts in frames[(frames >= start) & (frames < last)]:
+                idx = ts - start
+                if interp == 'nearest':
+                    img = stack[int(round(idx))]
+                else:
+                    i0 = min(int(idx), len(stack) - 1)
+                    frac = idx - i0
+                    img = stack[i0] if frac == 0 else stack[i0] * (1 - frac) + stack[i0+1] * frac
+                proc.stdin.write(renderer.composite(img, cmap=cmap, vmin=vmin, vmax=vmax).tobytes())
     finally:
-        shutil.rmtree(path)
+        proc.stdin.close()
+        proc.wait()
+
+    if proc.returncode != 0:
+        raise IOError("%s failed with return code %d"%(encoder, proc.returncode))
 
 def get_flatmask(subject, height=1024, recache=False):
     cachedir = db.get_cache(subject)
     cachefile = os.path.join(cachedir, "flatmask_{h}.npz".format(h=height))
 
-    if not os.path.exists(cachefile) or recache:
-        mask, extents = _make_flatmask(subject, height=height)
-        np.savez(cachefile, mask=mask, extents=extents)
-    else:
-        npz = np.load(cachefile)
-        mask, extents = npz['mask'], npz['extents']
-        npz.close()
+    with instrument.span("quickflat.get_flatmask", subject=subject, height=height) as span:
+        span.set(hit=os.path.exists(cachefile) and not recache)
+        if not os.path.exists(cachefile) or recache:
+            mask, extents = _make_flatmask(subject, height=height)
+            np.savez(cachefile, mask=mask, extents=extents)
+        else:
+            npz = np.load(cachefile)
+            mask, extents = npz['mask'], npz['extents']
+            npz.close()
 
     return mask, extents
 
@@ -530,18 +776,22 @@ def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
         extra = "l%d"%thick if thick > 1 else "d%g"%depth
         cachefile = cachefile.format(height=height, xfmname=xfmname, sampler=sampler, extra=extra)
 
-    if not os.path.exists(cachefile) or recache:
-        print("Generating a flatmap cache")
-        if pixelwise and xfmname is not None:
-            pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
+    with instrument.span("quickflat.get_flatcache", subject=subject, xfmname=xfmname,
+                         height=height, sampler=sampler, pixelwise=pixelwise) as span:
+        span.set(hit=os.path.exists(cachefile) and not recache)
+        if not os.path.exists(cachefile) or recache:
+            print("Generating a flatmap cache")
+            if pixelwise and xfmname is not None:
+                pixmap = _make_pixel_cache(subject, xfmname, height=height, sampler=sampler, thick=thick, depth=depth)
+            else:
+                pixmap = _make_vertex_cache(subject, height=height)
+            np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
         else:
-            pixmap = _make_vertex_cache(subject, height=height)
-        np.savez(cachefile, data=pixmap.data, indices=pixmap.indices, indptr=pixmap.indptr, shape=pixmap.shape)
-    else:
-        from scipy import sparse
-        npz = np.load(cachefile)
-        pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
-        npz.close()
+            from scipy import sparse
+            npz = np.load(cachefile)
+            pixmap = sparse.csr_matrix((npz['data'], npz['indices'], npz['indptr']), shape=npz['shape'])
+            npz.close()
+        span.set(pixmap=pixmap)
 
     if not pixelwise and xfmname is not None:
         from scipy import sparse
@@ -550,6 +800,61 @@ def get_flatcache(subject, xfmname, pixelwise=True, thick=32, sampler='nearest',
 
     return pixmap
 
+def _get_cutout(subject, cutout, height=1024):
+    """Renders the named cutout into a float image, 1 inside the cutout and 0 outside"""
+    roi = db.get_overlay(subject,
+                         otype='cutouts',
+                         roifill=(0.,0.,0.,0.),
+                         linecolor=(0.,0.,0.,0.),
+                         linewidth=0.)
+
+    # Set ONLY desired cutout to be white
+    roi.rois[cutout].set(roifill=(1.,1.,1.,1.),
+                         linewidth=2.,
+                         linecolor=(1.,1.,1.,1.))
+    co = roi.get_texture_array(height, labels=False)[:,:,0] / 255.
+    if not np.any(co):
+        raise Exception('No pixels in cutout region %s!'%cutout)
+    return co
+
+def _get_overlays(subject, with_rois=True, with_sulci=False, extra_disp=None, linewidth=None,
+                  linecolor=None, roifill=None, shadow=None, labelsize=None, labelcolor=None):
+    """Loads the overlays (rois, sulci and extra display layers) drawn over a flatmap"""
+    overlays = []
+    if with_rois:
+        roi = db.get_overlay(subject,
+                             linewidth=linewidth,
+                             linecolor=linecolor,
+                             roifill=roifill,
+                             shadow=shadow,
+                             labelsize=labelsize,
+                             labelcolor=labelcolor)
+        overlays.append(roi)
+    if with_sulci:
+        sulc = db.get_overlay(subject,
+                              otype='sulci',
+                              linewidth=linewidth,
+                              linecolor=linecolor,
+                              shadow=shadow,
+                              labelsize=labelsize,
+                              labelcolor=labelcolor)
+        overlays.append(sulc)
+    if not extra_disp is None:
+        svgfile,layer = extra_disp
+        if not isinstance(layer,(list,tuple)):
+            layer = [layer]
+        for extralayer in layer:
+            # Allow multiple extra layer overlays
+            disp = db.get_overlay(subject,
+                              otype='external',
+                              shadow=shadow,
+                              labelsize=labelsize,
+                              labelcolor=labelcolor,
+                              layer=extralayer,
+                              svgfile=svgfile)
+            overlays.append(disp)
+    return overlays
+
 def _make_hatch_image(dropout_data, height, sampler, recache=False):
     dmap, ee = make(dropout_data, height=height, sampler=sampler, recache=recache)
     hx, hy = np.meshgrid(range(dmap.shape[1]), range(dmap.shape[0]))
@@ -566,7 +871,7 @@ def _make_flatmask(subject, height=1024):
     from PIL import Image, ImageDraw
     pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
     bounds = polyutils.trace_poly(polyutils.boundary_edges(polys))
-    left, right = bounds.next(), bounds.next()
+    left, right = next(bounds), next(bounds)
     aspect = (height / (pts.max(0) - pts.min(0))[1])
     lpts = (pts[left] - pts.min(0)) * aspect
     rpts = (pts[right] - pts.min(0)) * aspect
@@ -598,7 +903,8 @@ def _make_vertex_cache(subject, height=1024):
     dataij = (np.ones((len(vert),)), np.array([np.arange(len(vert)), valid[vert]]))
     return sparse.csr_matrix(dataij, shape=(mask.sum(), len(flat)))
 
-def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sampler='nearest'):
+def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sampler='nearest',
+                      layerchunk=None):
     from scipy import sparse
     from scipy.spatial import Delaunay
     flat, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
@@ -631,8 +937,8 @@ def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sample
     try:
         pia, polys = db.get_surf(subject, "pia", merge=True, nudge=False)
         wm, polys = db.get_surf(subject, "wm", merge=True, nudge=False)
-        piacoords = xfm((pia[valid][dl.vertices][simps] * ll[np.newaxis].T).sum(1))
-        wmcoords = xfm((wm[valid][dl.vertices][simps] * ll[np.newaxis].T).sum(1))
+        piacoords = xfm((pia[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
+        wmcoords = xfm((wm[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
 
         valid_p = reduce(np.logical_and, [reduce(np.logical_and, (0 <= piacoords).T), 
             piacoords[:,0] < xfm.shape[2], 
@@ -644,22 +950,20 @@ def _make_pixel_cache(subject, xfmname, height=1024, thick=32, depth=0.5, sample
             wmcoords[:,2] < xfm.shape[0]])
         valid = np.logical_and(valid_p, valid_w)
         vidx = np.nonzero(valid)[0]
-        mapper = sparse.csr_matrix((mask.sum(), np.prod(xfm.shape)))
+        csrshape = mask.sum(), np.prod(xfm.shape)
         if thick == 1:
             i, j, data = sampclass(piacoords[valid]*depth + wmcoords[valid]*(1-depth), xfm.shape)
-            mapper = mapper + sparse.csr_matrix((data / float(thick), (vidx[i], j)),
-                                                shape=mapper.shape)
-            return mapper
+            return sparse.csr_matrix((data, (vidx[i], j)), shape=csrshape)
 
-        for t in np.linspace(0, 1, thick+2)[1:-1]:
-            i, j, data = sampclass(piacoords[valid]*t + wmcoords[valid]*(1-t), xfm.shape)
-            mapper = mapper + sparse.csr_matrix((data / float(thick), (vidx[i], j)),
-                                                shape=mapper.shape)
-        return mapper
+        def layers():
+            for t in np.linspace(0, 1, thick+2)[1:-1]:
+                i, j, data = sampclass(piacoords[valid]*t + wmcoords[valid]*(1-t), xfm.shape)
+                yield vidx[i], j, data / float(thick)
+        return samplers.accumulate(layers(), csrshape, chunk=layerchunk)
 
     except IOError:
         fid, polys = db.get_surf(subject, "fiducial", merge=True)
-        fidcoords = xfm((fid[valid][dl.vertices][simps] * ll[np.newaxis].T).sum(1))
+        fidcoords = xfm((fid[valid][dl.simplices][simps] * ll[np.newaxis].T).sum(1))
 
         valid = reduce(np.logical_and, [reduce(np.logical_and, (0 <= fidcoords).T),
             fidcoords[:,0] < xfm.shape[2],
@@ -683,7 +987,7 @@ def _has_cmap(dataview):
     if not isinstance(dataview, (dataset.VolumeRGB, dataset.VertexRGB)):
         # Get colormap from matplotlib or pycortex colormaps
         ## -- redundant code, here and in cortex/dataset/views.py -- ##
-        if isinstance(dataview.cmap,(str,unicode)):
+        if is_str(dataview.cmap):
             if not dataview.cmap in cm.__dict__:
                 # unknown colormap, test whether it's in pycortex colormaps
                 cmapdir = config.get('webgl', 'colormaps')
@@ -51,7 +51,7 @@ def thickness(outfile, subject):
     right = np.sqrt(((pr[0] - wr[0])**2).sum(1))
     np.savez(outfile, left=left, right=right)
 
-def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100): 
+def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100, batchsize=16):
     tissots = []
     allcenters = []
     for hem in ["lh", "rh"]:
@@ -61,25 +61,27 @@ def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100):
         nvert = fidpts.shape[0]
         tissot_array = np.zeros((nvert,))
 
-        centers = [np.random.randint(nvert)]
-        cdists = [surf.geodesic_distance(centers)]
+        centers = []
+        mcdist = np.inf * np.ones((nvert,))
         while True:
             ## Find possible vertices
-            mcdist = np.vstack(cdists).min(0)
             possverts = np.nonzero(mcdist > spacing)[0]
-            #possverts = np.nonzero(surf.geodesic_distance(centers) > spacing)[0]
             if not len(possverts):
                 break
-            ## Pick random vertex
-            centervert = possverts[np.random.randint(len(possverts))]
-            centers.append(centervert)
-            print("Adding vertex %d.." % centervert)
-            dists = surf.geodesic_distance([centervert])
-            cdists.append(dists)
-
-            ## Find appropriate set of vertices
-            selverts = dists < radius
-            tissot_array[selverts] = 1
+            ## Pick a batch of random vertices, and get all their distances at once
+            candidates = np.random.permutation(possverts)[:batchsize]
+            cdists = surf.batch_geodesic_distance([[c] for c in candidates])
+            for centervert, dists in zip(candidates, cdists):
+                ## Skip candidates too close to a center added from this batch
+                if mcdist[centervert] <= spacing:
+                    continue
+                centers.append(centervert)
+                print("Adding vertex %d.." % centervert)
+                mcdist = np.minimum(mcdist, dists)
+
+                ## Find appropriate set of vertices
+                selverts = dists < radius
+                tissot_array[selverts] = 1
 
         tissots.append(tissot_array)
         allcenters.append(np.array(centers))
@@ -88,12 +90,9 @@ def tissots_indicatrix(outfile, sub, radius=10, spacing=50, maxfails=100):
 
 def flat_border(outfile, subject):
     flatpts, flatpolys = db.get_surf(subject, "flat", merge=True, nudge=True)
-    flatpolyset = set(map(tuple, flatpolys))
-    
     fidpts, fidpolys = db.get_surf(subject, "fiducial", merge=True, nudge=True)
-    fidpolyset = set(map(tuple, fidpolys))
-    fidonlypolys = fidpolyset - flatpolyset
-    fidonlypolyverts = np.unique(np.array(list(fidonlypolys)).ravel())
+    fidonlypolys = polyutils.face_difference(fidpolys, flatpolys)
+    fidonlypolyverts = np.unique(fidonlypolys.ravel())
     
     fidonlyverts = np.setdiff1d(fidpolys.ravel(), flatpolys.ravel())
     
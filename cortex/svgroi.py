@@ -1,12 +1,13 @@
+import io
 import os
 import re
 import copy
-import shlex
-import tempfile
 import itertools
 import numpy as np
-import subprocess as sp
-from svgsplines import LineSpline, QuadBezSpline, CubBezSpline, ArcSpline
+from collections import OrderedDict
+from .svgsplines import LineSpline, QuadBezSpline, CubBezSpline, ArcSpline
+from .polyutils import inside_edges
+from . import instrument
 
 from scipy.spatial import cKDTree
 
@@ -80,8 +81,8 @@ class ROIpack(object):
         else:
             # Normalize coordinates 0-1
             if np.any(tcoords.max(0) > 1) or np.any(tcoords.min(0) < 0):
-                tcoords -= tcoords.min(0)
-                tcoords /= tcoords.max(0)
+                tcoords = tcoords - tcoords.min(0)
+                tcoords = tcoords / tcoords.max(0)
             self.tcoords = tcoords
             self.svgfile = svgfile
             self.callback = callback
@@ -209,21 +210,11 @@ class ROIpack(object):
             with open(filename, "w") as outfile:
                 outfile.write(etree.tostring(outsvg))
         
-    def get_texture(self, texres, name=None, background=None, labels=True, bits=32, **kwargs):
-        '''Renders the current roimap as a png'''
-        #set the current size of the texture
-        w, h = self.svgshape
-        dpi = texres / h * 72
-
-        if background is not None:
-            img = E.image(
-                {"{http://www.w3.org/1999/xlink}href":"data:image/png;base64,%s"%background},
-                id="image_%s"%name, x="0", y="0",
-                width=str(self.svgshape[0]),
-                height=str(self.svgshape[1]),
-            )
-            self.svg.getroot().insert(0, img)
-
+    def get_texture_array(self, texres, background=None, labels=True, **kwargs):
+        """Renders the current roimap into an RGBA uint8 array with `texres`
+        rows, without calling any external programs. Renderings are cached in
+        memory, keyed on the svg markup (which holds the layer, its style and
+        the labels) and the resolution."""
         if labels:
             if hasattr(self, "labels"):
                 self.labels.attrib['style'] = "display:inline;"
@@ -233,22 +224,35 @@ class ROIpack(object):
             if hasattr(self, "labels"):
                 self.labels.attrib['style'] = "display:none;"
 
-        pngfile = name
-        if name is None:
-            png = tempfile.NamedTemporaryFile(suffix=".png")
-            pngfile = png.name
+        import hashlib
+        key = hashlib.sha1(etree.tostring(self.svg)).hexdigest(), texres, background
+        with instrument.span("svgroi.get_texture", layer=self.layer, texres=texres) as span:
+            span.set(hit=key in _textures)
+            if key in _textures:
+                _textures[key] = _textures.pop(key)
+            else:
+                _textures[key] = _render(self, self.svg, texres, background=background)
+                while len(_textures) > _max_textures:
+                    _textures.popitem(last=False)
+            return _textures[key].copy()
 
-        cmd = "convert -background none -density {dpi} SVG:- PNG{bits}:{outfile}"
-        cmd = cmd.format(dpi=dpi, outfile=pngfile, bits=bits)
-        proc = sp.Popen(shlex.split(cmd), stdin=sp.PIPE, stdout=sp.PIPE)
-        proc.communicate(etree.tostring(self.svg))
-        
-        if background is not None:
-            self.svg.getroot().remove(img)
+    def get_texture(self, texres, name=None, background=None, labels=True, bits=32, **kwargs):
+        '''Renders the current roimap as a png. Writes to `name` if given,
+        otherwise returns a file-like object holding the png.'''
+        from PIL import Image
+        im = self.get_texture_array(texres, background=background, labels=labels, **kwargs)
+        im = Image.fromarray(im, "RGBA")
+        if bits == 24:
+            im = im.convert("RGB")
+
+        if name is not None:
+            im.save(name, format="PNG")
+            return
 
-        if name is None:
-            png.seek(0)
-            return png
+        png = io.BytesIO()
+        im.save(png, format="PNG")
+        png.seek(0)
+        return png
 
     def get_labelpos(self, pts=None, norms=None, fancy=True):
         return dict([(name, roi.get_labelpos(pts, norms, fancy)) for name, roi in list(self.rois.items())])
@@ -259,7 +263,10 @@ class ROIpack(object):
     def get_splines(self, roiname):
         path_strs = [list(_tokenize_path(path.attrib['d']))
                      for path in self.rois[roiname].paths]
+        return self._splines(path_strs)
 
+    def _splines(self, path_strs):
+        """Parses tokenized svg paths into lists of splines, in flipped (y up) svg units"""
         COMMANDS = set('MmZzLlHhVvCcSsQqTtAa')
         all_splines = [] #contains each hemisphere separately
 
@@ -510,95 +517,15 @@ class ROIpack(object):
         return all_splines
 
 
-    ###
-    # The get_roi function takes in an roi's name and returns an array indicating if every vertex is or isn't in that roi
-    # The way it works is that it collapses all of the x-values of the vertex coordinates approximately around the roi to the same
-    # small value, making a vertical line left of the roi. Then, it stretches the line to the right again, but stops the coordinates if they
-    # hit either an roi boundary or the original vertex position. In other words, it increases the x-values of the coordinates to either
-    # those of the the nearest spline path or the original vertex coordinate, whichever has the closer x-value.
-    # This way, it keeps track of how many boundaries it hit, starting from the outside, going inward toward the the original vertex coordinate.
-    # An odd number of boundaries found before the vertex means 'outside' the region or 'False' in the array, and an even number of
-    # boundaries found before the vertex means 'inside' the region or 'True' in the array
-    #
-    # This is all implemented with 1d and nd arrays manipulations, so the math is very algebraic.
-    ###
-
     def get_roi(self, roiname):
-        vts = self.tcoords*self.svgshape # reverts tcoords from unit circle size to normal svg image format size  
-        all_splines = self.get_splines(roiname) #all_splines is a list of generally two roi paths, one for each hemisphere
-
-        vts_inside_region = np.zeros(vts.shape[0],dtype=bool) # ultimately what gets returned
-
-        for splines in all_splines: #retrieves path splines for each hemisphere separately
-            x0s = np.min(vts[:,0])*.98*np.ones(vts.shape[0])
-
-            # Only checks the vertices in a bounding box around the spline path.
-            # The splines are always within a convex shape whose corners are
-            # their svg command's end point and control points, so the box is their
-            # min and max X and Y coordinates.
-            beforeSplineRegionX = vts[:,0] < np.min([float(sp_i.smallestX()) for sp_i in splines])
-            beforeSplineRegionY = vts[:,1] < np.min([float(sp_i.smallestY()) for sp_i in splines])
-            afterSplineRegionX = vts[:,0] > np.max([float(sp_i.biggestX()) for sp_i in splines])
-            afterSplineRegionY = vts[:,1] > np.max([float(sp_i.biggestY()) for sp_i in splines])
-
-            found_vtxs = np.zeros(vts.shape[0],dtype=bool)
-            found_vtxs[beforeSplineRegionX] = True
-            found_vtxs[beforeSplineRegionY] = True
-            found_vtxs[afterSplineRegionX] = True
-            found_vtxs[afterSplineRegionY] = True
-            
-            vt_isx = np.vstack([x0s,vts[:,1]]).T #iterable coords, same x-value as each other, but at their old y-value positions
- 
-            vtx_is = vt_isx[~found_vtxs]
-
-            splines_xs = [] # stores the roi's splines
-            for i in range(len(splines)):
-                splines_xs.append(splines[i].allSplineXGivenY(vtx_is)) # gets all the splines' x-values for each y-value in the line we're checking
-
-            small_vts = vts[~found_vtxs,:]
-            small_vts_inside_region = vts_inside_region[~found_vtxs]
-            small_found_vtxs = found_vtxs[~found_vtxs]
-
-            # keeps stretching the vertical line to the right until all the points find their original vertex again            
-            while sum(small_found_vtxs) != len(small_found_vtxs):
-                closest_xs = np.Inf*np.ones(vtx_is.shape[0]) # starting marker for all vts are at Inf
-
-                for i in range(len(splines_xs)):
-                    spline_i_xs = splines_xs[i]
-                    if len(spline_i_xs.shape) == 1: # Line splines
-                        isGreaterThanVtx = spline_i_xs > vtx_is[:,0]
-                        isLessThanClosestX = spline_i_xs < closest_xs
-                        closest_xs[isGreaterThanVtx*isLessThanClosestX] = spline_i_xs[isGreaterThanVtx*isLessThanClosestX]
-                    else: # all other splines
-                        for j in range(spline_i_xs.shape[1]):
-                            isGreaterThanVtx = spline_i_xs[:,j] > vtx_is[:,0]
-                            isLessThanClosestX = spline_i_xs[:,j] < closest_xs
-                            closest_xs[isGreaterThanVtx*isLessThanClosestX] = spline_i_xs[isGreaterThanVtx*isLessThanClosestX,j]                    
-            
-                # checks if it's found the boundary or the original vertex
-                # it forgets about all the points in the line who've found their original vertex
-                # if it found a boundary, then flip the 'inside' flag to 'outside', and vice versa
-                
-                small_found_vtxsx = small_vts[~small_found_vtxs,0]<closest_xs
-                small_found_vtxs[~small_found_vtxs] = small_found_vtxsx
+        """Returns the indices of the vertices inside the paths of an roi, using
+        the even-odd rule over all of its paths."""
+        with instrument.span("svgroi.get_roi", roi=roiname, npts=len(self.tcoords)):
+            vts = self.tcoords*self.svgshape # reverts tcoords from unit circle size to normal svg image format size
+            edges = [_flatten_splines(splines) for splines in self.get_splines(roiname)]
+            inside = inside_edges(vts, np.vstack(edges + [np.zeros((0, 2, 2))]))
+            return np.nonzero(inside)[0] # output indices of vertices that are inside the roi
 
-                small_vts_inside_region[~small_found_vtxs] = True - small_vts_inside_region[~small_found_vtxs]
-                vtx_is[~small_found_vtxsx,0] = closest_xs[~small_found_vtxsx]
-                vtx_is = vtx_is[~small_found_vtxsx,:]        
-                
-                for i in range(len(splines_xs)):
-                    if len(splines_xs[i].shape) == 1:
-                        splines_xs[i] = splines_xs[i][~small_found_vtxsx]
-                    else:
-                        splines_xs[i] = splines_xs[i][~small_found_vtxsx,:]
-
-            vts_inside_region[~found_vtxs] = small_vts_inside_region # reverts shape back from small bounding box to whole brain shape
-
-            if sum(vts_inside_region) == len(vts_inside_region):
-                break
-
-        return np.nonzero(vts_inside_region)[0] # output indices of vertices that are inside the roi
-    
     @property
     def names(self):
         return list(self.rois.keys())
@@ -692,7 +619,8 @@ class ROIpack(object):
             d, idx = cKDTree(pts).query((x,y))
             nolabels.remove(cand[idx])
 
-        for roi, i in nolabels:
+        #place new labels in a stable order, so that the markup (and its rendering) can be cached
+        for roi, i in [c for c in candidates if c in nolabels]:
             x, y = roi.get_labelpos()[i]
             text = etree.SubElement(layer, "{%s}text"%svgns)
             text.text = roi.name
@@ -725,7 +653,7 @@ class ROI(object):
         if data.pop(0).lower() != "m":
             raise ValueError("Unknown path format")
         #offset = np.array([float(x) for x in data[1].split(',')])
-        offset = np.array(map(float, [data.pop(0), data.pop(0)]))
+        offset = np.array(list(map(float, [data.pop(0), data.pop(0)])))
         mode = "l"
         pts = [[offset[0], offset[1]]]
         
@@ -853,6 +781,291 @@ class ROI(object):
 ###################################################################################
 # SVG Helper functions
 ###################################################################################
+def _flatten_splines(splines, tol=1e-3):
+    """Flattens a list of splines into line segments, returned as an (n, 2, 2)
+    array of (start, end) points. Bezier curves are subdivided so that the
+    polyline stays within `tol` (in svg units) of the curve, using Wang's
+    bound on the second differences of the control points. Arcs are not
+    parsed fully (see ArcSpline), and are approximated by their chord."""
+    edges = []
+    for spline in splines:
+        if isinstance(spline, CubBezSpline):
+            ctl = np.array([spline.s, spline.c1, spline.c2, spline.e], dtype=float)
+        elif isinstance(spline, QuadBezSpline):
+            ctl = np.array([spline.s, spline.c, spline.e], dtype=float)
+        else:
+            ctl = np.array([spline.s, spline.e], dtype=float)
+
+        degree = len(ctl) - 1
+        nseg = 1
+        if degree > 1:
+            ddiff = np.sqrt(((ctl[:-2] - 2*ctl[1:-1] + ctl[2:])**2).sum(1)).max()
+            nseg = max(1, int(np.ceil(np.sqrt(degree * (degree - 1) / 8. * ddiff / tol))))
+
+        t = np.linspace(0, 1, nseg+1)[:,np.newaxis]
+        coefs = [1, 1] if degree == 1 else [1, 2, 1] if degree == 2 else [1, 3, 3, 1]
+        pts = sum(c * t**k * (1-t)**(degree-k) * p for k, (c, p) in enumerate(zip(coefs, ctl)))
+        edges.append(np.concatenate([pts[:-1,np.newaxis], pts[1:,np.newaxis]], axis=1))
+
+    if len(edges) == 0:
+        return np.zeros((0, 2, 2))
+    return np.vstack(edges)
+
+_textures = OrderedDict()
+_max_textures = 16
+
+def _parse_style(style):
+    items = [item.split(":", 1) for item in style.split(";") if ":" in item]
+    return dict((k.strip(), v.strip()) for k, v in items)
+
+def _parse_color(color, opacity=1.):
+    """Parses an svg color into an RGBA tuple, or None for no paint"""
+    if color is None or color == "none":
+        return None
+    match = re.match(r"rgb\(\s*([\d.]+)\s*,\s*([\d.]+)\s*,\s*([\d.]+)\s*\)", color)
+    if match is not None:
+        rgb = [float(c) / 255. for c in match.groups()]
+    else:
+        from matplotlib.colors import to_rgb
+        rgb = list(to_rgb(color))
+    return tuple(rgb) + (float(opacity),)
+
+def _parse_length(length):
+    """Converts an svg font size or stroke width into user units (px)"""
+    match = re.match(r"([-+\d.eE]+)\s*(px|pt|em)?", length)
+    value = float(match.group(1))
+    return value * dict(px=1., pt=4/3., em=16.).get(match.group(2), 1.)
+
+def _polylines(edges):
+    """Splits consecutive line segments into connected polylines"""
+    if len(edges) == 0:
+        return []
+    breaks = np.nonzero((edges[1:,0] != edges[:-1,1]).any(1))[0] + 1
+    return [np.vstack([seg[:,0], seg[-1:,1]]) for seg in np.split(edges, breaks)]
+
+def _parse_dasharray(dasharray):
+    """Parses an svg stroke-dasharray into a list of lengths, or None for solid lines"""
+    if dasharray is None or dasharray.strip() in ("", "none"):
+        return None
+    dashes = [_parse_length(d) for d in re.split(r"[\s,]+", dasharray.strip()) if d != ""]
+    if len(dashes) % 2 == 1:
+        dashes = dashes * 2
+    if sum(dashes) <= 0 or min(dashes) < 0:
+        return None
+    return dashes
+
+def _dash(line, dashes, offset=0.):
+    """Cuts a polyline into the pieces that are drawn by a dash pattern,
+    which starts `offset` into the pattern at the start of the line"""
+    cum = np.hstack([0, np.cumsum(np.sqrt((np.diff(line, axis=0)**2).sum(1)))])
+    at = lambda d: np.array([np.interp(d, cum, line[:,0]), np.interp(d, cum, line[:,1])])
+    bounds = np.cumsum([0] + list(dashes))
+    period = bounds[-1]
+    pieces = []
+    for start in np.arange(-(offset % period), cum[-1], period):
+        for on, off in zip(bounds[:-1:2] + start, bounds[1::2] + start):
+            on, off = max(on, 0), min(off, cum[-1])
+            if off > on:
+                inner = line[(cum > on) & (cum < off)]
+                pieces.append(np.vstack([at(on), inner, at(off)]))
+    return pieces
+
+class _Canvas(object):
+    """Premultiplied RGBA float image that svg elements are composited onto"""
+    def __init__(self, shape):
+        self.shape = shape
+        self.image = np.zeros(shape+(4,), dtype=np.float32)
+
+    def _bounds(self, lo, hi, pad=1):
+        lo = np.clip(np.floor(lo - pad).astype(int), 0, self.shape[::-1])
+        hi = np.clip(np.ceil(hi + pad).astype(int), 0, self.shape[::-1])
+        return lo, hi
+
+    def paint(self, alpha, color, offset):
+        """Composites a coverage mask with the given color over the canvas"""
+        x, y = offset
+        region = self.image[y:y+alpha.shape[0], x:x+alpha.shape[1]]
+        a = alpha[..., np.newaxis] * color[3]
+        region *= 1 - a
+        region += a * (tuple(color[:3]) + (1,))
+
+    def fill(self, edges, color):
+        """Fills the even-odd interior of a set of line segments, given in pixels"""
+        lo, hi = self._bounds(edges.reshape(-1, 2).min(0), edges.reshape(-1, 2).max(0))
+        if (hi <= lo).any():
+            return
+        x, y = np.mgrid[lo[0]:hi[0], lo[1]:hi[1]]
+        centers = np.column_stack([x.ravel() + .5, y.ravel() + .5])
+        alpha = inside_edges(centers, edges).reshape(x.shape).T.astype(np.float32)
+        self.paint(alpha, color, lo)
+
+    def stroke(self, edges, color, width, dashes=None, offset=0., supersample=4):
+        """Draws line segments (in pixels) of the given width, antialiased by
+        supersampling. With `dashes`, each polyline is drawn with that dash
+        pattern, starting `offset` pixels into it."""
+        from PIL import Image, ImageDraw
+        lo, hi = self._bounds(edges.reshape(-1, 2).min(0), edges.reshape(-1, 2).max(0), width + 1)
+        if (hi <= lo).any():
+            return
+        im = Image.new("L", tuple((hi - lo) * supersample), 0)
+        draw = ImageDraw.Draw(im)
+        lw = max(1, int(round(width * supersample)))
+        lines = _polylines(edges)
+        if dashes is not None:
+            lines = [piece for line in lines for piece in _dash(line, dashes, offset)]
+        for line in lines:
+            pts = (line - lo) * supersample
+            draw.line([tuple(p) for p in pts], fill=255, width=lw, joint="curve")
+        alpha = np.asarray(im, dtype=np.float32) / 255.
+        h, w = alpha.shape
+        alpha = alpha.reshape(h // supersample, supersample, w // supersample, supersample).mean((1, 3))
+        self.paint(alpha, color, lo)
+
+    def text(self, text, pos, color, size):
+        """Draws bold italic text centered on `pos`, in the style of roi labels"""
+        from PIL import Image, ImageDraw, ImageFont
+        from matplotlib import font_manager
+        props = font_manager.FontProperties(family="sans-serif", weight="bold", style="italic")
+        font = ImageFont.truetype(font_manager.findfont(props), max(1, int(round(size))))
+        x0, y0, x1, y1 = font.getbbox(text, anchor="ms")
+        lo, hi = self._bounds(np.array(pos) + (x0, y0), np.array(pos) + (x1, y1))
+        if (hi <= lo).any():
+            return
+        im = Image.new("L", tuple(hi - lo), 0)
+        ImageDraw.Draw(im).text(tuple(np.array(pos) - lo), text, fill=255, font=font, anchor="ms")
+        self.paint(np.asarray(im, dtype=np.float32) / 255., color, lo)
+
+    def composite(self, im, offset):
+        """Composites a float RGBA image over the canvas at pixel `offset`"""
+        x, y = int(round(offset[0])), int(round(offset[1]))
+        h, w = self.shape
+        crop = im[max(0, -y):h - y, max(0, -x):w - x]
+        if crop.size == 0:
+            return
+        x, y = max(x, 0), max(y, 0)
+        region = self.image[y:y+crop.shape[0], x:x+crop.shape[1]]
+        region *= 1 - crop[..., 3:]
+        region[..., :3] += crop[..., :3] * crop[..., 3:]
+        region[..., 3] += crop[..., 3]
+
+    def over(self, other, shadow=0):
+        """Composites another canvas over this one. With `shadow` > 0, a black
+        drop shadow blurred by that many pixels is drawn underneath it."""
+        alpha = other.image[..., 3]
+        rows, cols = np.nonzero(alpha.any(1))[0], np.nonzero(alpha.any(0))[0]
+        if len(rows) == 0:
+            return
+        pad = int(np.ceil(3 * shadow))
+        y0, y1 = max(rows[0] - pad, 0), rows[-1] + pad + 1
+        x0, x1 = max(cols[0] - pad, 0), cols[-1] + pad + 1
+        region, src = self.image[y0:y1, x0:x1], other.image[y0:y1, x0:x1]
+        if shadow > 0:
+            from scipy.ndimage import gaussian_filter
+            blur = gaussian_filter(src[..., 3], shadow)
+            region *= 1 - blur[..., np.newaxis]
+            region[..., 3] += blur
+        region *= 1 - src[..., 3:]
+        region += src
+
+    def rgba(self):
+        """Returns the canvas as an 8-bit, non-premultiplied RGBA image"""
+        alpha = self.image[..., 3:]
+        rgb = np.where(alpha > 0, self.image[..., :3] / np.maximum(alpha, 1e-8), 0)
+        return (np.concatenate([rgb, alpha], axis=-1).clip(0, 1) * 255).round().astype(np.uint8)
+
+def _decode_png(data, size):
+    """Decodes a base64 png into a float RGBA array resized to `size` (w, h)"""
+    import base64
+    from PIL import Image
+    im = Image.open(io.BytesIO(base64.b64decode(data))).convert("RGBA")
+    size = tuple(max(1, int(round(s))) for s in size)
+    return np.asarray(im.resize(size, Image.BILINEAR), dtype=np.float32) / 255.
+
+def _render(pack, svg, texres, background=None):
+    """Rasterizes the paths and text of an svg into an RGBA array of height
+    `texres`. Supports the subset of svg that pycortex writes into overlays:
+    paths with fill and stroke colors, embedded png images, text labels, the
+    dropshadow filter, dash patterns, clip paths on layers and hidden elements."""
+    w, h = pack.svgshape
+    scale = texres / float(h)
+    shape = int(round(texres)), int(round(w * scale))
+    canvas = _Canvas(shape)
+    if background is not None:
+        canvas.composite(_decode_png(background, shape[::-1]), (0, 0))
+
+    root = svg.getroot()
+    blur = root.find(".//{%s}feGaussianBlur"%svgns)
+    shadow = float(blur.get("stdDeviation", 0)) * scale if blur is not None else 0
+
+    def hidden(elem):
+        return "display:none" in elem.get("style", "").replace(" ", "")
+
+    def edges_of(pathdef):
+        splines = pack._splines([list(_tokenize_path(pathdef))])[0]
+        edges = _flatten_splines(splines, tol=.1 / scale)
+        edges[..., 1] = h - edges[..., 1]
+        return edges * scale
+
+    def draw(elem, target):
+        if hidden(elem):
+            return
+        if shadow > 0 and elem.get("filter") is not None:
+            #filtered elements are drawn separately, so the shadow covers both fill and stroke
+            layer = _Canvas(shape)
+            draw_elem(elem, layer)
+            target.over(layer, shadow)
+        else:
+            draw_elem(elem, target)
+
+    def draw_elem(elem, target):
+        style = _parse_style(elem.get("style", ""))
+        if elem.tag == "{%s}path"%svgns:
+            edges = edges_of(elem.get("d"))
+            if len(edges) == 0:
+                return
+            fill = _parse_color(style.get("fill", "black"), style.get("fill-opacity", 1))
+            if fill is not None and fill[3] > 0:
+                target.fill(edges, fill)
+            stroke = _parse_color(style.get("stroke", "none"), style.get("stroke-opacity", 1))
+            width = _parse_length(style.get("stroke-width", "1")) * scale
+            if stroke is not None and stroke[3] > 0 and width > 0:
+                dashes = _parse_dasharray(style.get("stroke-dasharray"))
+                if dashes is not None:
+                    dashes = [d * scale for d in dashes]
+                offset = _parse_length(style.get("stroke-dashoffset", "0")) * scale
+                target.stroke(edges, stroke, width, dashes=dashes, offset=offset)
+        elif elem.tag == "{%s}image"%svgns:
+            href = elem.get("{http://www.w3.org/1999/xlink}href", "")
+            if href.startswith("data:image/png;base64,"):
+                x, y = float(elem.get("x", 0)) * scale, float(elem.get("y", 0)) * scale
+                size = float(elem.get("width")) * scale, float(elem.get("height")) * scale
+                target.composite(_decode_png(href[22:], size), (x, y))
+        elif elem.tag == "{%s}text"%svgns and elem.text:
+            color = _parse_color(style.get("fill", "black"), style.get("fill-opacity", 1))
+            size = _parse_length(style.get("font-size", "16px")) * scale
+            pos = float(elem.get("x")) * scale, float(elem.get("y")) * scale
+            if color is not None:
+                target.text(elem.text, pos, color, size)
+        else:
+            for child in elem:
+                draw(child, target)
+
+    for layer in root.findall("{%s}g"%svgns):
+        if hidden(layer):
+            continue
+        target = _Canvas(shape)
+        draw(layer, target)
+        clip = re.match(r"url\(#(.*)\)", layer.get("clip-path", ""))
+        if clip is not None:
+            clippath = root.find(".//*[@id='%s']/{%s}path"%(clip.group(1), svgns))
+            if clippath is not None:
+                mask = _Canvas(shape)
+                mask.fill(edges_of(clippath.get("d")), (1, 1, 1, 1))
+                target.image *= mask.image[..., 3:]
+        canvas.over(target)
+
+    return canvas.rgba()
+
 def _find_layer(svg, label):
     layers = [l for l in svg.findall("//{%s}g[@{%s}label]"%(svgns, inkns)) if l.get("{%s}label"%inkns) == label]
     if len(layers) < 1:
@@ -982,7 +1195,7 @@ def make_svg(pts, polys):
     pts[:,1] = 1024 - pts[:,1]
     path = ""
     polyiter = trace_poly(boundary_edges(polys))
-    for poly in [polyiter.next(), polyiter.next()]:
+    for poly in [next(polyiter), next(polyiter)]:
         path +="M%f %f L"%tuple(pts[poly.pop(0), :2])
         path += ', '.join(['%f %f'%tuple(pts[p, :2]) for p in poly])
         path += 'Z '
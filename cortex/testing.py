@@ -0,0 +1,206 @@
+"""Synthetic subjects, for testing and profiling pycortex without a real filestore.
+
+`make_subject` writes a complete subject into a filestore: pia, wm, fiducial,
+inflated and flat surfaces for both hemispheres, a reference volume with a
+transform, and an rois.svg with a handful of closed ROIs. Each hemisphere is a
+bumpy sphere with `nverts` vertices. The flatmap is an azimuthal equidistant
+projection around the lateral pole, with the medial cap cut away.
+
+`synthetic_subject` creates one in a temporary filestore and points the
+database at it::
+
+    with cortex.testing.synthetic_subject(nverts=40000) as subject:
+        mapper = cortex.get_mapper(subject, "synthxfm")
+"""
+import os
+import json
+import shutil
+import tempfile
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import numpy as np
+
+XFMNAME = "synthxfm"
+
+#ROI centers, as (radius, angle) around the lateral pole of each flatmap
+ROIS = OrderedDict([("V1", (0.7, 0.)), ("V2", (0.4, 0.)), ("MT", (0.45, 0.5*np.pi)),
+    ("FEF", (0.45, np.pi)), ("AC", (0.6, 1.5*np.pi))])
+
+def sphere(nverts):
+    """Triangulated unit sphere with `nverts` evenly spaced vertices, from the
+    convex hull of a Fibonacci lattice. Faces are oriented outwards."""
+    from scipy.spatial import ConvexHull
+    i = np.arange(nverts) + 0.5
+    z = 1 - 2 * i / nverts
+    r = np.sqrt(1 - z**2)
+    phi = np.pi * (3 - np.sqrt(5)) * i
+    pts = np.c_[r * np.cos(phi), r * np.sin(phi), z]
+
+    polys = ConvexHull(pts).simplices
+    a, b, c = pts[polys].transpose(1, 0, 2)
+    flip = (np.cross(b - a, c - a) * a).sum(1) < 0
+    polys[flip] = polys[flip][:, ::-1]
+    return pts, polys
+
+def _bumps(pts, rng, n=12, scale=0.08):
+    """Smooth random radial displacement, so that curvature is not constant"""
+    dirs = rng.randn(n, 3)
+    dirs /= np.sqrt((dirs**2).sum(1))[:, np.newaxis]
+    return 1 + scale * np.cos(4 * np.dot(pts, dirs.T)).mean(1)
+
+def _cut(polys, keep):
+    """Faces with all vertices in `keep`, shrunk until the boundary is a single
+    simple loop (no vertex is shared by two stretches of the boundary)"""
+    from .polyutils import boundary_edges
+    polys = polys[keep[polys].all(1)]
+    while True:
+        counts = np.bincount(boundary_edges(polys).ravel(), minlength=len(keep))
+        pinched = counts > 2
+        if not pinched.any():
+            return polys
+        polys = polys[~pinched[polys].any(1)]
+
+def _rotation(rng, angle):
+    """Random rotation about each axis of up to `angle` radians"""
+    rot = np.eye(3)
+    for i, theta in enumerate(rng.uniform(-angle, angle, 3)):
+        j, k = [a for a in range(3) if a != i]
+        r = np.eye(3)
+        r[[j, j, k, k], [j, k, j, k]] = np.cos(theta), -np.sin(theta), np.sin(theta), np.cos(theta)
+        rot = np.dot(r, rot)
+    return rot
+
+def _circle(cx, cy, r):
+    """SVG path of a circle, as four cubic bezier arcs"""
+    k = 0.5523 * r
+    return ("M %f,%f C %f,%f %f,%f %f,%f C %f,%f %f,%f %f,%f "
+            "C %f,%f %f,%f %f,%f C %f,%f %f,%f %f,%f Z")%(
+        cx + r, cy,
+        cx + r, cy + k, cx + k, cy + r, cx, cy + r,
+        cx - k, cy + r, cx - r, cy + k, cx - r, cy,
+        cx - r, cy - k, cx - k, cy - r, cx, cy - r,
+        cx + k, cy - r, cx + r, cy - k, cx + r, cy)
+
+def make_subject(filestore, subject="synth", nverts=10000, xfmname=XFMNAME,
+                 shape=(52, 32, 32), voxsize=3., radius=30., cut=0.75*np.pi,
+                 rois=ROIS, seed=0):
+    """Writes a synthetic subject into `filestore`.
+
+    Parameters
+    ----------
+    filestore : str
+        Filestore directory to write the subject into
+    subject : str, optional
+        Name of the subject
+    nverts : int, optional
+        Number of vertices per hemisphere. Real subjects have 100k to 300k.
+    xfmname : str, optional
+        Name of the transform to the reference volume
+    shape : tuple, optional
+        Shape of the reference volume, in (x, y, z) voxels
+    voxsize : float, optional
+        Size of the voxels of the reference volume, in mm
+    radius : float, optional
+        Radius of the white matter surface of each hemisphere, in mm
+    cut : float, optional
+        Vertices further than `cut` radians from the lateral pole form the
+        medial wall, which is cut from the flatmap
+    rois : dict, optional
+        ROI centers, as (radius, angle) around the lateral pole of each
+        flatmap, with the radius relative to that of the flatmap
+    seed : int, optional
+        Seed for the surface bumps, the transform and the reference volume
+
+    Returns
+    -------
+    subject : str
+        Name of the subject
+    """
+    import nibabel
+    from lxml import etree
+    from . import svgroi
+
+    rng = np.random.RandomState(seed)
+    path = os.path.join(filestore, subject)
+    for dirname in ["surfaces", "transforms", "cache"]:
+        os.makedirs(os.path.join(path, dirname))
+
+    unit, polys = sphere(nverts)
+    bumps = radius * _bumps(unit, rng)[:, np.newaxis]
+    flats = []
+    for hemi, side in [("lh", -1), ("rh", 1)]:
+        center = np.array([side * (radius + 5), 0, 0])
+        surfs = dict(wm=center + unit * bumps, pia=center + unit * (bumps + 3),
+            inflated=center * 1.5 + unit * radius * 1.3)
+        surfs['fiducial'] = (surfs['wm'] + surfs['pia']) / 2
+
+        #angle from the lateral pole, and around it, mirrored between hemispheres
+        theta = np.arccos(np.clip(side * unit[:, 0], -1, 1))
+        phi = np.arctan2(unit[:, 2], side * unit[:, 1])
+        fpolys = _cut(polys, theta <= cut)
+        rho = radius * np.minimum(theta, cut)
+        surfs['flat'] = np.c_[rho * np.cos(phi), rho * np.sin(phi), np.zeros(len(rho))]
+        flats.append((surfs['flat'], fpolys))
+
+        for name, pts in surfs.items():
+            fname = os.path.join(path, "surfaces", "%s_%s.npz"%(name, hemi))
+            np.savez(fname, pts=pts, polys=fpolys if name == "flat" else polys)
+
+    #reference volume centered on the brain, with a random rigid transform
+    affine = np.diag([voxsize, voxsize, voxsize, 1.])
+    affine[:3, -1] = -voxsize * (np.array(shape) - 1) / 2.
+    rigid = np.eye(4)
+    rigid[:3, :3] = _rotation(rng, np.pi / 18)
+    rigid[:3, -1] = rng.uniform(-voxsize, voxsize, 3)
+    coord = np.dot(np.linalg.inv(affine), rigid)
+
+    xfmdir = os.path.join(path, "transforms", xfmname)
+    os.makedirs(xfmdir)
+    data = rng.rand(*shape).astype(np.float32)
+    nibabel.save(nibabel.Nifti1Image(data, affine), os.path.join(xfmdir, "reference.nii.gz"))
+    with open(os.path.join(xfmdir, "matrices.xfm"), "w") as fp:
+        json.dump(dict(coord=coord.tolist(), magnet=np.dot(affine, coord).tolist()), fp,
+            sort_keys=True, indent=4)
+
+    #rois are circles on the merged and nudged flatmap, as seen by get_overlay
+    (lflat, lpolys), (rflat, rpolys) = flats
+    poles = np.array([[-lflat[:, 0].max(), 0], [-rflat[:, 0].min(), 0]])
+    flat = np.vstack([lflat + [poles[0, 0], 0, 0], rflat + [poles[1, 0], 0, 0]])
+    svg = etree.fromstring(svgroi.make_svg(flat, np.vstack([lpolys, rpolys + len(lflat)])).encode())
+    scale = 1024 / (flat.max(0) - flat.min(0))[1]
+    disk = radius * cut
+    layer = svg.find(".//{%s}g[@id='roilayer']"%svgroi.svgns)
+    for name, (r, angle) in rois.items():
+        group = etree.SubElement(layer, "{%s}g"%svgroi.svgns)
+        group.attrib["{%s}label"%svgroi.inkns] = name
+        for pole, side in zip(poles, [-1, 1]):
+            center = pole + disk * r * np.array([side * np.cos(angle), np.sin(angle)])
+            cx, cy = (center - flat.min(0)[:2]) * scale
+            element = etree.SubElement(group, "{%s}path"%svgroi.svgns)
+            element.attrib['d'] = _circle(cx, 1024 - cy, 0.12 * disk * scale)
+            element.attrib['style'] = "fill:none;stroke:#ffffff;stroke-width:2"
+    with open(os.path.join(path, "rois.svg"), "wb") as fp:
+        fp.write(etree.tostring(svg, pretty_print=True))
+
+    return subject
+
+@contextmanager
+def synthetic_subject(subject="synth", filestore=None, **kwargs):
+    """Writes a synthetic subject with `make_subject`, and points the database
+    at its filestore for the duration of the block. Without a `filestore`, a
+    temporary one is created and removed afterwards."""
+    from .database import db
+    tmpdir = tempfile.mkdtemp() if filestore is None else None
+    path = filestore if filestore is not None else tmpdir
+    saved = db.filestore, db._subjects
+    try:
+        make_subject(path, subject=subject, **kwargs)
+        db.filestore, db._subjects = path, None
+        db.surfcache.clear()
+        yield subject
+    finally:
+        db.filestore, db._subjects = saved
+        db.surfcache.clear()
+        if tmpdir is not None:
+            shutil.rmtree(tmpdir)
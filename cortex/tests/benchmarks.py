@@ -0,0 +1,214 @@
+"""Benchmarks for the projection and rendering hot paths.
+
+The benchmarks run offline, against a synthetic subject from `cortex.testing`
+that is written into a temporary filestore. Each benchmark reports its wall time and the peak memory traced by
+tracemalloc, and is optionally compared against a baseline saved by a
+previous run::
+
+    python -m cortex.tests.benchmarks --save baseline.json
+    python -m cortex.tests.benchmarks --baseline baseline.json
+
+The comparison exits with a non-zero status if any benchmark is slower, or
+uses more memory, than the baseline by more than the tolerance.
+"""
+import os
+import re
+import gc
+import sys
+import json
+import time
+import argparse
+import platform
+import multiprocessing
+import tracemalloc
+from collections import OrderedDict
+
+import numpy as np
+import scipy
+
+from ..testing import synthetic_subject, XFMNAME
+
+SAMPLERS = ("nearest", "trilinear", "gaussian", "lanczos")
+
+def measure(func):
+    """Runs `func` once, returning its result, the wall time in seconds and the
+    peak memory allocated during the call in MB. Memory allocated outside of
+    python and numpy, such as inside the OpenCTM library, is not counted."""
+    gc.collect()
+    tracemalloc.start()
+    try:
+        tic = time.time()
+        result = func()
+        elapsed = time.time() - tic
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, elapsed, peak / 2.**20
+
+benchmarks = OrderedDict()
+def benchmark(name, setup=None):
+    """Registers a benchmark. `setup` is called with the context before the
+    benchmark, outside of the measurement"""
+    def register(func):
+        benchmarks[name] = func, setup
+        return func
+    return register
+
+@benchmark("import cortex")
+def _bench_import(ctx):
+    #a fresh interpreter, so this includes its startup; the child's memory is not traced
+    import subprocess
+    return subprocess.check_call([sys.executable, "-W", "ignore", "-c", "import cortex"])
+
+def _flatcache(ctx):
+    from .. import quickflat
+    quickflat.get_flatmask(ctx.subject, height=ctx.height)
+    quickflat.get_flatcache(ctx.subject, XFMNAME, height=ctx.height)
+
+for _sampler in SAMPLERS:
+    @benchmark("get_mapper[%s]"%_sampler)
+    def _bench_mapper(ctx, sampler=_sampler):
+        from .. import utils
+        return utils.get_mapper(ctx.subject, XFMNAME, sampler, recache=True)
+
+@benchmark("Mapper.__call__[volume]")
+def _bench_map_volume(ctx):
+    return ctx.mapper(ctx.volume)
+
+@benchmark("Mapper.__call__[movie]")
+def _bench_map_movie(ctx):
+    return ctx.mapper(ctx.movie)
+
+@benchmark("_make_pixel_cache")
+def _bench_pixel_cache(ctx):
+    from .. import quickflat
+    return quickflat._make_pixel_cache(ctx.subject, XFMNAME, height=ctx.height)
+
+@benchmark("quickflat.make[volume]", setup=_flatcache)
+def _bench_make_volume(ctx):
+    from .. import quickflat
+    return quickflat.make(ctx.volume, height=ctx.height)
+
+@benchmark("quickflat.make[movie]", setup=_flatcache)
+def _bench_make_movie(ctx):
+    from .. import quickflat
+    return quickflat.make(ctx.movie, height=ctx.height)
+
+@benchmark("ROIpack.get_roi")
+def _bench_get_roi(ctx):
+    return [ctx.rois.get_roi(name) for name in ctx.rois.names]
+
+@benchmark("Surface.geodesic_distance")
+def _bench_geodesic(ctx):
+    from ..polyutils import Surface
+    surf = Surface(*ctx.db.get_surf(ctx.subject, "fiducial", "lh"))
+    return surf.geodesic_distance([0])
+
+@benchmark("Surface.smooth")
+def _bench_smooth(ctx):
+    from ..polyutils import Surface
+    pts, polys = ctx.db.get_surf(ctx.subject, "fiducial", "lh")
+    surf = Surface(pts, polys)
+    return surf.smooth(ctx.scalars[:len(pts)], factor=10, iterations=5)
+
+@benchmark("BrainCTM.save")
+def _bench_ctm(ctx):
+    from .. import brainctm
+    outfile = os.path.join(ctx.db.get_cache(ctx.subject), "bench.json")
+    return brainctm.make_pack(outfile, ctx.subject, types=("inflated",), method='mg2', level=9)
+
+class _Context(object):
+    """Inputs shared by the benchmarks, built outside of the timed calls"""
+    def __init__(self, subject, height=1024, ntimes=100, seed=0):
+        from ..database import db
+        from ..dataset import Volume
+        from .. import utils
+        self.db = db
+        self.subject = subject
+        self.height = height
+        rng = np.random.RandomState(seed)
+        shape = db.get_xfm(subject, XFMNAME).shape
+        self.volume = Volume(rng.randn(*shape).astype(np.float32), subject, XFMNAME)
+        self.movie = Volume(rng.randn(ntimes, *shape).astype(np.float32), subject, XFMNAME)
+        self.mapper = utils.get_mapper(subject, XFMNAME, "nearest")
+        self.scalars = rng.randn(self.mapper.nverts)
+        self.rois = db.get_overlay(subject)
+
+def run(nverts=10000, height=1024, ntimes=100, pattern=None, verbose=True):
+    """Runs the benchmarks whose names match the regular expression `pattern`
+    against a synthetic subject with `nverts` vertices per hemisphere,
+    returning a dictionary of results"""
+    results = OrderedDict()
+    with synthetic_subject(nverts=nverts) as subject:
+        ctx = _Context(subject, height=height, ntimes=ntimes)
+        for name, (func, setup) in benchmarks.items():
+            if pattern is not None and re.search(pattern, name) is None:
+                continue
+            if setup is not None:
+                setup(ctx)
+            _, elapsed, peak = measure(lambda: func(ctx))
+            results[name] = dict(time=elapsed, memory=peak)
+            if verbose:
+                print("%-30s %10.3f s %10.1f MB"%(name, elapsed, peak))
+
+    info = dict(vertices=nverts, height=height, ntimes=ntimes,
+        python=platform.python_version(), numpy=np.__version__, scipy=scipy.__version__,
+        system=platform.system(), machine=platform.machine(),
+        processor=platform.processor(), cpus=multiprocessing.cpu_count())
+    return dict(info=info, host=platform.node(), results=results)
+
+def compare(results, baseline, tolerance=1.25):
+    """Lists the benchmarks that took longer, or used more memory, than
+    `tolerance` times their baseline. Runs are compared on their settings,
+    hardware and software; the host names are only reported."""
+    if baseline.get('host') != results.get('host'):
+        print("Comparing against a baseline recorded on %s"%baseline.get('host'))
+    #older baselines kept the host name in the info
+    keys = set(baseline['info']) | set(results['info'])
+    keys.discard('node')
+    diff = sorted(k for k in keys if baseline['info'].get(k) != results['info'].get(k))
+    if len(diff) > 0:
+        print("Warning: baseline was recorded with different settings (%s)"%', '.join(diff))
+
+    regressions = []
+    print("%-30s %10s %10s"%("", "time", "memory"))
+    for name, result in results['results'].items():
+        if name not in baseline['results']:
+            continue
+        base = baseline['results'][name]
+        tratio = result['time'] / max(base['time'], 1e-6)
+        mratio = result['memory'] / max(base['memory'], 1e-6)
+        flag = ""
+        if tratio > tolerance or mratio > tolerance:
+            regressions.append(name)
+            flag = "REGRESSION"
+        print("%-30s %9.2fx %9.2fx %s"%(name, tratio, mratio, flag))
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pycortex projection and rendering paths")
+    parser.add_argument("-n", "--nverts", type=int, default=10000,
+        help="number of vertices per hemisphere of the synthetic subject")
+    parser.add_argument("--height", type=int, default=1024, help="flatmap height in pixels")
+    parser.add_argument("--ntimes", type=int, default=100, help="number of volumes in the movie")
+    parser.add_argument("-k", "--pattern", default=None, help="only run benchmarks matching this regex")
+    parser.add_argument("--save", default=None, help="save the results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="compare against this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.25,
+        help="ratio over the baseline that counts as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(nverts=args.nverts, height=args.height, ntimes=args.ntimes,
+        pattern=args.pattern)
+    if args.save is not None:
+        with open(args.save, "w") as fp:
+            json.dump(results, fp, indent=4)
+    if args.baseline is not None:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if len(compare(results, baseline, tolerance=args.tolerance)) > 0:
+            return 1
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,22 @@
+import copy
+
+from cortex.tests import benchmarks
+
+def test_benchmarks(capsys):
+    results = benchmarks.run(nverts=1000, height=128, ntimes=4, verbose=False)
+    assert list(results['results']) == list(benchmarks.benchmarks)
+    assert benchmarks.compare(results, results) == []
+
+    #another host with the same hardware and software is comparable
+    baseline = copy.deepcopy(results)
+    baseline['host'] = "elsewhere"
+    capsys.readouterr()
+    assert benchmarks.compare(results, baseline) == []
+    out = capsys.readouterr().out
+    assert "elsewhere" in out and "Warning" not in out
+
+    baseline['info']['numpy'] = "0.0"
+    for result in baseline['results'].values():
+        result['time'] /= 10.
+    assert benchmarks.compare(results, baseline) == list(benchmarks.benchmarks)
+    assert "different settings (numpy)" in capsys.readouterr().out
@@ -0,0 +1,36 @@
+import numpy as np
+import cortex
+
+def test_surfcache():
+    db = cortex.db
+    db.surfcache.clear()
+    pts, polys = db.get_surf("S1", "inflated", merge=True, nudge=True)
+    hits = db.surfcache.hits
+    pts2, polys2 = db.get_surf("S1", "inflated", merge=True, nudge=True)
+    assert pts2 is pts and db.surfcache.hits == hits + 1
+    assert not pts.flags.writeable
+
+    left, right = db.get_surf("S1", "inflated")
+    assert np.allclose(pts[:len(left[0]),0], left[0][:,0] - left[0][:,0].max())
+
+def test_get_paths_index():
+    import os
+    import shutil
+    import tempfile
+    from cortex.database import Database
+
+    filestore = tempfile.mkdtemp()
+    try:
+        for dirname in ["surfaces", "transforms"]:
+            os.makedirs(os.path.join(filestore, "subj", dirname))
+        open(os.path.join(filestore, "subj", "surfaces", "flat_lh.gii"), "w").close()
+        db = Database(filestore)
+
+        paths = db.get_paths("subj")
+        assert list(paths['surfs']) == ["flat"] and paths['xfms'] == []
+        os.makedirs(os.path.join(filestore, "subj", "transforms", "xfm"))
+        assert db.get_paths("subj")['xfms'] == ["xfm"]
+        db.refresh_paths("subj")
+        assert db.get_paths("subj", refresh=True)['surfs']['flat']['lh'].endswith("flat_lh.gii")
+    finally:
+        shutil.rmtree(filestore)
@@ -176,3 +176,12 @@ def test_volumedata_copy_with_custom_mask():
     v = cortex.Volume(data, subj, xfmname, mask=mask)
     vc = v.copy(v.data)
     assert np.allclose(v.data, vc.data)
+
+def test_vertex_smooth():
+    from cortex import testing
+    with testing.synthetic_subject(nverts=2000) as subject:
+        movie = cortex.Vertex(np.random.randn(5, 4000), subject)
+        smoothed = movie.smooth(6, chunksize=2)
+        assert smoothed.data.shape == (5, 4000) and smoothed.data.std() < movie.data.std()
+        single = movie[3].smooth(6)
+        assert np.allclose(single.data, smoothed.data[3], atol=1e-5)
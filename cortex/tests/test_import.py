@@ -0,0 +1,19 @@
+import sys
+import json
+import subprocess
+
+script = """
+import sys, json
+import cortex
+print(json.dumps(dict(modules=sorted(sys.modules))))
+"""
+
+def _import_cortex():
+    out = subprocess.check_output([sys.executable, "-W", "ignore", "-c", script])
+    return json.loads(out.decode().strip().split("\n")[-1])
+
+def test_lazy_imports():
+    modules = set(_import_cortex()['modules'])
+    for name in ["cortex.webgl", "cortex.quickflat", "cortex.mni", "cortex.align",
+                 "cortex.segment", "cortex.blender", "matplotlib", "tornado", "h5py"]:
+        assert name not in modules, "%s was imported by `import cortex`"%name
@@ -0,0 +1,37 @@
+import json
+import tempfile
+import numpy as np
+
+import cortex
+from cortex import instrument, testing
+
+def test_spans():
+    instrument.clear()
+    with testing.synthetic_subject(nverts=1000) as subject:
+        shape = cortex.db.get_xfm(subject, testing.XFMNAME).shape
+        vol = cortex.Volume(np.random.randn(*shape), subject, testing.XFMNAME)
+        cortex.quickflat.make(vol, height=64)
+        assert instrument.get_spans() == []
+
+        instrument.enable()
+        try:
+            cortex.quickflat.make(vol, height=64)
+            cortex.quickflat.make(vol, height=64, recache=True)
+        finally:
+            instrument.disable()
+
+    spans = instrument.get_spans()
+    caches = [s for s in spans if s['name'] == "quickflat.get_flatcache"]
+    assert [s['args']['hit'] for s in caches] == [True, False]
+    assert caches[0]['args']['pixmap']['shape'][1] == np.prod(shape)
+    make = [s for s in spans if s['name'] == "quickflat.make"]
+    assert len(make) == 2 and all(s['depth'] == 0 for s in make)
+    assert instrument.summary()['quickflat.make']['count'] == 2
+
+    tf = tempfile.NamedTemporaryFile(suffix=".json")
+    instrument.save_trace(tf.name)
+    with open(tf.name) as fp:
+        trace = json.load(fp)
+    assert len(trace['traceEvents']) == len(spans)
+    assert all(e['ph'] == "X" and e['dur'] >= 0 for e in trace['traceEvents'])
+    instrument.clear()
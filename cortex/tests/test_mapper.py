@@ -0,0 +1,101 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from cortex.mapper import samplers
+
+shape = (7, 9, 11)
+
+def _csr(ijdata, n):
+    i, j, data = ijdata
+    return sparse.csr_matrix((data, (i, j)), shape=(n, np.prod(shape)))
+
+def test_lanczos_chunks():
+    coords = np.random.rand(100, 3) * [11, 9, 7]
+    coords[5] = np.nan
+    full = _csr(samplers.lanczos(coords, shape), len(coords))
+    chunked = _csr(samplers.lanczos(coords, shape, chunksize=7), len(coords))
+    assert abs(full - chunked).max() < 1e-12
+
+    rows = np.array(full.sum(1)).ravel()
+    assert rows[5] == 0
+    assert np.allclose(np.delete(rows, 5), 1)
+
+def test_gaussian_exact():
+    #a voxel center one voxel away from the edges should weigh the most
+    coords = np.array([[3., 4., 2.]])
+    mask = _csr(samplers.gaussian(coords, shape, sigma=1, window=2), 1)
+    center = np.ravel_multi_index((2, 4, 3), shape)
+    assert mask.toarray().argmax() == center
+    assert mask.nnz == 3**3
+
+def test_accumulate():
+    layers = [samplers.nearest(np.random.rand(50, 3) * [11, 9, 7], shape) for _ in range(10)]
+    csrshape = 50, np.prod(shape)
+    summed = sparse.csr_matrix(csrshape)
+    for i, j, data in layers:
+        summed = summed + sparse.csr_matrix((data, (i, j)), shape=csrshape)
+
+    assert abs(samplers.accumulate(layers, csrshape) - summed).max() == 0
+    assert abs(samplers.accumulate(layers, csrshape, chunk=3) - summed).max() == 0
+
+def test_mapper_call():
+    import cortex
+    from cortex import testing
+    from cortex.mapper import Mapper
+    with testing.synthetic_subject(nverts=500) as subject:
+        vshape = cortex.db.get_xfm(subject, testing.XFMNAME).shape
+        nvox = np.prod(vshape)
+        left = sparse.random(500, nvox, density=1e-3, format='csr', random_state=1)
+        right = sparse.random(500, nvox, density=1e-3, format='csr', random_state=2)
+        mapper = Mapper(left, right, vshape)
+
+        volume = np.random.randn(3, *vshape).astype(np.float32)
+        flat = volume.reshape(3, -1).T
+        full = mapper(cortex.Volume(volume, subject, testing.XFMNAME))
+        assert full.data.dtype == np.float32 and full.data.shape == (3, 1000)
+        assert np.allclose(full.data, np.hstack([(left * flat).T, (right * flat).T]), atol=1e-4)
+
+        #derived masks are built once per dtype and mask
+        mask = np.random.rand(*vshape) > .5
+        part = mapper(cortex.Volume(volume[:, mask], subject, testing.XFMNAME, mask=mask))
+        assert mapper._masks(np.float32, mask) is mapper._masks(np.float32, mask)
+        assert mapper._masks(np.float32) is mapper._masks(np.float32)
+        zeroed = mapper(cortex.Volume(volume * mask, subject, testing.XFMNAME))
+        assert np.allclose(part.data, zeroed.data, atol=1e-4)
+
+def test_savecache_race(monkeypatch):
+    import os
+    import shutil
+    import tempfile
+    import cortex.mapper as mapper
+    cachedir = tempfile.mkdtemp()
+    filename = os.path.join(cachedir, "xfm_pointnn")
+    left = sparse.random(5, 20, density=.2, format='csr', random_state=1)
+    right = sparse.random(6, 20, density=.2, format='csr', random_state=2)
+    mapper._savecache(filename, left, right, (2, 2, 5), key="old")
+
+    #another process places its cache between ours being written and renamed
+    rename = os.rename
+    def racing(src, dst):
+        if dst == filename and not racing.done:
+            racing.done = True
+            mapper._savecache(filename, left, right, (2, 2, 5), key="new")
+        return rename(src, dst)
+    racing.done = False
+    monkeypatch.setattr(os, "rename", racing)
+    try:
+        mapper._savecache(filename, left, right, (2, 2, 5), key="new")
+        assert mapper._cacheheader(filename)['key'] == "new"
+        assert os.listdir(cachedir) == ["xfm_pointnn"]
+
+        #a cache for other sources is not mistaken for ours
+        racing.done = False
+        with pytest.raises(OSError):
+            mapper._savecache(filename, left, right, (2, 2, 5), key="other")
+        assert mapper._cacheheader(filename)['key'] == "new"
+        assert os.listdir(cachedir) == ["xfm_pointnn"]
+        cached = mapper.Mapper.from_cache(filename)
+        assert (cached.masks[0] != left).nnz == 0
+    finally:
+        shutil.rmtree(cachedir)
@@ -0,0 +1,47 @@
+import os
+
+import numpy as np
+import pytest
+
+from cortex import mp
+
+def test_map_order():
+    data = np.random.RandomState(0).randn(1000)
+    result = mp.map(lambda x: x * 2, data, procs=2, chunksize=7)
+    assert np.allclose(result, data * 2)
+    assert mp.map(lambda x: x + 1, (i for i in range(100)), procs=2, chunksize=3) == list(range(1, 101))
+    assert mp.map(lambda x: x, [], procs=2) == []
+
+def test_worker_error():
+    def func(x):
+        if x == 13:
+            raise ValueError("unlucky")
+        return x
+    with pytest.raises(RuntimeError) as exc:
+        mp.map(func, range(100), procs=2, chunksize=5)
+    assert "unlucky" in str(exc.value)
+
+def test_input_error():
+    def gen():
+        yield 1
+        yield 2
+        raise KeyError("broken input")
+    with pytest.raises(KeyError):
+        mp.map(lambda x: x * 2, gen(), procs=2, chunksize=1)
+
+def test_pool_reuse():
+    with mp.Pool(lambda x: (x, os.getpid()), procs=2) as pool:
+        pids = set(proc.pid for proc in pool._workers)
+        first = pool.map(range(50), chunksize=5)
+        second = pool.map(range(50, 80), chunksize=5)
+        assert set(proc.pid for proc in pool._workers) == pids
+    assert [x for x, _ in first + second] == list(range(80))
+    assert set(pid for _, pid in first + second) <= pids
+    assert os.getpid() not in pids
+    assert len(pool._workers) == 0
+
+def test_serial():
+    with mp.Pool(lambda x: (x, os.getpid()), procs=1) as pool:
+        assert len(pool._workers) == 0
+        result = pool.map(range(10))
+    assert result == [(x, os.getpid()) for x in range(10)]
@@ -16,3 +16,76 @@ def test_surfpatch():
     subwm, subpia, subpolys = surf.extract_chunk(auxpts=pia)
     subsurf = polyutils.Surface(subwm, subpolys)
     return [patch for patch in subsurf.patches(n=0.5)]
+
+def test_factorization_cache():
+    from scipy import sparse
+    from cortex import testing
+    pts, polys = testing.sphere(2000)
+    surf = polyutils.Surface(pts * 30, polys, backend="superlu")
+    scalars = np.random.RandomState(0).randn(len(pts))
+
+    smoothed = surf.smooth(scalars, factor=5)
+    assert list(surf._factors) == [("smooth", 5)]
+    assert np.allclose(surf.smooth(scalars, factor=5), smoothed)
+    assert len(surf._factors) == 1
+
+    B, D, W, V = surf.laplace_operator
+    lfac = sparse.dia_matrix((D, [0]), D.shape * 2) - 5 * (W - V)
+    assert np.allclose(sparse.linalg.spsolve(lfac.tocsc(), D * scalars), smoothed)
+
+    dist = surf.geodesic_distance([0])
+    assert dist[0] == 0 and (dist[1:] > 0).all()
+    assert ("heat", 1.0, False) in surf._factors and ("laplace",) in surf._factors
+
+def test_batch_geodesic_distance():
+    from cortex import testing
+    pts, polys = testing.sphere(2000)
+    surf = polyutils.Surface(pts * 30, polys)
+    sources = [[0], [10, 500], 1500]
+    dists = surf.batch_geodesic_distance(sources, chunksize=2)
+    assert dists.shape == (3, len(pts)) and dists.dtype == np.float32
+    for verts, dist in zip(sources, dists):
+        assert np.allclose(dist, surf.geodesic_distance(np.atleast_1d(verts)), atol=1e-4)
+
+def test_dijkstra_distance():
+    from cortex import testing
+    pts, polys = testing.sphere(2000)
+    surf = polyutils.Surface(pts * 30, polys)
+    dist = surf.dijkstra_distance([0])
+    assert dist[0] == 0 and np.isfinite(dist).all()
+    #edge paths are never shorter than a straight line, and not much longer than the great circle
+    chord = 30 * np.sqrt(((pts - pts[0])**2).sum(1))
+    arc = 30 * np.arccos(np.clip(np.dot(pts, pts[0]), -1, 1))
+    assert (dist >= chord - 1e-6).all() and (dist < 1.3 * arc + 1e-6).all()
+
+    near = surf.dijkstra_distance([0], radius=10)
+    assert np.all(np.isinf(near[dist > 10])) and np.allclose(near[dist <= 10], dist[dist <= 10])
+
+    neighbors = surf.geodesic_neighborhoods([0, 100, 1000], 10, chunksize=2)
+    assert neighbors.shape == (3, len(pts))
+    assert set(neighbors[0].indices) == set(np.nonzero(dist <= 10)[0])
+    assert neighbors[1, 100] == 0 and 100 in neighbors[1].indices
+
+def test_smoothing_kernel():
+    from cortex import testing
+    pts, polys = testing.sphere(2000)
+    surf = polyutils.Surface(pts * 30, polys)
+    kernel = surf.smoothing_kernel(8)
+    assert kernel.shape == (len(pts), len(pts)) and kernel.dtype == np.float32
+    assert np.allclose(kernel.sum(1), 1)
+
+    noise = np.random.RandomState(0).randn(len(pts))
+    assert kernel.dot(noise).std() < 0.5 * noise.std()
+    assert np.allclose(kernel.dot(pts[:,2]), pts[:,2], atol=0.05)
+
+def test_face_difference():
+    from cortex.testing import sphere
+    pts, polys = sphere(2000)
+    keep = np.random.RandomState(0).rand(len(polys)) < 0.7
+    other = np.roll(polys[keep], 1, axis=1)
+    expected = set(map(tuple, polyutils.sort_polys(polys))) - set(map(tuple, polyutils.sort_polys(other)))
+    mwall = polyutils.face_difference(np.vstack([polys, polys[:10]]), other)
+    assert len(mwall) == len(expected) and set(map(tuple, mwall)) == expected
+    assert len(polyutils.face_difference(polys, polys)) == 0
+    #faces with the opposite orientation are distinct
+    assert len(polyutils.face_difference(polys, polys[:, ::-1])) == len(polys)
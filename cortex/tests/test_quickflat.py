@@ -6,3 +6,43 @@ def test_quickflat():
 	tf = tempfile.NamedTemporaryFile(suffix=".png")
 	view = cortex.Volume.random("S1", "fullhead", cmap="hot")
 	cortex.quickflat.make_png(tf.name, view)
+
+def test_flatmap_renderer():
+	tf = tempfile.NamedTemporaryFile(suffix=".png")
+	renderer = cortex.quickflat.FlatmapRenderer("S1", "fullhead", height=256)
+	view = cortex.Volume.random("S1", "fullhead", cmap="hot")
+	im = renderer.render(view)
+	assert im.shape == renderer.shape + (4,) and im.dtype == np.uint8
+	renderer.save(tf.name, view)
+
+def test_make_movie_stack():
+	view = cortex.Volume(np.random.randn(5, 31, 100, 100), "S1", "fullhead")
+	stack, extents = cortex.quickflat.make(view, height=128, chunksize=2)
+	assert stack.shape[0] == 5 and stack.dtype == np.float32
+	single, extents = cortex.quickflat.make(cortex.Volume(view.data[3], "S1", "fullhead"), height=128)
+	assert np.allclose(stack[3], single, equal_nan=True, atol=1e-5)
+
+def test_make_movie(monkeypatch):
+	import subprocess
+	class FakeEncoder(object):
+		def __init__(self, cmd, stdin=None):
+			self.cmd = cmd
+			self.frames = []
+			self.returncode = None
+			self.stdin = self
+			procs.append(self)
+		def write(self, frame):
+			self.frames.append(frame)
+		def close(self):
+			pass
+		def wait(self):
+			self.returncode = 0
+	procs = []
+	monkeypatch.setattr(subprocess, "Popen", FakeEncoder)
+	view = cortex.Volume(np.random.randn(4, 31, 100, 100), "S1", "fullhead")
+	cortex.quickflat.make_movie("movie.mp4", view, height=64, tr=2, fps=3, chunksize=2)
+	proc, = procs
+	w, h = map(int, proc.cmd[proc.cmd.index("-s") + 1].split("x"))
+	assert len(proc.frames) == (4 - 1) * 2 * 3 + 1
+	assert all(len(frame) == w * h * 4 for frame in proc.frames)
+	assert proc.cmd[-1] == "movie.mp4"
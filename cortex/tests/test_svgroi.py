@@ -0,0 +1,68 @@
+import tempfile
+import numpy as np
+
+from cortex import svgroi
+
+svgdata = """<svg xmlns="http://www.w3.org/2000/svg" xmlns:inkscape="http://www.inkscape.org/namespaces/inkscape" width="1000" height="500">
+<g inkscape:label="rois" inkscape:groupmode="layer">
+<g inkscape:label="V1"><path d="M 100,100 C 200,50 300,150 300,250 L 150,300 Z" style="fill:none"/></g>
+<g inkscape:label="V2"><path d="M 400,50 L 480,50 L 480,450 L 400,450 Z" style="fill:none"/><path d="M 420,100 L 460,100 L 460,200 L 420,200 Z" style="fill:none"/></g>
+</g></svg>"""
+
+def test_get_roi():
+    from matplotlib.path import Path
+    tf = tempfile.NamedTemporaryFile(suffix=".svg")
+    tf.write(svgdata.encode())
+    tf.flush()
+
+    pts = np.random.rand(100000, 2)
+    pack = svgroi.ROIpack(pts.copy(), tf.name)
+    vts = pack.tcoords * pack.svgshape
+
+    flip = lambda x, y: (x, 500 - y)
+    outer = Path([flip(400, 50), flip(480, 50), flip(480, 450), flip(400, 450), flip(400, 50)], closed=True)
+    hole = Path([flip(420, 100), flip(460, 100), flip(460, 200), flip(420, 200), flip(420, 100)], closed=True)
+    inside = outer.contains_points(vts) & ~hole.contains_points(vts)
+    assert np.array_equal(pack.get_roi("V2"), np.nonzero(inside)[0])
+
+    curve = Path([flip(100, 100), flip(200, 50), flip(300, 150), flip(300, 250), flip(150, 300), flip(100, 100)],
+        [Path.MOVETO, Path.CURVE4, Path.CURVE4, Path.CURVE4, Path.LINETO, Path.CLOSEPOLY])
+    inside = np.nonzero(curve.contains_points(vts))[0]
+    #allow for a few vertices on the flattened boundary
+    assert len(np.setxor1d(pack.get_roi("V1"), inside)) < 10
+
+def test_get_texture():
+    tf = tempfile.NamedTemporaryFile(suffix=".svg")
+    tf.write(svgdata.encode())
+    tf.flush()
+
+    pack = svgroi.ROIpack(np.random.rand(1000, 2), tf.name, linecolor=(1., 0, 0, 1.), linewidth=4)
+    im = pack.get_texture_array(250, labels=False)
+    assert im.shape == (250, 500, 4) and im.dtype == np.uint8
+    #the left edge of V2 is stroked, its hole and the background are empty
+    assert tuple(im[100, 200]) == (255, 0, 0, 255)
+    assert im[75, 220, 3] == 0 and im[10, 10, 3] == 0
+    assert np.array_equal(pack.get_texture_array(250, labels=False), im)
+
+def test_dashes():
+    line = np.array([[0., 0], [10, 0], [10, 10]])
+    pieces = svgroi._dash(line, [4, 2], offset=3)
+    assert len(pieces) == 4
+    assert np.allclose(pieces[0], [[0, 0], [1, 0]])
+    assert np.allclose(pieces[1], [[3, 0], [7, 0]])
+    #dashes follow the line around corners
+    assert np.allclose(pieces[2], [[9, 0], [10, 0], [10, 3]])
+    assert np.allclose(pieces[3], [[10, 5], [10, 9]])
+    assert svgroi._parse_dasharray("none") is None
+    assert svgroi._parse_dasharray("3") == [3., 3.] and svgroi._parse_dasharray("4, 2 1") == [4., 2., 1., 4., 2., 1.]
+
+    tf = tempfile.NamedTemporaryFile(suffix=".svg")
+    tf.write(svgdata.encode())
+    tf.flush()
+    pack = svgroi.ROIpack(np.random.rand(1000, 2), tf.name, linecolor=(1., 0, 0, 1.), linewidth=4,
+        dashtype=(10, 10), dashoffset=(0,))
+    im = pack.get_texture_array(250, labels=False)
+    #the left edge of V2 alternates between 5 pixel dashes and gaps
+    edge = im[40:210, 200, 3] > 128
+    assert 0.4 < edge.mean() < 0.6
+    assert (np.diff(edge.astype(int)) != 0).sum() > 20
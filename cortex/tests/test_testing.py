@@ -0,0 +1,67 @@
+import os
+
+import numpy as np
+
+import cortex
+from cortex import testing, polyutils
+
+def test_synthetic_subject():
+    with testing.synthetic_subject(nverts=2000) as subject:
+        assert subject in cortex.db.subjects
+        for surf in ["pia", "wm", "fiducial", "inflated", "flat"]:
+            left, right = cortex.db.get_surf(subject, surf)
+            assert len(left[0]) == len(right[0]) == 2000
+
+        #the flatmap is one disk per hemisphere, with the medial wall cut
+        pts, polys = cortex.db.get_surf(subject, "flat", merge=True, nudge=True)
+        bounds = list(polyutils.trace_poly(polyutils.boundary_edges(polys)))
+        assert len(bounds) == 2 and len(np.unique(polys)) < len(pts)
+
+        rois = cortex.db.get_overlay(subject)
+        assert rois.names == list(testing.ROIS)
+        assert all(len(rois.get_roi(name)) > 0 for name in rois.names)
+
+        mapper = cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        assert mapper.nverts == 4000 and mapper.mask.sum() > 0
+    assert subject not in cortex.db.subjects
+
+def test_mapper_cache_stamp(monkeypatch):
+    from cortex.mapper import point
+    calls = []
+    hashfunc = point.PointNN._hash.__func__
+    def counted(cls, *args, **kwargs):
+        calls.append(args)
+        return hashfunc(cls, *args, **kwargs)
+    monkeypatch.setattr(point.PointNN, "_hash", classmethod(counted))
+
+    with testing.synthetic_subject(nverts=500) as subject:
+        cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        cachefile = os.path.join(cortex.db.get_cache(subject), testing.XFMNAME+"_pointnn")
+        built = os.stat(os.path.join(cachefile, "left_data.npy")).st_mtime
+
+        #warm hits do not rehash the surfaces
+        cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        assert len(calls) == 0
+
+        #touching a source rehashes once, then trusts the new stamp
+        xfmfile = cortex.db.get_paths(subject)['xfmdir'].format(xfmname=testing.XFMNAME)
+        stat = os.stat(xfmfile)
+        os.utime(xfmfile, (stat.st_atime, stat.st_mtime + 10))
+        cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        cortex.get_mapper(subject, testing.XFMNAME, "nearest")
+        assert len(calls) == 1
+        assert os.stat(os.path.join(cachefile, "left_data.npy")).st_mtime == built
+
+def test_roi_index_readonly():
+    from cortex import utils
+    with testing.synthetic_subject(nverts=500) as subject:
+        verts, labelpos = utils.get_roi_index(subject)
+        assert not any(arr.flags.writeable for arr in list(verts.values()) + list(labelpos.values()))
+        del verts["V1"]
+        again, _ = utils.get_roi_index(subject)
+        assert list(again.keys()) == list(testing.ROIS)
+
+        cachedir = cortex.db.get_cache(subject)
+        assert os.path.exists(os.path.join(cachedir, "overlay_rois.npz"))
+        assert not [f for f in os.listdir(cachedir) if f.endswith(".tmp")]
@@ -0,0 +1,244 @@
+import time
+import threading
+
+from cortex.webgl.data import FrameCache
+
+def test_frame_cache():
+    calls = []
+    def encode(name, frame):
+        calls.append((name, frame))
+        time.sleep(0.01)
+        return b"x" * 100
+
+    cache = FrameCache(encode, maxbytes=450)
+    threads = [threading.Thread(target=cache.get, args=(("a", 0),)) for _ in range(4)]
+    [thread.start() for thread in threads]
+    [thread.join() for thread in threads]
+    assert calls == [("a", 0)] and cache.hits == 3
+
+    for frame in range(1, 6):
+        cache.get(("a", frame))
+    assert len(cache) == 4 and cache.nbytes <= 450 and ("a", 0) not in cache._cache
+
+    cache.prefetch([("b", 0), ("b", 1)])
+    for _ in range(100):
+        if ("b", 1) in cache._cache:
+            break
+        time.sleep(0.01)
+    assert ("b", 1) in cache._cache
+    cache.get(("b", 1))
+    assert calls.count(("b", 1)) == 1
+
+def test_frame_cache_close():
+    cache = FrameCache(lambda name, frame: b"x" * 10, maxbytes=1000)
+    cache.idle = 0.05
+    cache.prefetch([("a", 0)])
+    worker = cache._worker
+    worker.join(5)
+    assert not worker.is_alive() and cache._worker is None
+    assert ("a", 0) in cache._cache
+
+    #prefetching again starts a new thread, which close stops
+    cache.idle = 60
+    cache.prefetch([("a", 1)])
+    worker = cache._worker
+    cache.close()
+    assert not worker.is_alive() and len(cache) == 0 and cache.nbytes == 0
+    cache.prefetch([("a", 2)])
+    assert cache._worker is None
+    assert cache.get(("a", 3)) == b"x" * 10 and len(cache) == 0
+
+def test_ctmpacks():
+    import os
+    from cortex import testing, utils
+    import shutil
+    import tempfile
+    filestore = tempfile.mkdtemp()
+    testing.make_subject(filestore, "synth2", nverts=1000)
+    try:
+        with testing.synthetic_subject(filestore=filestore, nverts=2000) as subject:
+            ctms = utils.get_ctmpacks([subject, "synth2"], procs=2, types=("inflated",), method="mg2", level=9)
+            for name in [subject, "synth2"]:
+                cachedir = os.path.dirname(ctms[name])
+                assert os.path.exists(ctms[name])
+                assert not any(fname.endswith((".tmp", ".lock")) for fname in os.listdir(cachedir))
+                assert utils.get_ctmpack(name, ("inflated",), method="mg2", level=9) == ctms[name]
+    finally:
+        shutil.rmtree(filestore)
+
+def test_build_lock():
+    import os
+    import threading
+    import tempfile
+    from cortex import utils
+    fname = os.path.join(tempfile.mkdtemp(), "pack.json")
+    order = []
+    def build(name):
+        with utils._build_lock(fname):
+            order.append(name)
+            order.append(name)
+    threads = [threading.Thread(target=build, args=(i,)) for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    #holders never overlap, and the lock file is gone once released
+    assert all(order[i] == order[i+1] for i in range(0, len(order), 2))
+    assert os.listdir(os.path.dirname(fname)) == []
+    os.rmdir(os.path.dirname(fname))
+
+def test_read_pack():
+    import os
+    import numpy as np
+    from scipy.spatial import cKDTree
+    from cortex import testing, utils, brainctm
+    from cortex.database import db
+    with testing.synthetic_subject(nverts=2000) as subject:
+        jsfile = utils.get_ctmpack(subject, ("inflated",), method="mg2", level=9)
+        meshes = brainctm.read_pack(os.path.splitext(jsfile)[0]+".ctm")
+        for (pts, polys), (spts, spolys) in zip(meshes, db.get_surf(subject, "pia")):
+            dist, idx = cKDTree(spts).query(pts)
+            assert len(pts) == len(spts) and dist.max() < 1e-2
+            assert len(polys) == len(spolys)
+
+class _Handler(object):
+    """Records what serve.write_binary does to a tornado RequestHandler"""
+    def __init__(self, **headers):
+        self.request = type("Request", (), dict(headers=headers))()
+        self.headers = {}
+        self.status = 200
+        self.body = b""
+
+    def set_header(self, name, value):
+        self.headers[name] = value
+
+    def set_status(self, status):
+        self.status = status
+
+    def write(self, data):
+        self.body += data
+
+def test_encode_message():
+    import json
+    import struct
+    import numpy as np
+    import pytest
+    pytest.importorskip("tornado")
+    from cortex.webgl import serve
+
+    msg, binary = serve.encode_message(dict(method="query", params=["window"]))
+    assert not binary and json.loads(msg) == dict(method="query", params=["window"])
+
+    arrays = [np.arange(5, dtype=np.int64), np.linspace(0, 1, 3), np.arange(8, dtype=np.uint8)]
+    msg, binary = serve.encode_message(dict(method="run", params=arrays))
+    assert binary
+    hlen = struct.unpack("<I", msg[:4])[0]
+    assert (4 + hlen) % 8 == 0
+    header = json.loads(msg[4:4+hlen].decode("utf-8"))
+    body = msg[4+hlen:]
+    for arr, ref in zip(header['params'], arrays):
+        assert arr['offset'] % 8 == 0
+        data = np.frombuffer(body[arr['offset']:arr['offset']+arr['nbytes']], dtype=arr['dtype'])
+        assert data.shape == tuple(arr['shape']) and np.allclose(data, ref)
+    assert header['params'][0]['dtype'] == "<i4" and header['params'][1]['dtype'] == "<f4"
+    assert len(body) % 8 == 0
+
+def test_write_binary():
+    import gzip
+    import pytest
+    pytest.importorskip("tornado")
+    from cortex.webgl import serve
+
+    body = bytes(bytearray(range(100)))
+    assert serve.parse_range("bytes=10-19", 100) == (10, 20)
+    assert serve.parse_range("bytes=-10", 100) == (90, 100)
+    assert serve.parse_range("bytes=-500", 100) == (0, 100)
+    assert serve.parse_range("bytes=90-", 100) == (90, 100)
+    assert serve.parse_range("bytes=50-500", 100) == (50, 100)
+    assert serve.parse_range("bytes=-", 100) is None
+    assert serve.parse_range("bytes=0-1,5-6", 100) is None
+
+    handler = _Handler(Range="bytes=-10")
+    serve.write_binary(handler, body)
+    assert handler.status == 206 and handler.body == body[90:]
+    assert handler.headers["Content-Range"] == "bytes 90-99/100"
+
+    handler = _Handler(Range="bytes=95-")
+    serve.write_binary(handler, body)
+    assert handler.status == 206 and handler.body == body[95:]
+
+    handler = _Handler(Range="bytes=200-")
+    serve.write_binary(handler, body)
+    assert handler.status == 416 and handler.body == b""
+    assert handler.headers["Content-Range"] == "bytes */100"
+
+    handler = _Handler(**{"Accept-Encoding": "gzip, deflate"})
+    serve.write_binary(handler, body)
+    assert handler.headers["Content-Encoding"] == "gzip"
+    assert gzip.decompress(handler.body) == body
+
+    handler = _Handler(**{"Accept-Encoding": "gzip"})
+    serve.write_binary(handler, body, compress=False)
+    assert "Content-Encoding" not in handler.headers and handler.body == body
+
+def test_websocket():
+    import json
+    import threading
+    import numpy as np
+    import pytest
+    pytest.importorskip("tornado")
+    from tornado import gen, ioloop, websocket
+    from cortex.webgl import serve
+
+    app = serve.WebApp([], 18765)
+    app.start()
+    received = []
+    @gen.coroutine
+    def client():
+        for _ in range(100):
+            try:
+                ws = yield websocket.websocket_connect("ws://localhost:18765/wsconnect/")
+                break
+            except Exception:
+                yield gen.sleep(0.05)
+        yield ws.write_message("connect")
+        received.append((yield ws.read_message()))
+        yield ws.write_message(json.dumps(dict(viewer=["object", None])))
+        received.append((yield ws.read_message()))
+        yield ws.write_message(json.dumps(len(received[-1])))
+        ws.close()
+
+    thread = threading.Thread(target=lambda: ioloop.IOLoop().run_sync(client))
+    thread.daemon = True
+    thread.start()
+    try:
+        assert app.connect.wait(10)
+        assert app.send(method="query", params=["window"]) == [dict(viewer=["object", None])]
+        resp = app.send(method="run", params=["viewer.setData", [np.arange(5)]])
+        thread.join(10)
+    finally:
+        app.stop()
+    app.join(5)
+    assert not app.is_alive()
+    assert json.loads(received[0]) == dict(method="query", params=["window"])
+    assert isinstance(received[1], bytes) and resp == [len(received[1])]
+
+def test_jsproxy():
+    import pytest
+    pytest.importorskip("tornado")
+    from cortex.webgl import serve
+
+    sent = []
+    def send(**msg):
+        sent.append(msg)
+        if msg['method'] == "query":
+            return [dict(viewer=["object", None], ready=["boolean", True])]
+        return [None]
+
+    proxy = serve.JSProxy(send)
+    assert sorted(dir(proxy)) == ["ready", "viewer"] and proxy.ready is True
+    proxy.ready = False
+    proxy.viewer[2]
+    assert sent[1:] == [dict(method="set", params=["window.ready", False]),
+        dict(method="query", params=["window.viewer"]),
+        dict(method="index", params=["window.viewer", 2])]
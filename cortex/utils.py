@@ -3,9 +3,11 @@ import os
 import binascii
 import numpy as np
 from importlib import import_module
+from contextlib import contextmanager
 from .database import db
 from .volume import mosaic, unmask, anat2epispace
 from .options import config
+from . import instrument
 
 class DocLoader(object):
     def __init__(self, func, mod, package):
@@ -47,22 +49,124 @@ def get_ctmpack(subject, types=("inflated",), method="raw", level=0, recache=Fal
                                extra='' if extra_disp is None else '_xx')
     ctmfile = os.path.join(db.get_cache(subject), ctmcache)
 
-    if os.path.exists(ctmfile) and not recache: # and extra_disp is None:
-        # (never load cache with extra_disp, which is based on files outside pycortex)
-        return ctmfile
-
-    print("Generating new ctm file...")
-    from . import brainctm
-    ptmap = brainctm.make_pack(ctmfile,
-                               subject,
-                               types=types,
-                               method=method, 
-                               level=level,
-                               decimate=decimate,
-                               disp_layers=disp_layers,
-                               extra_disp=extra_disp)
+    with instrument.span("get_ctmpack", subject=subject, types=list(types), method=method) as span:
+        span.set(hit=os.path.exists(ctmfile) and not recache)
+        if os.path.exists(ctmfile) and not recache: # and extra_disp is None:
+            # (never load cache with extra_disp, which is based on files outside pycortex)
+            return ctmfile
+
+        with _build_lock(ctmfile):
+            # Another process may have built the file while we waited for the lock
+            if os.path.exists(ctmfile) and not recache:
+                span.set(hit=True)
+                return ctmfile
+
+            print("Generating new ctm file...")
+            from . import brainctm
+            ptmap = brainctm.make_pack(ctmfile,
+                                       subject,
+                                       types=types,
+                                       method=method, 
+                                       level=level,
+                                       decimate=decimate,
+                                       disp_layers=disp_layers,
+                                       extra_disp=extra_disp)
     return ctmfile
 
+def get_ctmpacks(subjects, procs=None, **kwargs):
+    """Creates the ctm files of several subjects, see get_ctmpack for the keyword
+    arguments. Subjects are built concurrently, in up to `procs` processes (by
+    default one per core).
+
+    The workers are spawned rather than forked, since the caller (such as the
+    webgl server) may be running threads. Spawned workers import the calling
+    script, so scripts that build several subjects should guard their entry
+    point with ``if __name__ == "__main__":``.
+
+    Returns
+    -------
+    ctmfiles : dict
+        Path of the ctm file of each subject
+    """
+    import multiprocessing
+    from . import mp
+    subjects = list(subjects)
+    procs = mp.cpu_count() if procs is None else procs
+    procs = max(1, min(procs, len(subjects)))
+    try:
+        context = multiprocessing.get_context("spawn")
+    except AttributeError:
+        #python 2 cannot spawn
+        procs = 1
+    if procs == 1:
+        return dict((subject, get_ctmpack(subject, **kwargs)) for subject in subjects)
+
+    pool = context.Pool(procs)
+    try:
+        ctmfiles = pool.map(_spawned_ctmpack, [(db.filestore, subject, kwargs) for subject in subjects],
+                            chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    return dict(zip(subjects, ctmfiles))
+
+def _spawned_ctmpack(args):
+    """Builds one ctm pack in a spawned worker, which starts out with the default
+    filestore rather than the one of the calling process"""
+    filestore, subject, kwargs = args
+    if db.filestore != filestore:
+        db.filestore, db._subjects = filestore, None
+    return get_ctmpack(subject, **kwargs)
+
+@contextmanager
+def _atomic_open(fname, mode="wb"):
+    """Writes to a temporary file next to `fname`, which replaces `fname` once it
+    is closed, so that readers never see a partially written file"""
+    tmpname = "%s.%d.tmp"%(fname, os.getpid())
+    try:
+        with open(tmpname, mode) as fp:
+            yield fp
+        if hasattr(os, "replace"):
+            os.replace(tmpname, fname)
+        else:
+            os.rename(tmpname, fname)
+    except:
+        if os.path.exists(tmpname):
+            os.unlink(tmpname)
+        raise
+
+@contextmanager
+def _build_lock(fname):
+    """Holds an exclusive lock on `fname`.lock, so that processes building the same
+    cache file wait for the first one instead of duplicating its work. The lock
+    file is removed when it is released. Where fcntl is not available (Windows),
+    nothing is locked."""
+    try:
+        import fcntl
+    except ImportError:
+        yield
+        return
+
+    lockname = fname+".lock"
+    while True:
+        fp = open(lockname, "a")
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        #the previous holder may have removed the file while we waited on it
+        try:
+            if os.path.samestat(os.fstat(fp.fileno()), os.stat(lockname)):
+                break
+        except OSError:
+            pass
+        fp.close()
+
+    try:
+        yield
+    finally:
+        try:
+            os.unlink(lockname)
+        finally:
+            fp.close()
+
 def get_ctmmap(subject, **kwargs):
     from scipy.spatial import cKDTree
     from . import brainctm
@@ -197,6 +301,83 @@ def add_roi(data, name="new_roi", open_inkscape=True, add_path=True, **kwargs):
     if open_inkscape:
         return sp.call(["inkscape", '-f', rois.svgfile])
 
+_roi_index = dict()
+def get_roi_index(subject, layer="rois", recache=False):
+    """Return the vertices and label positions of every ROI in an overlay layer.
+
+    The result is cached in the subject's cache directory, keyed on a hash of
+    the layer's svg contents and of the flat surface, so it is only
+    recomputed when one of those changes.
+
+    Parameters
+    ----------
+    subject : str
+        Name of the subject
+    layer : str, optional
+        Overlay layer of rois.svg, "rois" by default
+    recache : bool, optional
+        Recompute the index even if a valid cache exists
+
+    Returns
+    -------
+    verts : dict
+        Dictionary of {roi name : roi verts}, in svg order. Vertices on the
+        medial wall or in cuts are excluded.
+    labelpos : dict
+        Dictionary of {roi name : (n, 2) array} of label positions in
+        normalized flatmap coordinates
+    """
+    import hashlib
+    from collections import OrderedDict
+    from lxml import etree
+    from . import svgroi
+
+    svgfile = db.get_paths(subject)["rois"]
+    stat = os.stat(svgfile)
+    memokey = subject, layer, svgfile, stat.st_mtime, stat.st_size
+    if not recache and memokey in _roi_index:
+        verts, labelpos = _roi_index[memokey]
+        return OrderedDict(verts), OrderedDict(labelpos)
+
+    pts, polys = db.get_surf(subject, "flat", merge=True, nudge=True)
+    svg = etree.parse(svgfile, parser=svgroi.parser)
+    root = svg.getroot()
+    sha = hashlib.sha1()
+    sha.update(("%s %s"%(root.get("width"), root.get("height"))).encode())
+    sha.update(etree.tostring(svgroi._find_layer(svg, layer)))
+    sha.update(np.ascontiguousarray(pts, dtype=np.float64).tobytes())
+    sha.update(np.ascontiguousarray(polys, dtype=np.int64).tobytes())
+    key = sha.hexdigest()
+
+    cachefile = os.path.join(db.get_cache(subject), "overlay_%s.npz"%layer)
+    verts, labelpos = OrderedDict(), OrderedDict()
+    try:
+        if recache:
+            raise IOError
+        npz = np.load(cachefile)
+        if str(npz['key']) != key:
+            raise IOError
+        for i, name in enumerate(npz['names']):
+            verts[str(name)] = npz['verts_%d'%i]
+            labelpos[str(name)] = npz['labelpos_%d'%i]
+    except (IOError, OSError, KeyError, ValueError):
+        rois = db.get_overlay(subject, layer)
+        goodpts = np.unique(polys)
+        arrays = dict(key=key, names=np.array(rois.names, dtype=np.str_))
+        for i, name in enumerate(rois.names):
+            verts[name] = np.intersect1d(rois.get_roi(name), goodpts)
+            labelpos[name] = np.array(rois[name].get_labelpos(fancy=True)).reshape(-1, 2)
+            arrays['verts_%d'%i] = verts[name]
+            arrays['labelpos_%d'%i] = labelpos[name]
+        with _atomic_open(cachefile) as fp:
+            np.savez(fp, **arrays)
+
+    #the memoized arrays are shared between callers
+    for arr in list(verts.values()) + list(labelpos.values()):
+        arr.flags.writeable = False
+    _roi_index[memokey] = verts, labelpos
+    return OrderedDict(verts), OrderedDict(labelpos)
+
 def get_roi_verts(subject, roi=None):
     """Return vertices for the given ROIs, or all ROIs if none are given.
 
@@ -215,24 +396,17 @@ def get_roi_verts(subject, roi=None):
         hemispheres, with right hemisphere vertex numbers sequential
         after left hemisphere vertex numbers.
     """
-    # Get ROIpack
-    rois = db.get_overlay(subject)
-
-    # Get flat surface so we can figure out which verts are in medial wall
-    # or in cuts
-    # This assumes subject has flat surface, which they must to have ROIs..
-    pts, polys = db.get_surf(subject, "flat", merge=True)
-    goodpts = np.unique(polys)
+    verts, _ = get_roi_index(subject)
 
     if roi is None:
-        roi = rois.names
+        roi = list(verts.keys())
 
     roidict = dict()
     if isinstance(roi, str):
         roi = [roi]
 
     for name in roi:
-        roidict[name] = np.intersect1d(rois.get_roi(name), goodpts)
+        roidict[name] = verts[name]
 
     return roidict
 
@@ -297,17 +471,13 @@ def get_roi_masks(subject,xfmname,roi_list=None,dst=2,fail_for_missing_rois=Fals
     roi_index : dict
         Mapping of roi names to index values (e.g. {'V1': 1}). 
     '''
-    # Get ROIs from inkscape SVGs
-    rois, vert_idx = db.get_overlay(subject, remove_medial=True)
+    # Get ROI vertices from inkscape SVGs, excluding the medial wall
+    roi_verts, _ = get_roi_index(subject)
+    roi_names = list(roi_verts.keys())
 
     # Retrieve shape from the reference
     shape = db.get_xfm(subject, xfmname).shape
     
-    # Get 3D coordinates
-    coords = np.vstack(db.get_coords(subject, xfmname)) # UGH. Replace with a mapper object (IDK what this comment is...)
-    n_verts = np.max(coords.shape)
-    coords = coords[vert_idx]
-    n_valid_vertices = np.max(coords.shape)
     # Get distance of each voxel from fiducial surface (vox_dst) and index for each voxel showing 
     # which surface vertex is closest to it (vox_idx). Note that vox_idx includes vertices on the 
     # medial wall, which later need to be excluded from the ROIs.
@@ -325,11 +495,11 @@ def get_roi_masks(subject,xfmname,roi_list=None,dst=2,fail_for_missing_rois=Fals
         cx_mask = (vox_dst < dst).flatten()
     
     if roi_list is None:
-        roi_list = rois.names
+        roi_list = roi_names
     else:
-        roi_list = [r for r in roi_list if r in ['Cortex','cortex']+rois.names]
+        roi_list = [r for r in roi_list if r in ['Cortex','cortex']+roi_names]
         if fail_for_missing_rois:
-            fails = [r for r in roi_list if not r in ['Cortex','cortex']+rois.names]
+            fails = [r for r in roi_list if not r in ['Cortex','cortex']+roi_names]
             if any(fails):
                 for f in fails:
                     print("No ROI exists for %s"%f)
@@ -344,14 +514,8 @@ def get_roi_masks(subject,xfmname,roi_list=None,dst=2,fail_for_missing_rois=Fals
         if roi.lower()=='cortex':
             roi_idx_bin3 = np.ones(Lmask.shape)>0
         else:
-            # Complicated indexing to remove vertices/voxels on the medial wall
-            roi_idx_bin1 = np.zeros((n_valid_vertices,),np.bool) # binary index 1
-            # This step is the time-consuming step, which can't be avoided.
-            roi_idx_sub1 = rois.get_roi(roi) # substitution index 1 (in valid vertex space)
-            roi_idx_bin1[roi_idx_sub1] = True
-            roi_idx_bin2 = np.zeros((n_verts,),np.bool) # binary index 2
-            roi_idx_bin2[vert_idx] = roi_idx_bin1
-            roi_idx_sub2 = np.nonzero(roi_idx_bin2)[0] # substitution index 2 (in ALL fiducial vertex space)
+            # Cached vertex indices, with the medial wall already removed
+            roi_idx_sub2 = roi_verts[roi] # substitution index (in ALL fiducial vertex space)
             roi_idx_bin3 = np.in1d(vox_idx_flat,roi_idx_sub2) # binary index to 3D volume (flattened, though)
         tmp_mask[:,ir,0] = np.all(np.array([roi_idx_bin3,Lmask,cx_mask]),axis=0)
         tmp_mask[:,ir,1] = np.all(np.array([roi_idx_bin3,Rmask,cx_mask]),axis=0)
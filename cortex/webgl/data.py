@@ -3,40 +3,77 @@ The general structure of the object that's transmitted looks like this:
 
 dict(
     views = [ dict(name="proper name", cmap=cmap, vmin=vmin, vmax=vmax, data=["__braindata_name"]) ],
-    data  = dict(__braindata_name=dict(subject=subject, min=min, max=max)),
-    images=(__braindata_name=["img1.png", "img2.png"]),
+    data  = dict(__braindata_name=dict(subject=subject, min=min, max=max, encoding="raw")),
+    images=(__braindata_name=["/data/__braindata_name/0/", "/data/__braindata_name/1/"]),
 )
+
+Each frame of a BrainData is a 2D mosaic of its volume. Frames are either sent
+raw, as little-endian float32 (or RGBA uint8 for raw colors) bytes that the
+browser loads straight into a texture, or as PNGs for static viewers that are
+opened from the filesystem. Frames are encoded when they are first requested,
+and kept in a FrameCache.
 """
+import io
 import os
 import json
+import threading
+from collections import OrderedDict, deque
+try:
+    import configparser
+except ImportError:
+    import ConfigParser as configparser
+
 import numpy as np
 
 from .. import dataset
 from .. import volume
+from .. import options
+from .. import instrument
 
 class Package(object):
-    """Package the data into a form usable by javascript"""
-    def __init__(self, data):
+    """Package the data into a form usable by javascript
+
+    Parameters
+    ----------
+    data : Dataset
+        Data to package
+    cache_size : int, optional
+        Maximum size in bytes of the encoded frames kept in memory. Defaults to
+        the `frame_cache` option (in MB) in the [webgl] section of options.cfg.
+    prefetch : int, optional
+        Number of frames encoded in the background after each requested frame.
+        Defaults to the `prefetch` option in the [webgl] section of options.cfg.
+    """
+    def __init__(self, data, cache_size=None, prefetch=None):
         self.dataset = dataset.normalize(data)
         self.uniques = data.uniques(collapse=True)
-        
+        if prefetch is None:
+            try:
+                prefetch = options.config.getint("webgl", "prefetch")
+            except (configparser.Error, ValueError):
+                prefetch = 8
+        self.nprefetch = prefetch
+        self.cache = FrameCache(self._encode, maxbytes=cache_size)
+
         self.brains = dict()
-        self.images = dict()
+        self.volumes = dict()
+        self.dtypes = dict()
         for brain in self.uniques:
             name = brain.name
             self.brains[name] = brain.to_json(simple=True)
-            voldata = brain.volume
+            self.volumes[name] = brain.volume
             if isinstance(brain, (dataset.VolumeRGB, dataset.VertexRGB)):
-                voldata = voldata.astype(np.uint8)
+                self.dtypes[name] = np.uint8
                 self.brains[name]['raw'] = True
             else:
-                voldata = voldata.astype(np.float32)
+                self.dtypes[name] = np.float32
                 self.brains[name]['raw'] = False
-            self.images[name] = [volume.mosaic(vol, show=False) for vol in voldata]
-            if len(set([shape for m, shape in self.images[name]])) != 1:
-                raise ValueError('Internal error in mosaic')
-            self.brains[name]['mosaic'] = self.images[name][0][1]
-            self.images[name] = [_pack_png(m) for m, shape in self.images[name]]
+
+            #Every frame has the same mosaic layout as the first
+            first, shape = volume.mosaic(self._frame(name, 0), show=False)
+            self.brains[name]['mosaic'] = shape
+            height, width = first.shape[:2]
+            self.brains[name]['imsize'] = [width, height]
 
     @property
     def views(self):
@@ -53,24 +90,175 @@ class Package(object):
     def subjects(self):
         return set(braindata.subject for braindata in self.uniques)
 
-    def metadata(self, **kwargs):
-        return dict(views=self.views, data=self.brains, images=self.image_names(**kwargs))
+    def metadata(self, encoding="raw", **kwargs):
+        """Metadata for the javascript viewer, with frames in the given `encoding`
+        ('raw' or 'png') and at the urls given by `fmt`, see image_names"""
+        brains = dict((name, dict(brain, encoding=encoding)) for name, brain in self.brains.items())
+        return dict(views=self.views, data=brains, images=self.image_names(**kwargs))
 
     def image_names(self, fmt="/data/{name}/{frame}/"):
         names = dict()
-        for name, imgs in self.images.items():
-            names[name] = [fmt.format(name=name, frame=i) for i in range(len(imgs))]
+        for name, vols in self.volumes.items():
+            names[name] = [fmt.format(name=name, frame=i) for i in range(len(vols))]
         return names
 
+    def encode(self, name, frame, encoding="raw"):
+        """Returns the bytes of a frame of the BrainData `name`, encoding it if it
+        is not cached"""
+        if encoding not in ("raw", "png"):
+            raise ValueError("Unknown frame encoding %r"%encoding)
+        return self.cache.get((name, frame, encoding))
+
+    def prefetch(self, name, frame, encoding="raw"):
+        """Encodes the frames following `frame` of the BrainData `name` in the
+        background, wrapping around at the end of movies"""
+        nframes = len(self.volumes[name])
+        count = min(self.nprefetch, nframes - 1)
+        self.cache.prefetch([(name, (frame + i) % nframes, encoding) for i in range(1, count + 1)])
+
+    def close(self):
+        """Stops prefetching and frees the encoded frames"""
+        self.cache.close()
+
+    def _frame(self, name, frame):
+        return np.asarray(self.volumes[name][frame]).astype(self.dtypes[name])
+
+    def _encode(self, name, frame, encoding):
+        with instrument.span("webgl.encode", brain=name, frame=frame, encoding=encoding):
+            mosaic, shape = volume.mosaic(self._frame(name, frame), show=False)
+            if encoding == "png":
+                return _pack_png(mosaic)
+            return _pack_raw(mosaic)
+
+class FrameCache(object):
+    """Least recently used cache of encoded frames, bounded by their total size in
+    bytes. Missing frames are encoded by calling `encode(*key)`, either when they
+    are requested with `get` or ahead of time by a background thread with
+    `prefetch`. A frame that is being encoded is never encoded twice at once.
+
+    The prefetch thread exits once it has been idle for `idle` seconds, and is
+    started again by the next `prefetch`. Call `close` to stop it right away
+    and drop the cached frames.
+    """
+    #Seconds without prefetch requests before the background thread exits
+    idle = 30.
+
+    def __init__(self, encode, maxbytes=None):
+        if maxbytes is None:
+            try:
+                maxbytes = options.config.getint("webgl", "frame_cache") * 2**20
+            except (configparser.Error, ValueError):
+                maxbytes = 256 * 2**20
+        self.encode = encode
+        self.maxbytes = maxbytes
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._queue = deque(maxlen=256)
+        self._worker = None
+        self._closed = False
+
+    def __len__(self):
+        return len(self._cache)
+
+    def __repr__(self):
+        return "<Frame cache: %d hits, %d misses, %d frames, %0.1f/%0.1f MB>"%(
+            self.hits, self.misses, len(self), self.nbytes / 2.**20, self.maxbytes / 2.**20)
+
+    def get(self, key):
+        """Returns the encoded frame for `key`"""
+        with instrument.span("webgl.frame") as span:
+            while True:
+                with self._lock:
+                    if key in self._cache:
+                        self.hits += 1
+                        span.set(hit=True)
+                        value = self._cache.pop(key)
+                        self._cache[key] = value
+                        return value
+                    event = self._pending.get(key)
+                    if event is None:
+                        event = self._pending[key] = threading.Event()
+                        self.misses += 1
+                        break
+                #Another thread is encoding this frame, wait for it
+                event.wait()
+
+            span.set(hit=False)
+            try:
+                value = self.encode(*key)
+                with self._lock:
+                    if not self._closed:
+                        self._cache[key] = value
+                        self.nbytes += len(value)
+                    while self.nbytes > self.maxbytes:
+                        _, old = self._cache.popitem(last=False)
+                        self.nbytes -= len(old)
+            finally:
+                with self._lock:
+                    del self._pending[key]
+                event.set()
+            return value
+
+    def prefetch(self, keys):
+        """Queues `keys` to be encoded in a background thread. Only the most
+        recently queued frames are kept if the thread falls behind."""
+        with self._wakeup:
+            if self._closed:
+                return
+            for key in keys:
+                if key not in self._cache and key not in self._pending and key not in self._queue:
+                    self._queue.append(key)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._prefetch)
+                self._worker.daemon = True
+                self._worker.start()
+            self._wakeup.notify()
+
+    def close(self):
+        """Stops the prefetch thread and drops all cached frames. Frames can still
+        be requested with `get`, but are no longer prefetched or cached."""
+        with self._wakeup:
+            self._closed = True
+            self._queue.clear()
+            self._cache.clear()
+            self.nbytes = 0
+            worker = self._worker
+            self._wakeup.notify_all()
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
+
+    def _prefetch(self):
+        while True:
+            with self._wakeup:
+                if len(self._queue) == 0 and not self._closed:
+                    self._wakeup.wait(self.idle)
+                if len(self._queue) == 0 or self._closed:
+                    self._worker = None
+                    return
+                key = self._queue.popleft()
+            try:
+                self.get(key)
+            except Exception:
+                #Errors are raised again when the frame is requested
+                pass
+
+def _pack_raw(mosaic):
+    if mosaic.dtype not in (np.float32, np.uint8):
+        raise TypeError
+    return np.ascontiguousarray(mosaic, dtype=mosaic.dtype.newbyteorder("<")).tobytes()
+
 def _pack_png(mosaic):
     from PIL import Image
-    import cStringIO
-    buf = cStringIO.StringIO()
+    buf = io.BytesIO()
     if mosaic.dtype not in (np.float32, np.uint8):
         raise TypeError
 
     y, x = mosaic.shape[:2]
-    im = Image.frombuffer('RGBA', (x,y), mosaic.data, 'raw', 'RGBA', 0, 1)
+    im = Image.frombuffer('RGBA', (x,y), np.ascontiguousarray(mosaic).data, 'raw', 'RGBA', 0, 1)
     im.save(buf, format='PNG')
-    buf.seek(0)
-    return buf.read()
\ No newline at end of file
+    return buf.getvalue()
@@ -12,6 +12,10 @@ var dtypeNames = {
     "|i4":Int32Array,
     "|i2":Int16Array,
     "|i1":Int8Array,
+    "<u4":Uint32Array,
+    "<u2":Uint16Array,
+    "<i4":Int32Array,
+    "<i2":Int16Array,
     "<f4":Float32Array,
 }
 
@@ -28,6 +32,23 @@ function classify(data) {
     return data
 }
 
+//Websocket messages with arrays are binary: the length of a JSON header as a
+//little-endian uint32, the header, then the raw array data it refers to by offset
+function parse_message(data) {
+    if (!(data instanceof ArrayBuffer))
+        return JSON.parse(data);
+
+    var length = new DataView(data).getUint32(0, true);
+    var header = new TextDecoder("utf-8").decode(new Uint8Array(data, 4, length));
+    return JSON.parse(header, function(key, value) {
+        if (value instanceof Object && value.__class__ == "NParray" && value.offset !== undefined) {
+            value.buffer = data;
+            value.offset += 4 + length;
+        }
+        return value;
+    });
+}
+
 function parse_dict(dict) {
     dict = dict.trim();
     if (dict[0] != '{' || dict[dict.length-1] != '}')
@@ -61,6 +82,11 @@ NParray.fromData = function(data, dtype, shape) {
     return arr;
 }
 NParray.fromJSON = function(json) {
+    if (json.buffer !== undefined) {
+        var dtype = dtypeNames[json.dtype];
+        var view = new dtype(json.buffer, json.offset, json.nbytes / dtype.BYTES_PER_ELEMENT);
+        return NParray.fromData(view, json.dtype, json.shape);
+    }
     var size = json.shape.length ? json.shape[0] : 0;
     for (var i = 1, il = json.shape.length; i < il; i++) {
         size *= json.shape[i];
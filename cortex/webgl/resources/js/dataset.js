@@ -159,13 +159,30 @@ var dataset = (function(module) {
         this.min = json.min;
         this.max = json.max;
         this.mosaic = json.mosaic;
+        this.imsize = json.imsize;
+        this.encoding = json.encoding || "png";
         this.name = json.name;
 
         this.data = images[json.name];
         this.frames = images[json.name].length;
 
         this.textures = [];
-        var loadmosaic = function(idx) {
+        var addtexture = function(tex, width, height) {
+            tex.minFilter = module.filtertypes['nearest'];
+            tex.magfilter = module.filtertypes['nearest'];
+            tex.needsUpdate = true;
+            tex.flipY = false;
+            this.shape = [((width-1) / this.mosaic[0])-1, ((height-1) / this.mosaic[1])-1];
+            this.textures.push(tex);
+
+            if (this.textures.length < this.frames) {
+                this.loaded.notify(this.textures.length);
+                loadmosaic(this.textures.length);
+            } else {
+                this.loaded.resolve();
+            }
+        }.bind(this);
+        var loadpng = function(idx) {
             var img = new Image();
             img.addEventListener("load", function() {
                 var tex;
@@ -183,22 +200,29 @@ var dataset = (function(module) {
                     tex = new THREE.DataTexture(arr, img.width, img.height, THREE.LuminanceFormat, THREE.FloatType);
                     tex.premultiplyAlpha = false;
                 }
-                tex.minFilter = module.filtertypes['nearest'];
-                tex.magfilter = module.filtertypes['nearest'];
-                tex.needsUpdate = true;
-                tex.flipY = false;
-                this.shape = [((img.width-1) / this.mosaic[0])-1, ((img.height-1) / this.mosaic[1])-1];
-                this.textures.push(tex);
-
-                if (this.textures.length < this.frames) {
-                    this.loaded.notify(this.textures.length);
-                    loadmosaic(this.textures.length);
+                addtexture(tex, img.width, img.height);
+            }.bind(this));
+            img.src = this.data[idx];
+        }.bind(this);
+        //Raw frames are little-endian float32 luminance, or uint8 RGBA for raw colors
+        var loadraw = function(idx) {
+            var xhr = new XMLHttpRequest();
+            xhr.open("GET", this.data[idx], true);
+            xhr.responseType = "arraybuffer";
+            xhr.addEventListener("load", function() {
+                var tex, width = this.imsize[0], height = this.imsize[1];
+                if (this.raw) {
+                    tex = new THREE.DataTexture(new Uint8Array(xhr.response), width, height, THREE.RGBAFormat);
+                    tex.premultiplyAlpha = true;
                 } else {
-                    this.loaded.resolve();
+                    tex = new THREE.DataTexture(new Float32Array(xhr.response), width, height, THREE.LuminanceFormat, THREE.FloatType);
+                    tex.premultiplyAlpha = false;
                 }
+                addtexture(tex, width, height);
             }.bind(this));
-            img.src = this.data[this.textures.length];
+            xhr.send();
         }.bind(this);
+        var loadmosaic = this.encoding == "png" ? loadpng : loadraw;
 
         loadmosaic(0);
     };
@@ -1,10 +1,11 @@
 function Websock() {
     this.ws = new WebSocket("ws://"+location.host+"/wsconnect/");
+    this.ws.binaryType = "arraybuffer";
     this.ws.onopen = function(evt) {
         this.ws.send("connect");
     }.bind(this);
     this.ws.onmessage = function(evt) {
-        var jsdat = classify(JSON.parse(evt.data));
+        var jsdat = classify(parse_message(evt.data));
         var func = this[jsdat.method];
         var resp = func.apply(this, jsdat.params);
         //Don't return jquery objects, 
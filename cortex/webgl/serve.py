@@ -2,9 +2,9 @@ import os
 import re
 import time
 import json
+import zlib
 import stat
 import email
-import Queue
 import struct
 import socket
 import logging
@@ -12,6 +12,10 @@ import binascii
 import datetime
 import mimetypes
 import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
 import numpy as np
 import tornado.web
@@ -24,24 +28,28 @@ cwd = os.path.split(os.path.abspath(__file__))[0]
 hostname = socket.gethostname()
 
 def make_base64(imgfile):
-    with open(imgfile) as img:
+    with open(imgfile, "rb") as img:
         mtype = mimetypes.guess_type(imgfile)[0]
-        data = binascii.b2a_base64(img.read()).strip()
+        data = binascii.b2a_base64(img.read()).strip().decode('ascii')
         return "data:{mtype};base64,{data}".format(mtype=mtype, data=data)
 
+def _js_array(obj):
+    """Converts an array to a little-endian dtype that has a javascript typed array"""
+    if obj.dtype == np.float64:
+        obj = obj.astype(np.float32)
+    elif obj.dtype == np.int64:
+        obj = obj.astype(np.int32)
+    return np.ascontiguousarray(obj, dtype=obj.dtype.newbyteorder("<"))
+
 class NPEncode(json.JSONEncoder):
     def default(self, obj):
         if isinstance(obj, np.ndarray):
-            if obj.dtype == np.float:
-                obj = obj.astype(np.float32)
-            elif obj.dtype == np.int:
-                obj = obj.astype(np.int32)
-
+            obj = _js_array(obj)
             return dict(
                 __class__="NParray",
                 dtype=obj.dtype.descr[0][1], 
                 shape=obj.shape, 
-                data=binascii.b2a_base64(obj.tostring()))
+                data=binascii.b2a_base64(obj.tobytes()).decode('ascii'))
         elif isinstance(obj, (np.int64, np.int32, np.int16, np.int8, np.uint64, np.uint32, np.uint16, np.uint8)):
             return int(obj)
         elif isinstance(obj, (np.float64, np.float32)):
@@ -49,6 +57,85 @@ class NPEncode(json.JSONEncoder):
         else:
             return super(NPEncode, self).default(obj)
 
+class BinaryEncode(NPEncode):
+    """Encodes arrays as references to their raw data, which is appended to
+    `buffers` padded to 8 bytes"""
+    def __init__(self, buffers=None, **kwargs):
+        super(BinaryEncode, self).__init__(**kwargs)
+        self.buffers = buffers if buffers is not None else []
+
+    def default(self, obj):
+        if isinstance(obj, np.ndarray):
+            obj = _js_array(obj)
+            data = obj.tobytes()
+            offset = sum(len(buf) for buf in self.buffers)
+            self.buffers.append(data + b"\0" * (-len(data) % 8))
+            return dict(
+                __class__="NParray",
+                dtype=obj.dtype.descr[0][1],
+                shape=obj.shape,
+                offset=offset,
+                nbytes=len(data))
+        return super(BinaryEncode, self).default(obj)
+
+def encode_message(msg):
+    """Encodes a message for the websocket, returning the message and whether it
+    is binary. Messages without arrays are sent as JSON text. Messages with
+    arrays are sent as a single binary frame: the length of a JSON header as a
+    little-endian uint32, the header padded with spaces to 8 bytes, then the raw
+    data of the arrays, which the header refers to by offset."""
+    buffers = []
+    header = json.dumps(msg, cls=BinaryEncode, buffers=buffers)
+    if len(buffers) == 0:
+        return header, False
+
+    header = header.encode('utf-8')
+    pad = -(4 + len(header)) % 8
+    return b"".join([struct.pack("<I", len(header) + pad), header, b" " * pad] + buffers), True
+
+def parse_range(header, size):
+    """Parses an HTTP Range header for a single range of bytes, returning the
+    (start, stop) slice of a body of `size` bytes, or None if the header is not
+    understood. A slice with start >= stop cannot be satisfied."""
+    match = re.match(r"bytes=(\d*)-(\d*)$", header.strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    start, end = match.groups()
+    if start == "":
+        return max(size - int(end), 0), size
+    stop = size if end == "" else min(int(end) + 1, size)
+    return int(start), stop
+
+def gzip_bytes(data, level=1):
+    """Compresses `data` into a gzip stream, which browsers decode transparently
+    when it is sent with Content-Encoding: gzip"""
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+def write_binary(handler, body, compress=True):
+    """Writes `body` as the response of a tornado RequestHandler. Requests for a
+    single byte range get a partial response. Full responses are gzipped if
+    `compress` and the client accepts it; ranges refer to the uncompressed body."""
+    handler.set_header("Content-Type", "application/octet-stream")
+    handler.set_header("Accept-Ranges", "bytes")
+    header = handler.request.headers.get("Range")
+    span = parse_range(header, len(body)) if header is not None else None
+    if span is not None:
+        start, stop = span
+        if start >= stop:
+            handler.set_status(416)
+            handler.set_header("Content-Range", "bytes */%d"%len(body))
+            return
+        handler.set_status(206)
+        handler.set_header("Content-Range", "bytes %d-%d/%d"%(start, stop - 1, len(body)))
+        handler.write(body[start:stop])
+    elif compress and "gzip" in handler.request.headers.get("Accept-Encoding", ""):
+        handler.set_header("Content-Encoding", "gzip")
+        handler.set_header("Vary", "Accept-Encoding")
+        handler.write(gzip_bytes(body))
+    else:
+        handler.write(body)
+
 class ClientSocket(websocket.WebSocketHandler):
     def initialize(self, parent):
         self.parent = parent
@@ -78,7 +165,7 @@ class WebApp(threading.Thread):
             (r"/(.*)", tornado.web.StaticFileHandler, dict(path=cwd)),
         ]
         self.port = port
-        self.response = Queue.Queue()
+        self.response = queue.Queue()
         self.connect = threading.Event()
         self.sockets = []
 
@@ -88,25 +175,31 @@ class WebApp(threading.Thread):
         return num
 
     def run(self):
-        ioloop = tornado.ioloop.IOLoop()
-        ioloop.clear_current()
-        ioloop.make_current()
+        try:
+            #tornado >= 5 runs on asyncio, which needs a loop for this thread
+            import asyncio
+            asyncio.set_event_loop(asyncio.new_event_loop())
+        except ImportError:
+            pass
+        self.ioloop = tornado.ioloop.IOLoop.current()
         application = tornado.web.Application(self.handlers, gzip=True)
-        self.server = tornado.httpserver.HTTPServer(application, io_loop=ioloop)
+        self.server = tornado.httpserver.HTTPServer(application)
         self.server.listen(self.port)
-        ioloop.start()
+        self.ioloop.start()
 
     def stop(self):
         print("Stopping server")
+        self.ioloop.add_callback(self._stop_server)
+
+    def _stop_server(self):
         self.server.stop()
-        tornado.ioloop.IOLoop.current().stop()
+        self.ioloop.stop()
 
     def send(self, **msg):
-        if not isinstance(msg, str):
-            msg = json.dumps(msg, cls=NPEncode)
-
+        msg, binary = encode_message(msg)
+        #websockets may only be written from the thread running the ioloop
         for sock in self.sockets:
-            sock.write_message(msg)
+            self.ioloop.add_callback(sock.write_message, msg, binary=binary)
         return [json.loads(self.response.get(timeout=2)) for _ in range(self.n_clients)]
 
     def get_client(self):
@@ -128,7 +221,7 @@ class JSProxy(object):
             return self.attrs[attr][1]
 
     def __setattr__(self, attr, value):
-        if not hasattr(self, "attrs") or attr not in self.attrs:
+        if "attrs" not in self.__dict__ or attr not in self.attrs:
             return super(JSProxy, self).__setattr__(attr, value)
 
         assert self.attrs[attr] not in ["object", "function"]
@@ -153,7 +246,7 @@ class JSProxy(object):
 
     def __getitem__(self, idx):
         assert not isinstance(idx, (slice, list, tuple, np.ndarray))
-        resp = self.send(method='index', params=[self.name, args])
+        resp = self.send(method='index', params=[self.name, idx])
         if isinstance(resp[0], dict) and "error" in resp[0]:
             raise Exception(resp[0]['error'])
         else:
@@ -2,7 +2,6 @@ import os
 import glob
 import copy
 import json
-import Queue
 import shutil
 import random
 import functools
@@ -10,17 +9,25 @@ import binascii
 import mimetypes
 import threading
 import webbrowser
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+try:
+    from configparser import NoOptionError
+except ImportError:
+    from ConfigParser import NoOptionError
+
 import numpy as np
 
 from tornado import web
 from .FallbackLoader import FallbackLoader
 
-from .. import utils, options, volume, dataset
+from .. import utils, options, volume, dataset, instrument
 from ..database import db
 
 from . import serve
 from .data import Package
-from ConfigParser import NoOptionError
 
 try:
     cmapdir = options.config.get('webgl', 'colormaps')
@@ -39,6 +46,7 @@ colormaps = [(os.path.splitext(os.path.split(cm)[1])[0], serve.make_base64(cm))
 viewopts = dict(voxlines="false", voxline_color="#FFFFFF",
                 voxline_width='.01', title="Brain")
 
+@instrument.traced("webgl.make_static")
 def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r",
                 template="static.html", layout=None, anonymize=False,
                 disp_layers=['rois'], extra_disp=None, html_embed=True,
@@ -89,8 +97,7 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
     don't handle xsrf correctly
     """
     outpath = os.path.abspath(os.path.expanduser(outpath)) # To handle ~ expansion
-    if not os.path.exists(outpath):
-        os.makedirs(outpath)
+    if not os.path.exists(os.path.join(outpath, "data")):
         os.makedirs(os.path.join(outpath, "data"))
 
     data = dataset.normalize(data)
@@ -103,12 +110,11 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
     subjects = list(package.subjects)
 
     ctmargs = dict(method='mg2', level=9, recache=recache)
-    ctms = dict((subj, utils.get_ctmpack(subj,
-                                         types,
-                                         disp_layers=disp_layers,
-                                         extra_disp=extra_disp,
-                                         **ctmargs))
-                for subj in subjects)
+    ctms = utils.get_ctmpacks(subjects,
+                              types=types,
+                              disp_layers=disp_layers,
+                              extra_disp=extra_disp,
+                              **ctmargs)
 
     db.auxfile = None
     if layout is None:
@@ -149,14 +155,15 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
         submap = None
 
     #Process the data
-    metadata = package.metadata(fmt="data/{name}_{frame}.png")
-    images = package.images
+    #Static viewers may be opened from the filesystem, where only images can be loaded
+    metadata = package.metadata(fmt="data/{name}_{frame}.png", encoding="png")
     #Write out the PNGs
-    for name, imgs in images.items():
+    for name, vols in package.volumes.items():
         impath = os.path.join(outpath, "data", "{name}_{frame}.png")
-        for i, img in enumerate(imgs):
+        for i in range(len(vols)):
             with open(impath.format(name=name, frame=i), "wb") as binfile:
-                binfile.write(img)
+                #Encoded directly, since the frames are not needed again
+                binfile.write(package._encode(name, i, "png"))
 
     #Copy any stimulus files
     stimpath = os.path.join(outpath, "stim")
@@ -167,7 +174,6 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
             shutil.copy2(view.attrs['stim'], stimpath)
 
     #Parse the html file and paste all the js and css files directly into the html
-    from . import htmlembed
     if os.path.exists(template):
         ## Load locally
         templatedir, templatefile = os.path.split(os.path.abspath(template))
@@ -187,7 +193,7 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
     tpl = loader.load(templatefile)
     tpl_args = copy.deepcopy(viewopts)
     tpl_args.update(kwargs)  # override viewopts with kwargs
-    html = tpl.generate(data=json.dumps(metadata),
+    html = tpl.generate(data=json.dumps(metadata, cls=serve.NPEncode),
                         colormaps=colormaps,
                         default_cmap=cmap,
                         python_interface=False,
@@ -198,12 +204,14 @@ def make_static(outpath, data, types=("inflated",), recache=False, cmap="RdBu_r"
                         **tpl_args)
     desthtml = os.path.join(outpath, "index.html")
     if html_embed:
+        from . import htmlembed
         htmlembed.embed(html, desthtml, rootdirs)
     else:
-        with open(desthtml, "w") as htmlfile:
+        with open(desthtml, "wb") as htmlfile:
             htmlfile.write(html)
 
 
+@instrument.traced("webgl.show")
 def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
          autoclose=True, open_browser=True, port=None, pickerfun=None,
          disp_layers=['rois'], extra_disp=None, template='mixer.html', **kwargs):
@@ -233,17 +241,15 @@ def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
             stims[sname] = view.attrs['stim']
 
     package = Package(data)
-    metadata = json.dumps(package.metadata())
-    images = package.images
+    metadata = json.dumps(package.metadata(), cls=serve.NPEncode)
     subjects = list(package.subjects)
 
     kwargs.update(dict(method='mg2', level=9, recache=recache))
-    ctms = dict((subj, utils.get_ctmpack(subj,
-                                         types,
-                                         disp_layers=disp_layers,
-                                         extra_disp=extra_disp,
-                                         **kwargs))
-                for subj in subjects)
+    ctms = utils.get_ctmpacks(subjects,
+                              types=types,
+                              disp_layers=disp_layers,
+                              extra_disp=extra_disp,
+                              **kwargs)
 
     subjectjs = json.dumps(dict((subj, "/ctm/%s/"%subj) for subj in subjects))
     db.auxfile = None
@@ -258,7 +264,7 @@ def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
         smootherstep=(lambda x, y, m: linear(x, y, 6*m**5 - 15*m**4 + 10*m**3))
     )
 
-    post_name = Queue.Queue()
+    post_name = queue.Queue()
 
     if pickerfun is None:
         pickerfun = lambda a: None
@@ -268,14 +274,16 @@ def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
             subj, path = path.split('/')
             if path == '':
                 self.set_header("Content-Type", "application/json")
-                self.write(open(ctms[subj]).read())
+                with open(ctms[subj]) as fp:
+                    self.write(fp.read())
             else:
                 fpath = os.path.split(ctms[subj])[0]
                 mtype = mimetypes.guess_type(os.path.join(fpath, path))[0]
                 if mtype is None:
                     mtype = "application/octet-stream"
                 self.set_header("Content-Type", mtype)
-                self.write(open(os.path.join(fpath, path)).read())
+                with open(os.path.join(fpath, path), "rb") as fp:
+                    self.write(fp.read())
 
     class DataHandler(web.RequestHandler):
         def get(self, path):
@@ -286,9 +294,10 @@ def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
                 dataname = path
                 frame = 0
 
-            if dataname in images:
-                self.set_header("Content-Type", "image/png")
-                self.write(images[dataname][int(frame)])
+            if dataname in package.volumes:
+                frame = int(frame)
+                serve.write_binary(self, package.encode(dataname, frame))
+                package.prefetch(dataname, frame)
             else:
                 self.set_status(404)
                 self.write_error(404)
@@ -671,6 +680,10 @@ def show(data, types=("inflated",), recache=False, cmap='RdBu_r', layout=None,
 
     class WebApp(serve.WebApp):
         disconnect_on_close = autoclose
+        def stop(self):
+            super(WebApp, self).stop()
+            package.close()
+
         def get_client(self):
             self.connect.wait()
             self.connect.clear()
@@ -724,11 +737,11 @@ def _make_disp_defaults(disp_layers):
         disp_defaults[layer] = dict()
         disp_defaults[layer]["line_width"] = options.config.get(dlayer, "line_width")
 
-        line_color = map(float, options.config.get(dlayer, "line_color").split(","))
-        fill_color = map(float, options.config.get(dlayer, "fill_color").split(","))
+        line_color = list(map(float, options.config.get(dlayer, "line_color").split(",")))
+        fill_color = list(map(float, options.config.get(dlayer, "fill_color").split(",")))
 
-        disp_defaults[layer]["line_color"] = rgb_to_hex(tuple(x*255 for x in line_color[:3]))
-        disp_defaults[layer]["fill_color"] = rgb_to_hex(tuple(x*255 for x in fill_color[:3]))
+        disp_defaults[layer]["line_color"] = rgb_to_hex(tuple(int(x*255) for x in line_color[:3]))
+        disp_defaults[layer]["fill_color"] = rgb_to_hex(tuple(int(x*255) for x in fill_color[:3]))
 
         # Manually extract alpha values from line and fill color option strings
         disp_defaults[layer]["line_alpha"] = line_color[3]